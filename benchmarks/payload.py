@@ -0,0 +1,89 @@
+"""
+Payload benchmark for /ask responses.
+
+Real /ask response bodies are built by running the RAG flow on ground-truth
+questions (with the fake LLM backend unless LLM_BACKEND is set). Each
+response is then serialised the way the app used to (stdlib json with sorted
+keys, the full body) and with the options in payload.py: orjson, the
+`fields=minimal` projection, and gzip/brotli compression. For every variant
+the script reports the median body size and the median time spent on
+serialisation plus compression.
+
+From the repository root:
+
+    python benchmarks/payload.py --questions 100
+"""
+import os
+import sys
+import csv
+import json
+import time
+import uuid
+import argparse
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT, "fitness_assistant")
+
+
+def build_responses(n):
+    import rag
+
+    with open(os.path.join(ROOT, "data", "ground-trunth-retrieval.csv"), newline="") as f:
+        questions = [row["question"] for row in csv.DictReader(f)][:n]
+    return [{"conversation_id": str(uuid.uuid4()), "question": question,
+             "answer_data": rag.rag(question)} for question in questions]
+
+
+def variants():
+    import payload
+
+    minimal = payload.FIELD_PRESETS["minimal"]
+    result = {
+        "before (json, sorted, full)": lambda r: json.dumps(r, sort_keys=True, separators=(",", ":")).encode(),
+        "orjson, full": payload.dumps,
+        "orjson, fields=minimal": lambda r: payload.dumps(payload.project(r, minimal)),
+        "orjson + gzip, full": lambda r: payload.compress(payload.dumps(r), "gzip"),
+        "orjson + gzip, fields=minimal": lambda r: payload.compress(payload.dumps(payload.project(r, minimal)), "gzip"),
+    }
+    if payload.brotli is not None:
+        result["orjson + br, full"] = lambda r: payload.compress(payload.dumps(r), "br")
+    return result
+
+
+def measure(fn, responses, repeats):
+    sizes, times = [], []
+    for response in responses:
+        best = float("inf")
+        for _ in range(repeats):
+            started = time.perf_counter()
+            body = fn(response)
+            best = min(best, time.perf_counter() - started)
+        sizes.append(len(body))
+        times.append(best)
+    return statistics.median(sizes), statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure /ask response size and serialisation time")
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20, help="Timing runs per response (the best is kept)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LLM_BACKEND", "fake")
+    os.environ.setdefault("FAKE_LLM_LATENCY", "0")
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    import payload
+
+    responses = build_responses(args.questions)
+    print(f"{len(responses)} responses, orjson {'on' if payload.orjson else 'off'}, "
+          f"brotli {'on' if payload.brotli else 'off'}")
+    print(f"{'variant':<32} {'median bytes':>12} {'median us':>10}")
+    for name, fn in variants().items():
+        size, seconds = measure(fn, responses, args.repeats)
+        print(f"{name:<32} {size:>12.0f} {seconds * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Serving benchmark: throughput, latency and memory per gunicorn worker.
+
+Starts the app under four configurations, one after the other:
+
+- default: `gunicorn app:app`, a single sync worker (what the Dockerfile used to run)
+- tuned, no preload: gunicorn.conf.py with GUNICORN_PRELOAD=0
+- tuned, no preload, shared index: the same, with SHARED_INDEX_PATH set
+- tuned: gunicorn.conf.py (gthread workers, preloaded app)
+
+Each configuration gets the same burst of concurrent /ask requests with
+the fake LLM backend, so that LLM latency is simulated without quota or
+cost. Memory is read from /proc through psutil. PSS splits shared pages
+between the processes that map them, so with preloading the PSS per
+worker falls well below the RSS.
+
+Postgres must be reachable with the usual POSTGRES_* variables (run
+db_prep.py first). From the repository root:
+
+    python benchmarks/serving.py --requests 200 --concurrency 32 --llm-latency 0.5
+"""
+import os
+import csv
+import sys
+import time
+import signal
+import argparse
+import subprocess
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+import requests
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fitness_assistant")
+QUESTIONS_PATH = os.path.join(APP_DIR, "..", "data", "ground-trunth-retrieval.csv")
+
+CONFIGS = {
+    # gunicorn reads ./gunicorn.conf.py by default, so point it at an empty config
+    "default": (["gunicorn", "-c", os.devnull, "app:app"], {}),
+    "tuned, no preload": (["gunicorn", "-c", "gunicorn.conf.py", "app:app"], {"GUNICORN_PRELOAD": "0"}),
+    # Each worker attaches to the memory-mapped index instead of fitting its own
+    "tuned, no preload, shared index": (["gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                                        {"GUNICORN_PRELOAD": "0",
+                                         "SHARED_INDEX_PATH": "/dev/shm/fitness-index-bench.bin"}),
+    "tuned": (["gunicorn", "-c", "gunicorn.conf.py", "app:app"], {}),
+}
+
+
+def load_questions(n):
+    with open(QUESTIONS_PATH, newline="") as f:
+        questions = [row["question"] for row in csv.DictReader(f)]
+    return [questions[i % len(questions)] for i in range(n)]
+
+
+def wait_until_up(url, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            requests.get(f"{url}/metrics", timeout=5)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn did not start in time")
+
+
+def wait_until_idle(master_pid, timeout=120):
+    """Wait for every worker to finish booting, so startup CPU does not count against the first requests"""
+    master = psutil.Process(master_pid)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        workers = master.children()
+        if workers and all(proc.cpu_percent(interval=0.2) < 5 for proc in workers):
+            return
+    raise RuntimeError("gunicorn workers did not settle in time")
+
+
+def memory(master_pid):
+    """RSS and PSS (MiB) of the master and each worker"""
+    master = psutil.Process(master_pid)
+    result = {}
+    for name, procs in (("master", [master]), ("workers", master.children())):
+        rss, pss = [], []
+        for proc in procs:
+            info = proc.memory_full_info()
+            rss.append(info.rss / 2**20)
+            pss.append(info.pss / 2**20)
+        result[name] = {"count": len(procs), "rss": rss, "pss": pss}
+    return result
+
+
+def run(name, args, port):
+    command, extra_env = CONFIGS[name]
+    env = dict(os.environ, LLM_BACKEND="fake", FAKE_LLM_LATENCY=str(args.llm_latency),
+               FAKE_LLM_JITTER="0", FAKE_LLM_ERROR_RATE="0", FAKE_LLM_RATE_LIMIT_RATE="0",
+               GUNICORN_WORKERS=str(args.workers),
+               GUNICORN_ACCESS_LOG="/dev/null", **extra_env)
+    command = command + ["--bind", f"127.0.0.1:{port}"]
+    url = f"http://127.0.0.1:{port}"
+
+    process = subprocess.Popen(command, cwd=APP_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        started = time.monotonic()
+        wait_until_up(url, process)
+        wait_until_idle(process.pid)
+        startup = time.monotonic() - started
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+        session.mount("http://", adapter)
+
+        def ask(question):
+            t0 = time.perf_counter()
+            response = session.post(f"{url}/ask", json={"question": question}, timeout=300)
+            return time.perf_counter() - t0, response.status_code
+
+        questions = load_questions(args.requests)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(ask, questions))
+        elapsed = time.perf_counter() - started
+        mem = memory(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    latencies = sorted(t for t, _ in results)
+    errors = sum(1 for _, status in results if status != 200)
+    workers = mem["workers"]
+    return {
+        "config": name,
+        "workers": workers["count"],
+        "startup_s": startup,
+        "throughput_rps": len(results) / elapsed,
+        "p50_s": statistics.median(latencies),
+        "p95_s": latencies[int(0.95 * (len(latencies) - 1))],
+        "errors": errors,
+        "worker_rss_mib": statistics.mean(workers["rss"]),
+        "worker_pss_mib": statistics.mean(workers["pss"]),
+        "total_pss_mib": sum(workers["pss"]) + sum(mem["master"]["pss"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gunicorn serving configurations")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4, help="Workers for the tuned configurations")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Simulated seconds per LLM call")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    args = parser.parse_args()
+
+    rows = []
+    for name in args.configs:
+        print(f"[INFO] Benchmarking {name}...", file=sys.stderr)
+        rows.append(run(name, args, args.port))
+
+    columns = ["config", "workers", "startup_s", "throughput_rps", "p50_s", "p95_s", "errors",
+               "worker_rss_mib", "worker_pss_mib", "total_pss_mib"]
+    print(" | ".join(columns))
+    for row in rows:
+        print(" | ".join(f"{row[c]:.2f}" if isinstance(row[c], float) else str(row[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Startup benchmark for the app and CLI entry points.
+
+Each entry point is imported in a fresh interpreter with `python -X importtime`.
+The script reports the median import time over several runs, plus the
+modules with the largest cumulative import time from the last run. For the
+app it also times the warm-up (index, facet bitmaps, reranker and LLM
+client), which runs in the gunicorn hooks rather than at import.
+
+From the repository root:
+
+    python benchmarks/startup.py --runs 5
+"""
+import os
+import sys
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT, "fitness_assistant")
+
+ENTRY_POINTS = {
+    "app": (APP_DIR, "import app"),
+    "app + warmup": (APP_DIR, "import app; app.warmup(); app.llm.get_backend().warmup()"),
+    "cli": (ROOT, "import cli"),
+}
+
+
+def parse_importtime(stderr):
+    """Return {module: cumulative microseconds} from -X importtime output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def measure(cwd, code):
+    """Wall time of a fresh interpreter running code, and its import times"""
+    wrapped = f"import time; t0 = time.perf_counter(); {code}; print(time.perf_counter() - t0)"
+    env = dict(os.environ, LLM_BACKEND=os.getenv("LLM_BACKEND", "fake"))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", wrapped], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import and warm-up time of the entry points")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="Slowest top-level imports to list")
+    args = parser.parse_args()
+
+    for name, (cwd, code) in ENTRY_POINTS.items():
+        times = []
+        for _ in range(args.runs):
+            elapsed, modules = measure(cwd, code)
+            times.append(elapsed)
+        print(f"{name}: median {statistics.median(times) * 1000:.0f} ms "
+              f"(min {min(times) * 1000:.0f} ms, {args.runs} runs)")
+        top_level = {m: t for m, t in modules.items() if "." not in m}
+        for module, micros in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {module:<24} {micros / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,150 @@
+import sys
+import csv
 import json
+import time
 import uuid
+import random
 import argparse
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import requests
-import questionary
+from requests.adapters import HTTPAdapter
 
-import pandas as pd
+
+def make_session(pool_size=1):
+    """A requests session that keeps up to pool_size connections to the server alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def load_questions(file_path):
+    with open(file_path, newline="") as f:
+        return [row["question"] for row in csv.DictReader(f)]
 
 
 def get_random_question(file_path):
-    df = pd.read_csv(file_path)
-    return df.sample(n=1).iloc[0]["question"]
+    return random.choice(load_questions(file_path))
 
 
-def ask_question(url, question):
+def ask_question(url, question, session=requests, timeout=None):
     data = {"question": question}
-    response = requests.post(url, json=data)
+    response = session.post(url, json=data, timeout=timeout)
     return response.json()
 
 
-def send_feedback(url, conversation_id, feedback):
+def send_feedback(url, conversation_id, feedback, session=requests):
     feedback_data = {"conversation_id": conversation_id, "feedback": feedback}
-    response = requests.post(f"{url}/feedback", json=feedback_data)
+    response = session.post(f"{url}/feedback", json=feedback_data)
     return response.status_code
 
 
+def read_batch_questions(source):
+    """
+    Yield questions from a file or stdin ("-").
+
+    A .csv file must have a "question" column; anything else is read as one
+    question per line, blank lines skipped.
+    """
+    if source.endswith(".csv"):
+        yield from load_questions(source)
+        return
+    f = sys.stdin if source == "-" else open(source)
+    try:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def timed_ask(session, url, question, timeout):
+    """Send one question; return a JSONL record with its latency and status"""
+    started = time.perf_counter()
+    record = {"question": question}
+    try:
+        response = session.post(url, json={"question": question}, timeout=timeout)
+        record["status"] = response.status_code
+        body = response.json()
+        if response.ok:
+            record["conversation_id"] = body.get("conversation_id")
+            record["answer"] = body.get("answer_data", {}).get("answer")
+        else:
+            record["error"] = body.get("error", response.reason)
+    except (requests.RequestException, ValueError) as e:
+        record["status"] = None
+        record["error"] = str(e)
+    record["latency"] = round(time.perf_counter() - started, 4)
+    return record
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_batch(base_url, source, output, concurrency, timeout=120, limit=None):
+    """
+    Ask every question from source with up to `concurrency` requests in flight.
+
+    Results are written to output as JSON lines in completion order, and a
+    latency/throughput summary is printed to stderr.
+    """
+    session = make_session(concurrency)
+    url = f"{base_url}/ask"
+    questions = read_batch_questions(source)
+    latencies = []
+    errors = 0
+    out = sys.stdout if output == "-" else open(output, "w")
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            in_flight = set()
+            for i, question in enumerate(questions):
+                if limit is not None and i >= limit:
+                    break
+                # Bounded submission, so a long stdin stream is not read into memory up front
+                if len(in_flight) >= concurrency * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    errors += write_results(done, out, latencies)
+                in_flight.add(pool.submit(timed_ask, session, url, question, timeout))
+            errors += write_results(in_flight, out, latencies, wait_all=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - started
+
+    total = len(latencies)
+    latencies.sort()
+    print(f"{total} questions in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f} req/s), "
+          f"{errors} errors, concurrency {concurrency}", file=sys.stderr)
+    print(f"latency p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+          f"p90 {percentile(latencies, 0.9) * 1000:.0f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms, "
+          f"max {(latencies[-1] if latencies else 0) * 1000:.0f} ms", file=sys.stderr)
+    return errors
+
+
+def write_results(futures, out, latencies, wait_all=False):
+    if wait_all:
+        futures = wait(futures).done
+    errors = 0
+    for future in futures:
+        record = future.result()
+        latencies.append(record["latency"])
+        if record["status"] != 200:
+            errors += 1
+        out.write(json.dumps(record) + "\n")
+    out.flush()
+    return errors
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Interactive CLI app for continuous question answering and feedback"
@@ -32,10 +152,28 @@ def main():
     parser.add_argument(
         "--random", action="store_true", help="Use random questions from the CSV file"
     )
+    parser.add_argument("--url", default="http://localhost:5000", help="Base URL of the app")
+    parser.add_argument(
+        "--batch", metavar="FILE",
+        help="Non-interactive: ask every question in FILE (.csv with a question column, "
+             "else one per line; - for stdin)",
+    )
+    parser.add_argument("--output", default="-", help="Batch results as JSON lines (default stdout)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Batch requests in flight")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--limit", type=int, default=None, help="Ask at most this many batch questions")
     args = parser.parse_args()
 
-    base_url = "http://localhost:5000"
-    csv_file = "./data/ground-truth-retrieval.csv"
+    base_url = args.url
+    csv_file = "./data/ground-trunth-retrieval.csv"
+
+    if args.batch:
+        errors = run_batch(base_url, args.batch, args.output, args.concurrency, args.timeout, args.limit)
+        sys.exit(1 if errors else 0)
+
+    import questionary
+
+    session = make_session()
 
     print("Welcome to the interactive question-answering app!")
     print("You can exit the program at any time when prompted.")
@@ -47,7 +185,7 @@ def main():
         else:
             question = questionary.text("Enter your question:").ask()
 
-        response = ask_question(f"{base_url}/ask", question)
+        response = ask_question(f"{base_url}/ask", question, session)
         conversation_id = response.get("conversation_id")
         response = response.get("answer_data")
         answer = response.get("answer", "No answer provided")
@@ -60,7 +198,7 @@ def main():
 
         if feedback != "Pass (Skip feedback)":
             feedback_value = 1 if feedback == "+1 (Positive)" else -1
-            status = send_feedback(base_url, conversation_id, feedback_value)
+            status = send_feedback(base_url, conversation_id, feedback_value, session)
             print(f"Feedback sent. Status code: {status}")
         else:
             print("Feedback skipped.")
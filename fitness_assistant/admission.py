@@ -0,0 +1,258 @@
+"""
+Admission control for /ask.
+
+At most ADMISSION_MAX_INFLIGHT RAG runs execute at once in a worker. Up to
+ADMISSION_MAX_QUEUE more requests wait for a slot, first come first
+served, for at most ADMISSION_QUEUE_TIMEOUT seconds. Anything beyond that
+is shed immediately with Overloaded. A shed request costs no LLM call,
+and its Retry-After comes from the recent execution time.
+
+While a request runs, the client's socket can be registered with
+watch_disconnect(). rag() then calls cancel_point() before each LLM call,
+so it stops, without spending tokens, once nobody is waiting for the
+answer. A request that only waits for another request's run (a
+single-flight follower) gives its slot back with release_slot(), and
+takes one again with readmit() if it ends up doing the run itself. The
+queue only holds requests that already have a worker thread,
+so ADMISSION_MAX_INFLIGHT + ADMISSION_MAX_QUEUE should not exceed
+GUNICORN_THREADS by much.
+"""
+import os
+import math
+import time
+import socket
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+import deadlines
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", 6))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 16))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 5))
+
+_disconnect_probe = contextvars.ContextVar("disconnect_probe", default=None)
+_current_slot = contextvars.ContextVar("admission_slot", default=None)
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed; retry_after is a hint in whole seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server overloaded ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ClientDisconnected(Exception):
+    """Raised at a cancel point when the client has gone away"""
+
+
+class _Slot:
+    def __init__(self, controller):
+        self.controller = controller
+        self.started = time.perf_counter()
+        self.held = True
+        self.lock = threading.Lock()
+
+    def release(self, duration=None):
+        """Give the slot back once; returns whether this call released it"""
+        with self.lock:
+            if not self.held:
+                return False
+            self.held = False
+        self.controller._release(duration)
+        return True
+
+
+class AdmissionController:
+    """
+    Concurrency cap with a bounded FIFO wait queue.
+
+    Args:
+        max_inflight (int): Runs allowed at once.
+        max_queue (int): Requests allowed to wait for a slot; more are shed at once.
+        queue_timeout (float): Seconds a request may wait before it is shed.
+    """
+
+    def __init__(self, max_inflight=ADMISSION_MAX_INFLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._waiters = deque()  # Events of the queued requests, oldest first
+        self._avg_duration = 1.0  # EWMA of execution seconds, for Retry-After
+
+    def inflight(self):
+        return self._inflight
+
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def retry_after(self):
+        """Seconds until the current queue is likely to have drained"""
+        with self._lock:
+            backlog = len(self._waiters) + 1
+            return max(1, math.ceil(self._avg_duration * backlog / self.max_inflight))
+
+    def _shed(self, reason):
+        metrics.inc("admission.shed")
+        metrics.inc(f"admission.shed.{reason}")
+        raise Overloaded(reason, self.retry_after())
+
+    @contextmanager
+    def admit(self, timeout=None):
+        """
+        Hold an execution slot for the duration of the block.
+
+        Raises:
+            Overloaded: If the queue is full or no slot frees up within the timeout.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        waited = self._acquire(timeout)
+        metrics.inc("admission.admitted")
+        if waited:
+            metrics.inc("admission.queued")
+        slot = _Slot(self)
+        token = _current_slot.set(slot)
+        try:
+            yield
+        finally:
+            _current_slot.reset(token)
+            slot.release(time.perf_counter() - slot.started)
+
+    def _acquire(self, timeout):
+        """Take a slot, waiting in the queue if needed; returns whether it waited"""
+        with self._lock:
+            if self._inflight < self.max_inflight and not self._waiters:
+                self._inflight += 1
+                return False
+            if len(self._waiters) >= self.max_queue or timeout <= 0:
+                full = True
+            else:
+                full = False
+                granted = threading.Event()
+                self._waiters.append(granted)
+        if full:
+            self._shed("queue_full")
+
+        if granted.wait(timeout):
+            return True
+        with self._lock:
+            if granted.is_set():
+                # The slot was handed over just as the wait timed out
+                return True
+            self._waiters.remove(granted)
+        self._shed("timeout")
+
+    def _release(self, duration=None):
+        with self._lock:
+            if duration is not None:
+                self._avg_duration = 0.9 * self._avg_duration + 0.1 * duration
+            if self._waiters:
+                # Hand the slot straight to the oldest waiter, so newcomers cannot overtake it
+                self._waiters.popleft().set()
+            else:
+                self._inflight -= 1
+
+
+def release_slot():
+    """
+    Give back the current request's execution slot before the request ends.
+
+    For requests that go on waiting without doing the work themselves, so
+    they do not take capacity from requests that do. Does nothing outside
+    admit() or if the slot was already released.
+    """
+    slot = _current_slot.get()
+    if slot is not None and slot.release():
+        metrics.inc("admission.released_early")
+
+
+@contextmanager
+def readmit(timeout=None):
+    """
+    Hold an execution slot again for the block if release_slot() gave the current one back.
+
+    Does nothing outside admit() or while the slot is still held.
+
+    Raises:
+        Overloaded: If no slot frees up within the timeout (by default the
+            controller's queue timeout, cut to the request deadline).
+    """
+    slot = _current_slot.get()
+    if slot is None or slot.held:
+        yield
+        return
+    if timeout is None:
+        timeout = deadlines.timeout(slot.controller.queue_timeout)
+    metrics.inc("admission.readmitted")
+    with slot.controller.admit(timeout=timeout):
+        yield
+
+
+def socket_disconnected(sock):
+    """True if the peer has closed the connection (a pending request body does not count)"""
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+
+@contextmanager
+def watch_disconnect(sock):
+    """Make cancel_point() in this context raise ClientDisconnected once sock is closed by the client"""
+    token = _disconnect_probe.set(sock)
+    try:
+        yield
+    finally:
+        _disconnect_probe.reset(token)
+
+
+@contextmanager
+def shielded():
+    """Disable cancellation, for work whose result is shared with other requests"""
+    token = _disconnect_probe.set(None)
+    try:
+        yield
+    finally:
+        _disconnect_probe.reset(token)
+
+
+def cancel_point(stage):
+    """
+    Stop the current request if its client has disconnected.
+
+    Raises:
+        ClientDisconnected: If the watched socket is closed.
+    """
+    sock = _disconnect_probe.get()
+    if sock is not None and socket_disconnected(sock):
+        metrics.inc("admission.cancelled")
+        logger.info(f"Client disconnected, cancelled before {stage}")
+        raise ClientDisconnected(stage)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Return the process-wide admission controller"""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController()
+                metrics.set_gauge("admission.inflight", _controller.inflight)
+                metrics.set_gauge("admission.queue_depth", _controller.queue_depth)
+    return _controller
@@ -1,9 +1,136 @@
 from flask import Flask, request, jsonify
+import os
 import uuid
+import logging
+import threading
+import functools
 from rag import rag  
 import db
+import llm
+import cache
+import facets
+import metrics
+import sessions
+import singleflight
+import tracing
+import admission
+import payload
+import deadlines
+import stages
+import index_registry
+import spool
+from rag import summarise_history, readiness, warmup
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+payload.configure_json(app)
+
+# Identical questions asked at the same time share one RAG run
+coalescer = singleflight.SingleFlight(shared_dir=os.getenv("SINGLEFLIGHT_DIR"))
+
+session_store = sessions.SessionStore()
+
+admission_control = admission.get_admission_controller()
+
+# Write the conversation row once the response is sent; feedback waits for the write
+WRITE_AFTER_RESPONSE = os.getenv("CONVERSATION_WRITE", "after_response") == "after_response"
+PENDING_WRITE_WAIT = float(os.getenv("PENDING_WRITE_WAIT", 5))
+pending_writes = {}  # conversation_id -> threading.Event, set once the row is written
+
+CONVERSATIONS_PAGE_LIMIT = 100
+FEEDBACK_BATCH_LIMIT = int(os.getenv("FEEDBACK_BATCH_LIMIT", 1000))
+stats_cache = cache.TTLCache(ttl=float(os.getenv("STATS_CACHE_TTL", 10)))
+
+
+def is_valid_uuid(value):
+    try:
+        uuid.UUID(str(value))
+        return True
+    except ValueError:
+        return False
+
+def save_conversation(conversation_id, question, answer_data, timeout=None):
+    columns = dict(
+        question=question,
+        answer=answer_data.get("answer"),
+        model_used=answer_data["model_used"],
+        response_time=answer_data["response_time"],
+        relevance=answer_data["relevance"],
+        relevance_explanation=answer_data["relevance_explanation"],
+        prompt_tokens=answer_data["prompt_tokens"],
+        completion_tokens=answer_data["completion_tokens"],
+        total_tokens=answer_data["total_tokens"],
+        eval_prompt_tokens=answer_data["eval_prompt_tokens"],
+        eval_completion_tokens=answer_data["eval_completion_tokens"],
+        eval_total_tokens=answer_data["eval_total_tokens"],
+        gemini_cost=answer_data["gemini_cost"],
+        retrieval_time=answer_data["retrieval_time"],
+        llm_time=answer_data["llm_time"],
+        judge_time=answer_data["judge_time"],
+        degradations=answer_data.get("degradations"))
+    if spool.enabled():
+        # Appended to the local spool, shipped to Postgres in the background
+        with tracing.span("spool.append"):
+            spool.get_spool().append([spool.conversation_record(conversation_id, **columns)])
+        return
+    with tracing.span("db.save_conversation"):
+        db.save_conversation(conversation_id=conversation_id, timeout=timeout, **columns)
+
+def save_feedback(feedback_items):
+    """Save (conversation_id, feedback, event_id) items, through the spool when it is enabled"""
+    wait_for_writes({conversation_id for conversation_id, _, _ in feedback_items})
+    if spool.enabled():
+        spool.get_spool().append([spool.feedback_record(conversation_id, feedback, event_id)
+                                  for conversation_id, feedback, event_id in feedback_items])
+        return len(feedback_items)
+    return db.save_feedback_batch(feedback_items)
+
+def parse_event_id(item):
+    """Optional client idempotency key of a feedback item; retries with the same one are stored once"""
+    event_id = item.get('event_id')
+    if event_id is not None and not is_valid_uuid(event_id):
+        raise ValueError('event_id must be a UUID')
+    return event_id
+
+def db_timeout():
+    # A late answer is still worth saving, but not worth a hung worker
+    return max(deadlines.timeout(), deadlines.DB_MIN_TIMEOUT)
+
+def write_after_response(response, conversation_id, write):
+    """Run write once the response has been sent to the client, in the same worker thread"""
+    done = threading.Event()
+    pending_writes[conversation_id] = done
+
+    def write_conversation():
+        try:
+            write()
+        except Exception as e:
+            # The client already has its answer; the row is lost, so count it
+            metrics.inc("conversation_write.failed")
+            logger.error(f"Saving conversation {conversation_id} failed: {e}")
+        finally:
+            done.set()
+            pending_writes.pop(conversation_id, None)
+
+    response.call_on_close(write_conversation)
+
+def deadline_bound(answer_data, error):
+    """Whether an answer or error depended on the request deadline it was computed under"""
+    if error is not None:
+        return isinstance(error, (deadlines.DeadlineExceeded, llm.LLMTimeoutError))
+    return bool(answer_data.get('degradations'))
+
+def wait_for_writes(conversation_ids):
+    """Wait for conversation rows this worker is still writing, so feedback on them is not skipped"""
+    for conversation_id in conversation_ids:
+        done = pending_writes.get(conversation_id)
+        if done is not None:
+            done.wait(PENDING_WRITE_WAIT)
+
+@app.after_request
+def compress_response(response):
+    return payload.compress_response(response, request.headers.get('Accept-Encoding'))
 
 @app.route('/ask', methods=['POST'])
 def ask_question():
@@ -12,45 +139,136 @@ def ask_question():
     
     if not question:
         return jsonify({'error': 'Question is required'}), 400
+
+    # Multi-turn sessions: pass session_id, or start_session to get a new one
+    session_id = data.get('session_id')
+    if session_id is None and data.get('start_session'):
+        session_id = str(uuid.uuid4())
+    if session_id is not None and not is_valid_uuid(session_id):
+        return jsonify({'error': 'Invalid session_id'}), 400
+
+    # Optional facet filters, e.g. {"type_of_equipment": "Bodyweight", "body_part": ["Lower Body"]}
+    try:
+        filters = facets.parse_filters(data.get('filters'))
+    except (ValueError, AttributeError) as e:
+        return jsonify({'error': f'Invalid filters: {e}'}), 400
+
+    # Optional projection of the response, e.g. fields=conversation_id,answer_data.answer or fields=minimal
+    try:
+        fields = payload.parse_fields(request.args.get('fields') or data.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid fields: {e}'}), 400
+
+    # Each gym has its own catalogue: X-Tenant-ID header, or tenant in the query string or body
+    tenant = (request.headers.get('X-Tenant-ID') or request.args.get('tenant')
+              or data.get('tenant') or index_registry.DEFAULT_TENANT)
+    try:
+        index_registry.catalogue_path(tenant)
+    except index_registry.UnknownTenant:
+        return jsonify({'error': 'Unknown tenant'}), 404
+
+    # End-to-end deadline in seconds; REQUEST_TIMEOUT if the client gives none
+    try:
+        timeout = deadlines.parse_timeout(data.get('timeout'))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid timeout: {e}'}), 400
     
     # Generate a unique conversation ID
     conversation_id = str(uuid.uuid4())
-    
+
+    with tracing.start_trace("ask", {"conversation_id": conversation_id,
+                                     "session": session_id is not None,
+                                     "tenant": tenant}):
+        # Shed load with a fast 503 rather than queueing behind slow LLM calls until gunicorn
+        # times out; Overloaded comes from admit() or from a follower taking its slot back
+        try:
+            with deadlines.start(timeout), \
+                    admission_control.admit(timeout=deadlines.timeout(admission_control.queue_timeout)), \
+                    admission.watch_disconnect(request.environ.get('gunicorn.socket')):
+                return answer_question(conversation_id, question, session_id, filters, fields, tenant)
+        except admission.Overloaded as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+def answer_question(conversation_id, question, session_id, filters, fields=None,
+                    tenant=index_registry.DEFAULT_TENANT):
+    # Runs inside the request's trace, so the stages below show up as its spans
     try:
-        # Invoke the RAG function with the question
-        answer_data = rag(question)
-        
-        # db.save_conversation(
-        #             question=question,
-        #             answer=answer,
-        #             model_used="gemini-1.5-flash",
-        #             response_time=result["response_time"],
-        #             relevance=result["relevance"],
-        #             relevance_explanation=result["relevance_explanation"],
-        #             prompt_tokens=result["prompt_tokens"],
-        #             completion_tokens=result["completion_tokens"],
-        #             gemini_cost=result["gemini_cost"]
-        #         )  # Save conversation to the database
-        
-        # Return the answer and conversation ID
-        
-        db.save_conversation(
-                            conversation_id=conversation_id,
-                            question=question,
-                             answer = answer_data.get("answer"), 
-                             model_used=answer_data["model_used"], 
-                             response_time=answer_data["response_time"], 
-                            relevance=answer_data["relevance"], 
-                            relevance_explanation=answer_data["relevance_explanation"],
-                            prompt_tokens=answer_data["prompt_tokens"], 
-                            completion_tokens= answer_data["completion_tokens"],
-                            gemini_cost= answer_data["gemini_cost"])
-        return jsonify({
-            'conversation_id': conversation_id,
-            'question': question,
-            'answer_data': answer_data
-        }), 200
+        # The client may have given up while the request was queued
+        admission.cancel_point("rag")
+        # The tenant's catalogue is loaded here on first use, within the admission limit
+        with index_registry.use(tenant):
+            graph = stages.StageGraph("ask")
+            write_deps = ["rag"]
+            if not spool.enabled():
+                # A pooled connection for the conversation row is opened while the question is answered
+                graph.add("db.connect", db.get_pool().prepare)
+                write_deps.append("db.connect")
+            if session_id:
+                # Answers depend on the session history, so they are never shared
+                def load_session():
+                    with tracing.span("session.load"):
+                        return session_store.get_or_create(session_id)
+
+                def save_turn(session, answer_data):
+                    with tracing.span("session.save"):
+                        session_store.add_turn(session, question, answer_data["answer"],
+                                               summarise=summarise_history)
+
+                graph.add("session.load", load_session)
+                graph.add("rag", lambda session: rag(question, session=session, filters=filters),
+                          deps=["session.load"])
+                graph.add("session.save", save_turn, deps=["session.load", "rag"])
+            else:
+                # Invoke the RAG function with the question, sharing the run with identical in-flight questions
+                key = tenant + "|" + singleflight.normalise_question(question)
+                if filters:
+                    key += "|" + repr(sorted((field, sorted(values)) for field, values in filters.items()))
+                # The run may be shared, so one client disconnecting must not cancel it
+                def run_shared():
+                    with admission.shielded():
+                        return rag(question, filters=filters)
+
+                def run_coalesced():
+                    # Followers wait without an admission slot; a degraded answer or a timeout
+                    # is not shared with followers that have more time left
+                    answer_data, shared = coalescer.do(key, run_shared, deadline_bound=deadline_bound)
+                    return dict(answer_data) if shared else answer_data
+
+                graph.add("rag", run_coalesced)
+
+            if not WRITE_AFTER_RESPONSE:
+                graph.add("db.save_conversation",
+                          lambda answer_data, *_: save_conversation(conversation_id, question, answer_data,
+                                                                    timeout=db_timeout()),
+                          deps=write_deps)
+            with tracing.span("ask.stages") as stages_span:
+                answer_data = graph.run()["rag"]
+                critical_path, _ = graph.critical_path()
+                stages_span.set_attribute("critical_path", " > ".join(critical_path))
+
+            # Return the answer and conversation ID
+            response = {
+                'conversation_id': conversation_id,
+                'question': question,
+                'answer_data': answer_data
+            }
+            if session_id:
+                response['session_id'] = session_id
+            response = jsonify(payload.project(response, fields))
+            if WRITE_AFTER_RESPONSE:
+                write_after_response(response, conversation_id,
+                                     functools.partial(save_conversation, conversation_id, question,
+                                                       answer_data, timeout=db_timeout()))
+            return response, 200
         
+    except admission.Overloaded:
+        # A single-flight follower that had to run itself got no slot back; shed with a 503
+        raise
+    except admission.ClientDisconnected:
+        # Nobody is waiting for the answer; 499 as in nginx, for the access log only
+        return jsonify({'error': 'Client disconnected'}), 499
+    except (deadlines.DeadlineExceeded, llm.LLMTimeoutError) as e:
+        return jsonify({'error': f'Deadline exceeded: {e}'}), 504
     except Exception as e:
         return jsonify({'error': f'Error processing question: {str(e)}'}), 500
 
@@ -61,16 +279,108 @@ def submit_feedback():
     conversation_id = data.get('conversation_id')
     feedback = data.get('feedback')
     
-    if not conversation_id or feedback not in [-1, 1]:
+    if not conversation_id or not is_valid_uuid(conversation_id) or feedback not in [-1, 1]:
         return jsonify({'error': 'Valid conversation_id and feedback (+1 or -1) are required'}), 400
+    try:
+        event_id = parse_event_id(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    db.save_feedback(conversation_id=conversation_id,
-                     feedback=feedback
-                     )
-    # Acknowledge receiving feedback (database storage to be implemented later)
+    save_feedback([(conversation_id, feedback, event_id)])
+    # Acknowledge receiving feedback
     return jsonify({
         'message': f'Received feedback {feedback} for conversation {conversation_id}'
     }), 200
 
+@app.route('/feedback/batch', methods=['POST'])
+def submit_feedback_batch():
+    # Clients syncing offline feedback send many items in one request
+    data = request.get_json()
+    items = data.get('feedback') if isinstance(data, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'A non-empty "feedback" list is required'}), 400
+    if len(items) > FEEDBACK_BATCH_LIMIT:
+        return jsonify({'error': f'At most {FEEDBACK_BATCH_LIMIT} feedback items per batch'}), 400
+
+    feedback_items = []
+    for i, item in enumerate(items):
+        conversation_id = item.get('conversation_id') if isinstance(item, dict) else None
+        feedback = item.get('feedback') if isinstance(item, dict) else None
+        if not conversation_id or not is_valid_uuid(conversation_id) or feedback not in [-1, 1]:
+            return jsonify({'error': f'Item {i}: valid conversation_id and feedback (+1 or -1) are required'}), 400
+        try:
+            feedback_items.append((conversation_id, feedback, parse_event_id(item)))
+        except ValueError as e:
+            return jsonify({'error': f'Item {i}: {e}'}), 400
+
+    # With the spool, saved counts the items spooled; feedback for unknown conversations is dropped later
+    saved = save_feedback(feedback_items)
+    return jsonify({
+        'received': len(feedback_items),
+        'saved': saved
+    }), 200
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    conversation_id = request.args.get('conversation_id')
+    if conversation_id:
+        if not is_valid_uuid(conversation_id):
+            return jsonify({'error': 'Invalid conversation_id'}), 400
+        stats = stats_cache.get_or_compute(('conversation', conversation_id),
+                                           lambda: db.get_conversation_feedback_stats(conversation_id))
+        if stats is None:
+            return jsonify({'error': 'No feedback for this conversation'}), 404
+        return jsonify(stats), 200
+
+    days = request.args.get('days', 30, type=int)
+    stats = stats_cache.get_or_compute(('summary', days), lambda: {
+        'feedback': db.get_feedback_stats(),
+        'by_model': db.get_feedback_stats_by_model(),
+        'by_day': [dict(row, day=row['day'].isoformat())
+                   for row in db.get_daily_feedback_stats(days=days)],
+        'llm_spend': [dict(row, day=row['day'].isoformat())
+                      for row in db.get_llm_spend(days=days)],
+    })
+    return jsonify(stats), 200
+
+@app.route('/conversations', methods=['GET'])
+def list_conversations():
+    # Conversation history, newest first; pass next_cursor back as cursor to get the next page
+    limit = min(max(request.args.get('limit', 20, type=int), 1), CONVERSATIONS_PAGE_LIMIT)
+    include_text = request.args.get('include_text', 'false').lower() in ('1', 'true', 'yes')
+
+    try:
+        rows, next_cursor = db.get_conversations_page(
+            limit=limit,
+            cursor=request.args.get('cursor'),
+            relevance=request.args.get('relevance'),
+            model_used=request.args.get('model'),
+            include_text=include_text
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    for row in rows:
+        row['id'] = str(row['id'])
+        row['timestamp'] = row['timestamp'].isoformat()
+    return jsonify({
+        'conversations': rows,
+        'next_cursor': next_cursor
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify(metrics.snapshot()), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # 200 once the index and LLM client are warm, so load balancers only route to warm workers
+    status = readiness()
+    is_ready = status['index'] and status['llm_client']
+    return jsonify(dict(status, ready=is_ready)), 200 if is_ready else 503
+
 if __name__ == '__main__':
+    warmup()
+    llm.get_backend().warmup()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+Small thread-safe in-process caches.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Cache whose entries expire a fixed number of seconds after they were computed.
+
+    Args:
+        ttl (float): Lifetime of an entry, in seconds.
+        max_entries (int): Expired entries are pruned once the cache grows past this size.
+    """
+
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get_or_compute(self, key, fn):
+        """Return the cached value for key, computing it with fn() when missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        value = fn()
+        with self._lock:
+            now = time.monotonic()
+            if len(self._entries) >= self.max_entries:
+                self._entries = {k: e for k, e in self._entries.items() if e[0] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LRUCache:
+    """
+    Bounded cache that drops the least recently used entry first.
+
+    Every entry remembers how long it took to compute, so the cache can
+    report how much time its hits saved.
+
+    Args:
+        max_entries (int): Maximum number of entries kept.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def get_or_compute(self, key, fn):
+        """Return the cached value for key, computing it with fn() on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry[1]
+                return entry[0]
+            self.misses += 1
+        started = time.perf_counter()
+        value = fn()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._entries[key] = (value, elapsed)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio(),
+            "saved_seconds": self.saved_seconds,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,239 @@
+"""
+LLM cost accounting and daily budget enforcement.
+
+Prices live in PRICE_TABLES, one entry per price list with the date it took
+effect, and every recorded cost is tagged with the version it was priced
+with. Prompt tokens served from Gemini's context cache (cached_tokens) are
+billed at the cached-input rate.
+
+SpendTracker keeps per-day/per-model spend in memory and a background
+thread flushes the deltas to the `llm_spend_daily` table. Each flush also
+reads back the day's total across all workers. Budget checks compare that
+total, plus this worker's unflushed spend, with DAILY_BUDGET_USD, so they
+never touch Postgres on the request path. Past BUDGET_SKIP_JUDGE_RATIO of
+the budget the relevance judge is skipped. Past BUDGET_DOWNGRADE_RATIO,
+answers use the lighter model in MODEL_DOWNGRADES, but only when the
+current price table makes it cheaper.
+
+Offline tools that call the LLM (replay) install their own tracker with
+persist=False, so their spend is neither written to `llm_spend_daily` nor
+counted against the production budget.
+"""
+import os
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# USD per million tokens; add a new entry (never edit an old one) when prices change
+PRICE_TABLES = [
+    {
+        "version": "2025-05-01",
+        "effective": "2025-05-01",
+        "models": {
+            "gemini-1.5-flash": {"input": 0.075, "cached_input": 0.01875, "output": 0.30},
+            "gemini-1.5-flash-8b": {"input": 0.0375, "cached_input": 0.01, "output": 0.15},
+            "gemini-2.0-flash": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+            "gemini-2.0-flash-lite": {"input": 0.075, "cached_input": 0.01875, "output": 0.30},
+        },
+    },
+]
+
+# Lighter model to answer with once the downgrade threshold is reached or the
+# deadline is close; for the budget it is only used if it is priced lower
+MODEL_DOWNGRADES = {
+    "gemini-1.5-flash": "gemini-1.5-flash-8b",
+    "gemini-2.0-flash": "gemini-2.0-flash-lite",
+}
+
+DAILY_BUDGET_USD = float(os.getenv("DAILY_BUDGET_USD", 0)) or None
+BUDGET_SKIP_JUDGE_RATIO = float(os.getenv("BUDGET_SKIP_JUDGE_RATIO", 0.8))
+BUDGET_DOWNGRADE_RATIO = float(os.getenv("BUDGET_DOWNGRADE_RATIO", 0.9))
+COST_FLUSH_INTERVAL = float(os.getenv("COST_FLUSH_INTERVAL", 10))
+
+
+def price_table(on=None):
+    """The price table in effect on a date (today, UTC, by default)"""
+    on = (on or datetime.now(timezone.utc).date()).isoformat()
+    effective = [table for table in PRICE_TABLES if table["effective"] <= on]
+    return max(effective or PRICE_TABLES, key=lambda table: table["effective"])
+
+
+def calculate_cost(model, tokens_stats, table=None):
+    """
+    Cost of one LLM call in USD.
+
+    Args:
+        model (str): Model name, a key of the price table.
+        tokens_stats (dict): prompt_tokens, completion_tokens and optionally cached_tokens.
+        table (dict): Price table to use; the current one by default.
+    Raises:
+        KeyError: If the model has no price.
+    """
+    prices = (table or price_table())["models"][model]
+    cached = tokens_stats.get("cached_tokens", 0) or 0
+    uncached = max(tokens_stats["prompt_tokens"] - cached, 0)
+    return (uncached * prices["input"]
+            + cached * prices["cached_input"]
+            + tokens_stats["completion_tokens"] * prices["output"]) / 1_000_000
+
+
+def cheaper_model(model, table=None):
+    """
+    The downgrade of `model` if it costs less per token, else `model` itself.
+
+    A model is cheaper if neither its input nor its output price is higher
+    and at least one is lower.
+    """
+    downgrade = MODEL_DOWNGRADES.get(model)
+    prices = (table or price_table())["models"]
+    if downgrade is None or model not in prices or downgrade not in prices:
+        return model
+    current, lighter = prices[model], prices[downgrade]
+    keys = ("input", "output")
+    if all(lighter[k] <= current[k] for k in keys) and any(lighter[k] < current[k] for k in keys):
+        return downgrade
+    return model
+
+
+class SpendTracker:
+    """
+    In-memory daily spend counters with periodic flushes to Postgres.
+
+    Args:
+        daily_budget (float): Budget in USD per UTC day; None disables the guards.
+        flush_interval (float): Seconds between background flushes.
+        persist (bool): Flush to Postgres; False keeps the spend in this process only.
+    """
+
+    def __init__(self, daily_budget=DAILY_BUDGET_USD, flush_interval=COST_FLUSH_INTERVAL, persist=True):
+        self.daily_budget = daily_budget
+        self.flush_interval = flush_interval
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._pending = {}  # (day, model, price_version) -> [calls, prompt, cached, completion, cost]
+        self._day = None
+        self._flushed_total = 0.0  # day's total across workers, as of the last flush
+        self._pending_total = 0.0
+        self._thread = None
+
+    def _today(self):
+        return datetime.now(timezone.utc).date()
+
+    def record(self, model, tokens_stats):
+        """Account for one LLM call and return its cost"""
+        table = price_table()
+        try:
+            cost = calculate_cost(model, tokens_stats, table)
+        except KeyError:
+            logger.warning(f"No price for model {model}, recording zero cost")
+            cost = 0.0
+        day = self._today()
+        with self._lock:
+            if day != self._day:
+                self._day, self._flushed_total, self._pending_total = day, 0.0, 0.0
+            counters = self._pending.setdefault((day, model, table["version"]), [0, 0, 0, 0, 0.0])
+            counters[0] += 1
+            counters[1] += tokens_stats["prompt_tokens"]
+            counters[2] += tokens_stats.get("cached_tokens", 0) or 0
+            counters[3] += tokens_stats["completion_tokens"]
+            counters[4] += cost
+            self._pending_total += cost
+        metrics.inc("cost.usd_total", cost)
+        if self.persist:
+            self._ensure_thread()
+        return cost
+
+    def today_spend(self):
+        """Today's spend in USD: the last flushed total across workers plus this worker's unflushed spend"""
+        with self._lock:
+            if self._day != self._today():
+                return 0.0
+            return self._flushed_total + self._pending_total
+
+    def budget_ratio(self):
+        if not self.daily_budget:
+            return 0.0
+        return self.today_spend() / self.daily_budget
+
+    def should_skip_judge(self):
+        return self.daily_budget is not None and self.budget_ratio() >= BUDGET_SKIP_JUDGE_RATIO
+
+    def answer_model(self, model):
+        """The model to answer with: a cheaper one, if there is one, once the downgrade threshold is reached"""
+        if self.daily_budget is not None and self.budget_ratio() >= BUDGET_DOWNGRADE_RATIO:
+            return cheaper_model(model)
+        return model
+
+    def flush(self):
+        """Write pending spend to Postgres and refresh today's total across workers"""
+        if not self.persist:
+            return
+        import db
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            pending_total, self._pending_total = self._pending_total, 0.0
+            day = self._day or self._today()
+        rows = [(d, model, version, *counters) for (d, model, version), counters in pending.items()]
+        try:
+            total = db.add_llm_spend(rows, day)
+        except Exception as e:
+            # Put the deltas back so they are written by the next flush
+            with self._lock:
+                for key, counters in pending.items():
+                    current = self._pending.setdefault(key, [0, 0, 0, 0, 0.0])
+                    for i, value in enumerate(counters):
+                        current[i] += value
+                if self._day == day:
+                    self._pending_total += pending_total
+            logger.warning(f"Could not flush LLM spend: {e}")
+            return
+        with self._lock:
+            if self._day == day:
+                self._flushed_total = total
+            elif self._day is None:
+                self._day, self._flushed_total = day, total
+
+    def _ensure_thread(self):
+        # Started on first use, so it is never inherited across a gunicorn fork
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="spend-flusher", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.flush_interval):
+            self.flush()
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_spend_tracker():
+    """Return the process-wide spend tracker"""
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = SpendTracker()
+                atexit.register(_tracker.flush)
+                metrics.set_gauge("cost.today_usd", _tracker.today_spend)
+                metrics.set_gauge("cost.budget_ratio", _tracker.budget_ratio)
+    return _tracker
+
+
+def set_spend_tracker(tracker):
+    """Replace the process-wide spend tracker, before any LLM call is made"""
+    global _tracker
+    with _tracker_lock:
+        _tracker = tracker
+    metrics.set_gauge("cost.today_usd", tracker.today_spend)
+    metrics.set_gauge("cost.budget_ratio", tracker.budget_ratio)
@@ -1,7 +1,10 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_values
 import uuid
 import os
+import base64
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 load_dotenv()
@@ -16,18 +19,129 @@ def get_db_connection():
         port=os.getenv("POSTGRES_PORT")
     )
 
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free in time"""
+
+class ConnectionPool:
+    """
+    At most `size` connections per process, kept open between requests.
+
+    Connections are opened on demand. A connection returned after an error,
+    or found closed, is dropped and replaced by a new one on the next checkout.
+    """
+
+    def __init__(self, size=DB_POOL_SIZE, connect=get_db_connection):
+        self.size = size
+        self.connect = connect
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        """Open a connection ahead of a checkout if none is idle (e.g. while a request is answered)"""
+        with self._lock:
+            if self._idle:
+                return
+        conn = self.connect()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def acquire(self, timeout=DB_POOL_TIMEOUT):
+        """
+        Raises:
+            PoolTimeout: If every connection stayed checked out for `timeout` seconds.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolTimeout(f"No database connection free within {timeout:.1f}s")
+        try:
+            with self._lock:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if not conn.closed:
+                        return conn
+            return self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        try:
+            if discard or conn.closed:
+                conn.close()
+            else:
+                conn.rollback()  # ends any transaction, and with it SET LOCAL settings
+                with self._lock:
+                    keep = len(self._idle) < self.size
+                    if keep:
+                        self._idle.append(conn)
+                if not keep:
+                    conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout=DB_POOL_TIMEOUT):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool, created on first use so connections are never shared across a fork"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool()
+                _pool_pid = os.getpid()
+    return _pool
+
 def init_db():
     """Initialize database tables by dropping them if they exist, then recreating."""
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
             print("[INFO] Dropping existing tables (if any)...")
+            cur.execute("DROP TABLE IF EXISTS feedback_daily_stats")
+            cur.execute("DROP TABLE IF EXISTS feedback_conversation_stats")
             cur.execute("DROP TABLE IF EXISTS feedback")
             cur.execute("DROP TABLE IF EXISTS conversations")
+            cur.execute("DROP TABLE IF EXISTS sessions")
+            cur.execute("DROP TABLE IF EXISTS llm_spend_daily")
+            conn.commit()
+    finally:
+        conn.close()
+    migrate_db()
+    print("[INFO] Database initialized successfully.")
+
+def migrate_db():
+    """
+    Create or upgrade the tables in place, keeping their data.
 
-            print("[INFO] Creating 'conversations' table...")
+    Every statement is idempotent, so this can run on an empty database, on
+    one created by an older version, or on one that is already current.
+    Counter tables created here are filled from the existing feedback.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            print("[INFO] Creating or upgrading 'conversations' table...")
             cur.execute("""
-                CREATE TABLE conversations (
+                CREATE TABLE IF NOT EXISTS conversations (
                     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
                     question TEXT NOT NULL,
                     answer TEXT NOT NULL,
@@ -42,21 +156,123 @@ def init_db():
                     completion_tokens INTEGER,
                     total_tokens INTEGER,
                     gemini_cost FLOAT,
+                    retrieval_time FLOAT,
+                    llm_time FLOAT,
+                    judge_time FLOAT,
+                    degradations TEXT[],
                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
             """)
+            cur.execute("""
+                ALTER TABLE conversations
+                    ADD COLUMN IF NOT EXISTS retrieval_time FLOAT,
+                    ADD COLUMN IF NOT EXISTS llm_time FLOAT,
+                    ADD COLUMN IF NOT EXISTS judge_time FLOAT,
+                    ADD COLUMN IF NOT EXISTS degradations TEXT[]
+            """)
+
+            print("[INFO] Creating conversation history indexes...")
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conversations_timestamp_id
+                ON conversations (timestamp DESC, id DESC)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conversations_relevance_timestamp_id
+                ON conversations (relevance, timestamp DESC, id DESC)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conversations_model_timestamp_id
+                ON conversations (model_used, timestamp DESC, id DESC)
+            """)
 
-            print("[INFO] Creating 'feedback' table...")
+            print("[INFO] Creating or upgrading 'feedback' table...")
             cur.execute("""
-                CREATE TABLE feedback (
+                CREATE TABLE IF NOT EXISTS feedback (
                     id SERIAL PRIMARY KEY,
                     conversation_id UUID REFERENCES conversations(id),
                     feedback INTEGER NOT NULL CHECK (feedback IN (-1, 1)),
+                    event_id UUID NOT NULL UNIQUE DEFAULT gen_random_uuid(),
                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            # Existing rows each get their own random event_id
+            cur.execute("""
+                ALTER TABLE feedback
+                    ADD COLUMN IF NOT EXISTS event_id UUID NOT NULL UNIQUE DEFAULT gen_random_uuid()
+            """)
+
+            print("[INFO] Creating feedback counter tables...")
+            cur.execute("SELECT to_regclass('feedback_conversation_stats') IS NULL")
+            backfill = cur.fetchone()[0]
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS feedback_conversation_stats (
+                    conversation_id UUID PRIMARY KEY REFERENCES conversations(id),
+                    positive_feedback INTEGER NOT NULL DEFAULT 0,
+                    negative_feedback INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS feedback_daily_stats (
+                    day DATE NOT NULL,
+                    model_used VARCHAR(100) NOT NULL,
+                    positive_feedback INTEGER NOT NULL DEFAULT 0,
+                    negative_feedback INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, model_used)
+                )
+            """)
+            if backfill:
+                # Same aggregation as insert_feedback(), over the feedback stored so far
+                cur.execute("""
+                    INSERT INTO feedback_conversation_stats (conversation_id, positive_feedback, negative_feedback)
+                    SELECT conversation_id,
+                           COUNT(*) FILTER (WHERE feedback = 1),
+                           COUNT(*) FILTER (WHERE feedback = -1)
+                    FROM feedback
+                    WHERE conversation_id IS NOT NULL
+                    GROUP BY conversation_id
+                """)
+                cur.execute("""
+                    INSERT INTO feedback_daily_stats AS s (day, model_used, positive_feedback, negative_feedback)
+                    SELECT f.timestamp::date,
+                           COALESCE(c.model_used, 'unknown'),
+                           COUNT(*) FILTER (WHERE f.feedback = 1),
+                           COUNT(*) FILTER (WHERE f.feedback = -1)
+                    FROM feedback f
+                    JOIN conversations c ON c.id = f.conversation_id
+                    GROUP BY 1, 2
+                    ON CONFLICT (day, model_used) DO UPDATE SET
+                        positive_feedback = s.positive_feedback + EXCLUDED.positive_feedback,
+                        negative_feedback = s.negative_feedback + EXCLUDED.negative_feedback
+                """)
+
+            print("[INFO] Creating or upgrading 'sessions' table...")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id UUID PRIMARY KEY,
+                    summary TEXT NOT NULL DEFAULT '',
+                    turns JSONB NOT NULL DEFAULT '[]',
+                    version INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cur.execute("ALTER TABLE sessions ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0")
+
+            print("[INFO] Creating 'llm_spend_daily' table...")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS llm_spend_daily (
+                    day DATE NOT NULL,
+                    model VARCHAR(100) NOT NULL,
+                    price_version VARCHAR(20) NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                    cached_tokens BIGINT NOT NULL DEFAULT 0,
+                    completion_tokens BIGINT NOT NULL DEFAULT 0,
+                    cost DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, model, price_version)
+                )
+            """)
 
             conn.commit()
-            print("[INFO] Database initialized successfully.")
+            print("[INFO] Database schema is up to date.")
     finally:
         conn.close()
 
@@ -72,11 +288,23 @@ def save_conversation(conversation_id,
                      eval_prompt_tokens=0,
                      eval_completion_tokens=0,
                      eval_total_tokens=0,
-                     gemini_cost=0):
-    """Save a conversation to the database"""
-    conn = get_db_connection()
-    try:
+                     gemini_cost=0,
+                     retrieval_time=None,
+                     llm_time=None,
+                     judge_time=None,
+                     degradations=None,
+                     timeout=None):
+    """
+    Save a conversation to the database, with the seconds spent in each stage.
+
+    Args:
+        degradations (list): Names of the stages degraded by the request deadline.
+        timeout (float): Seconds the INSERT may take (statement_timeout), no limit if None.
+    """
+    with get_pool().connection() as conn:
         with conn.cursor() as cur:
+            if timeout is not None:
+                cur.execute("SET LOCAL statement_timeout = %s", (max(1, int(timeout * 1000)),))
             cur.execute("""
                 INSERT INTO conversations 
                 (id, question, 
@@ -91,8 +319,12 @@ def save_conversation(conversation_id,
                  eval_prompt_tokens,
                  eval_completion_tokens,
                  eval_total_tokens, 
-                 gemini_cost)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                 gemini_cost,
+                 retrieval_time,
+                 llm_time,
+                 judge_time,
+                 degradations)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING id
             """, (conversation_id,
                   question, answer,
@@ -100,74 +332,417 @@ def save_conversation(conversation_id,
                   relevance, relevance_explanation,
                   prompt_tokens, completion_tokens, total_tokens,
                   eval_prompt_tokens, eval_completion_tokens, eval_total_tokens,
-                  gemini_cost))
+                  gemini_cost,
+                  retrieval_time, llm_time, judge_time, degradations))
             
             result = cur.fetchone()
             conn.commit()
             return result[0] if result else conversation_id
-    finally:
-        conn.close()
 
 def save_feedback(conversation_id, feedback):
     """Save user feedback for a conversation"""
+    return save_feedback_batch([(conversation_id, feedback)])
+
+def save_feedback_batch(feedback_items):
+    """
+    Save many feedback rows with one multi-row insert and update the feedback counters.
+
+    Feedback for unknown conversations is skipped. The per-conversation and
+    per-day/per-model counters are updated in the same statement, so they
+    always agree with the feedback table.
+
+    Args:
+        feedback_items (list): (conversation_id, feedback) or (conversation_id, feedback, event_id)
+            tuples; feedback with an event_id that is already stored is skipped too.
+    Returns:
+        int: Number of feedback rows saved.
+    """
+    if not feedback_items:
+        return 0
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            saved = insert_feedback(cur, [(item[0], item[1], item[2] if len(item) > 2 else None, None)
+                                          for item in feedback_items])
+            conn.commit()
+            return saved
+
+def insert_feedback(cur, feedback_items):
+    """
+    Insert feedback rows and update the counters, without committing.
+
+    Feedback for unknown conversations, and feedback whose event_id is
+    already stored, is skipped.
+
+    Args:
+        feedback_items (list): (conversation_id, feedback, event_id, timestamp) tuples;
+            event_id and timestamp may be None for a new id and the current time.
+    Returns:
+        int: Number of feedback rows inserted.
+    """
+    rows = execute_values(cur, """
+        WITH inserted AS (
+            INSERT INTO feedback (conversation_id, feedback, event_id, timestamp)
+            SELECT v.conversation_id, v.feedback,
+                   COALESCE(v.event_id, gen_random_uuid()),
+                   COALESCE(v.timestamp::timestamp, CURRENT_TIMESTAMP)
+            FROM (VALUES %s) AS v (conversation_id, feedback, event_id, timestamp)
+            JOIN conversations c ON c.id = v.conversation_id
+            ON CONFLICT (event_id) DO NOTHING
+            RETURNING conversation_id, feedback, timestamp
+        ),
+        per_conversation AS (
+            INSERT INTO feedback_conversation_stats AS s
+                (conversation_id, positive_feedback, negative_feedback)
+            SELECT conversation_id,
+                   COUNT(*) FILTER (WHERE feedback = 1),
+                   COUNT(*) FILTER (WHERE feedback = -1)
+            FROM inserted
+            GROUP BY conversation_id
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                positive_feedback = s.positive_feedback + EXCLUDED.positive_feedback,
+                negative_feedback = s.negative_feedback + EXCLUDED.negative_feedback
+        ),
+        per_day AS (
+            INSERT INTO feedback_daily_stats AS s
+                (day, model_used, positive_feedback, negative_feedback)
+            SELECT i.timestamp::date,
+                   COALESCE(c.model_used, 'unknown'),
+                   COUNT(*) FILTER (WHERE i.feedback = 1),
+                   COUNT(*) FILTER (WHERE i.feedback = -1)
+            FROM inserted i
+            JOIN conversations c ON c.id = i.conversation_id
+            GROUP BY 1, 2
+            ON CONFLICT (day, model_used) DO UPDATE SET
+                positive_feedback = s.positive_feedback + EXCLUDED.positive_feedback,
+                negative_feedback = s.negative_feedback + EXCLUDED.negative_feedback
+        )
+        SELECT COUNT(*) FROM inserted
+    """, feedback_items,
+        template="(%s::uuid, %s::integer, %s::uuid, %s::timestamptz)",
+        page_size=len(feedback_items),
+        fetch=True)
+    return rows[0][0]
+
+SPOOLED_CONVERSATION_COLUMNS = [
+    "id", "question", "answer", "model_used", "response_time", "relevance",
+    "relevance_explanation", "prompt_tokens", "completion_tokens", "total_tokens",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "gemini_cost",
+    "retrieval_time", "llm_time", "judge_time", "degradations", "timestamp"
+]
+
+def save_spooled(conversations, feedback):
+    """
+    Insert conversation and feedback records shipped from the local spool, in one transaction.
+
+    Records already in the database (same conversation id or feedback
+    event_id) are skipped, so a batch can be shipped again after a failure.
+    Conversations go first, so feedback in the same batch finds them.
+
+    Args:
+        conversations (list): Records from spool.conversation_record().
+        feedback (list): Records from spool.feedback_record().
+    Returns:
+        list: event_ids of the feedback whose conversation is not in the database.
+    """
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO feedback (conversation_id, feedback)
-                VALUES (%s, %s)
-            """, (conversation_id, feedback))
+            if conversations:
+                columns = ", ".join(SPOOLED_CONVERSATION_COLUMNS)
+                # timestamptz in the spool, stored in the server's time zone like CURRENT_TIMESTAMP
+                template = "(" + ", ".join("%s::timestamptz" if column == "timestamp" else "%s"
+                                           for column in SPOOLED_CONVERSATION_COLUMNS) + ")"
+                execute_values(cur, f"""
+                    INSERT INTO conversations ({columns}) VALUES %s
+                    ON CONFLICT (id) DO NOTHING
+                """, [tuple(record.get(column) for column in SPOOLED_CONVERSATION_COLUMNS)
+                      for record in conversations],
+                    template=template, page_size=len(conversations))
+            missing = []
+            if feedback:
+                insert_feedback(cur, [(r["conversation_id"], r["feedback"], r["event_id"], r["timestamp"])
+                                      for r in feedback])
+                missing = execute_values(cur, """
+                    SELECT v.event_id::text FROM (VALUES %s) AS v (event_id, conversation_id)
+                    WHERE NOT EXISTS (SELECT 1 FROM conversations c WHERE c.id = v.conversation_id)
+                """, [(r["event_id"], r["conversation_id"]) for r in feedback],
+                    template="(%s::uuid, %s::uuid)", page_size=len(feedback), fetch=True)
             conn.commit()
+            return [row[0] for row in missing]
     finally:
         conn.close()
 
 def get_conversation_by_id(conversation_id):
     """Get a conversation by ID"""
-    conn = get_db_connection()
-    try:
+    with get_pool().connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("""
                 SELECT * FROM conversations WHERE id = %s
             """, (conversation_id,))
             return cur.fetchone()
-    finally:
-        conn.close()
 
 def get_feedback_stats():
-    """Get feedback statistics"""
-    conn = get_db_connection()
-    try:
+    """Get feedback statistics from the daily counters"""
+    with get_pool().connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("""
                 SELECT 
-                    COUNT(*) as total_feedback,
-                    COUNT(CASE WHEN feedback = 1 THEN 1 END) as positive_feedback,
-                    COUNT(CASE WHEN feedback = -1 THEN 1 END) as negative_feedback
-                FROM feedback
+                    COALESCE(SUM(positive_feedback + negative_feedback), 0) as total_feedback,
+                    COALESCE(SUM(positive_feedback), 0) as positive_feedback,
+                    COALESCE(SUM(negative_feedback), 0) as negative_feedback
+                FROM feedback_daily_stats
             """)
             return cur.fetchone()
-    finally:
-        conn.close()
+
+def get_feedback_stats_by_model():
+    """Get feedback counters per model"""
+    with get_pool().connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT model_used,
+                       SUM(positive_feedback) as positive_feedback,
+                       SUM(negative_feedback) as negative_feedback
+                FROM feedback_daily_stats
+                GROUP BY model_used
+                ORDER BY model_used
+            """)
+            return cur.fetchall()
+
+def get_daily_feedback_stats(days=30):
+    """Get feedback counters per day and model for the last N days"""
+    with get_pool().connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT day, model_used, positive_feedback, negative_feedback
+                FROM feedback_daily_stats
+                WHERE day > CURRENT_DATE - %s
+                ORDER BY day DESC, model_used
+            """, (days,))
+            return cur.fetchall()
+
+def get_conversation_feedback_stats(conversation_id):
+    """Get feedback counters for one conversation"""
+    with get_pool().connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT conversation_id, positive_feedback, negative_feedback
+                FROM feedback_conversation_stats
+                WHERE conversation_id = %s
+            """, (conversation_id,))
+            return cur.fetchone()
+
+def get_session(session_id):
+    """Get a conversation session (rolling summary, recent turns and version) by ID"""
+    with get_pool().connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT summary, turns, version FROM sessions WHERE id = %s
+            """, (session_id,))
+            return cur.fetchone()
+
+def get_session_version(session_id):
+    """Version of a stored session, or None if it has never been saved"""
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT version FROM sessions WHERE id = %s", (session_id,))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+def save_session(session_id, summary, turns, version=0):
+    """
+    Save a session if it is still at `version` (0 for a session never saved).
+
+    Args:
+        version (int): The version the changes were made on.
+    Returns:
+        int: The new version, or None if another writer saved the session first.
+    """
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO sessions (id, summary, turns, version, updated_at)
+                VALUES (%s, %s, %s, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT (id) DO UPDATE SET
+                    summary = EXCLUDED.summary,
+                    turns = EXCLUDED.turns,
+                    version = sessions.version + 1,
+                    updated_at = EXCLUDED.updated_at
+                WHERE sessions.version = %s
+                RETURNING version
+            """, (session_id, summary, Json(turns), version))
+            row = cur.fetchone()
+            conn.commit()
+            return row[0] if row else None
+
+CONVERSATION_SUMMARY_COLUMNS = [
+    "id", "question", "model_used", "response_time", "relevance",
+    "prompt_tokens", "completion_tokens", "gemini_cost", "timestamp",
+]
+CONVERSATION_TEXT_COLUMNS = ["answer", "relevance_explanation"]
+
+def encode_cursor(timestamp, conversation_id):
+    """Encode the (timestamp, id) position of a row as an opaque page cursor"""
+    raw = f"{timestamp.isoformat()}|{conversation_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Decode a page cursor back into (timestamp, id); raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        timestamp, conversation_id = raw.split("|")
+        return datetime.fromisoformat(timestamp), str(uuid.UUID(conversation_id))
+    except (UnicodeError, TypeError, base64.binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def get_conversations_page(limit=20, cursor=None, relevance=None, model_used=None,
+                           include_text=False):
+    """
+    Get one page of conversations, newest first, with keyset pagination on (timestamp, id).
+
+    Args:
+        limit (int): Page size.
+        cursor (str): Cursor returned with the previous page, None for the first page.
+        relevance (str): Only return conversations with this relevance.
+        model_used (str): Only return conversations answered by this model.
+        include_text (bool): Also return the large answer and relevance_explanation columns.
+    Returns:
+        tuple: (rows, next_cursor) where next_cursor is None on the last page.
+    """
+    columns = CONVERSATION_SUMMARY_COLUMNS + (CONVERSATION_TEXT_COLUMNS if include_text else [])
+    conditions = []
+    params = []
+    if relevance:
+        conditions.append("relevance = %s")
+        params.append(relevance)
+    if model_used:
+        conditions.append("model_used = %s")
+        params.append(model_used)
+    if cursor:
+        conditions.append("(timestamp, id) < (%s, %s::uuid)")
+        params.extend(decode_cursor(cursor))
+
+    query = f"SELECT {', '.join(columns)} FROM conversations"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+    # One extra row tells whether there is a next page
+    params.append(limit + 1)
+
+    with get_pool().connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["timestamp"], rows[-1]["id"])
+    return rows, next_cursor
 
 def get_last_conversations(limit=5, relevance_filter=None):
     """Get the last N conversations, optionally filtered by relevance"""
+    rows, _ = get_conversations_page(limit=limit, relevance=relevance_filter,
+                                     include_text=True)
+    return rows
+
+def iter_conversations(since=None, until=None, model_used=None, limit=None, batch_size=500):
+    """
+    Stream recorded conversations, oldest first, through a server-side cursor.
+
+    Rows are fetched batch_size at a time, so memory stays constant however
+    many conversations match.
+
+    Args:
+        since (datetime): Only conversations at or after this time.
+        until (datetime): Only conversations before this time.
+        model_used (str): Only conversations answered by this model.
+        limit (int): Stop after this many rows.
+    Yields:
+        dict: One conversation row.
+    """
+    query = """
+        SELECT id, question, model_used, response_time, relevance,
+               prompt_tokens, completion_tokens, total_tokens,
+               eval_prompt_tokens, eval_completion_tokens, eval_total_tokens,
+               gemini_cost, retrieval_time, llm_time, judge_time, timestamp
+        FROM conversations
+    """
+    conditions = []
+    params = []
+    if since is not None:
+        conditions.append("timestamp >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("timestamp < %s")
+        params.append(until)
+    if model_used is not None:
+        conditions.append("model_used = %s")
+        params.append(model_used)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY timestamp, id"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = """
-                SELECT id, question, answer, course, model_used, response_time,
-                       relevance, relevance_explanation, prompt_tokens,
-                       completion_tokens, gemini_cost, timestamp
-                FROM conversations
-            """
-            params = []
-            if relevance_filter:
-                query += " WHERE relevance = %s"
-                params.append(relevance_filter)
-            query += " ORDER BY timestamp DESC LIMIT %s"
-            params.append(limit)
-            
+        # A named cursor lives on the server; the client only holds itersize rows
+        with conn.cursor(name=f"replay_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = batch_size
             cur.execute(query, params)
-            return cur.fetchall()
+            for row in cur:
+                yield row
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+def add_llm_spend(rows, day):
+    """
+    Add per-model spend deltas to the daily counters and return the day's total.
+
+    Args:
+        rows (list): (day, model, price_version, calls, prompt_tokens, cached_tokens,
+            completion_tokens, cost) tuples.
+        day (date): Day whose total spend (all models, all workers) is returned.
+    Returns:
+        float: Total cost recorded for day, in USD.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            if rows:
+                execute_values(cur, """
+                    INSERT INTO llm_spend_daily AS s
+                        (day, model, price_version, calls, prompt_tokens, cached_tokens,
+                         completion_tokens, cost)
+                    VALUES %s
+                    ON CONFLICT (day, model, price_version) DO UPDATE SET
+                        calls = s.calls + EXCLUDED.calls,
+                        prompt_tokens = s.prompt_tokens + EXCLUDED.prompt_tokens,
+                        cached_tokens = s.cached_tokens + EXCLUDED.cached_tokens,
+                        completion_tokens = s.completion_tokens + EXCLUDED.completion_tokens,
+                        cost = s.cost + EXCLUDED.cost
+                """, rows, page_size=len(rows))
+            cur.execute("SELECT COALESCE(SUM(cost), 0) FROM llm_spend_daily WHERE day = %s", (day,))
+            total = cur.fetchone()[0]
+            conn.commit()
+            return total
+    finally:
+        conn.close()
+
+def get_llm_spend(days=30):
+    """Get LLM spend per day and model for the last N days"""
+    with get_pool().connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT day, model, SUM(calls)::bigint AS calls,
+                       SUM(prompt_tokens)::bigint AS prompt_tokens,
+                       SUM(cached_tokens)::bigint AS cached_tokens,
+                       SUM(completion_tokens)::bigint AS completion_tokens,
+                       SUM(cost) AS cost
+                FROM llm_spend_daily
+                WHERE day > CURRENT_DATE - %s
+                GROUP BY day, model
+                ORDER BY day DESC, model
+            """, (days,))
+            return cur.fetchall()
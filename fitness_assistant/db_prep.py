@@ -2,10 +2,20 @@ import os
 import requests
 from tqdm.auto import tqdm
 import json
-from db import init_db
+import argparse
+from db import init_db, migrate_db
 
 
 
 if __name__ == "__main__":
-    print("[INFO] Initializing PostgreSQL database...")
-    init_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create the database tables")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Upgrade the existing tables in place instead of dropping them")
+    args = parser.parse_args()
+
+    if args.migrate:
+        print("[INFO] Migrating PostgreSQL database...")
+        migrate_db()
+    else:
+        print("[INFO] Initializing PostgreSQL database...")
+        init_db()
\ No newline at end of file
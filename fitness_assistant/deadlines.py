@@ -0,0 +1,126 @@
+"""
+End-to-end request deadlines.
+
+/ask starts a deadline for every request: the client's `timeout` (seconds)
+or REQUEST_TIMEOUT, capped at MAX_REQUEST_TIMEOUT. It is kept on a context
+variable, like the tracing spans, so every stage can read the remaining
+budget without it being passed around:
+
+    with deadlines.start(10):
+        deadlines.remaining()          # seconds left, None outside a deadline
+        if deadlines.below(FAST_MODEL_BELOW):
+            deadlines.degrade("fast_model")
+
+Stages pick cheaper behaviour when the budget runs short and record each
+degradation by name. The names are returned with the answer and stored in
+the conversation row. Outside a deadline (CLI, evaluation scripts) nothing
+is ever degraded.
+"""
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 30))
+MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT", 110))  # below gunicorn's timeout
+
+# Remaining seconds under which a stage degrades
+FEWER_HITS_BELOW = float(os.getenv("DEADLINE_FEWER_HITS_BELOW", 8))
+FAST_MODEL_BELOW = float(os.getenv("DEADLINE_FAST_MODEL_BELOW", 8))
+SKIP_JUDGE_BELOW = float(os.getenv("DEADLINE_SKIP_JUDGE_BELOW", 4))
+NO_RETRY_BELOW = float(os.getenv("DEADLINE_NO_RETRY_BELOW", 2))
+# Floor for the DB statement timeout, so a late answer can still be saved
+DB_MIN_TIMEOUT = float(os.getenv("DEADLINE_DB_MIN_TIMEOUT", 1))
+
+FEWER_HITS = 3
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a stage that cannot be degraded starts after the deadline"""
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.degradations = []
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def degrade(self, name):
+        if name not in self.degradations:
+            self.degradations.append(name)
+
+
+def parse_timeout(value):
+    """
+    The request's deadline in seconds: the client's value if any, capped at MAX_REQUEST_TIMEOUT.
+
+    Raises:
+        ValueError: If the value is not a positive number.
+    """
+    if value is None:
+        return min(REQUEST_TIMEOUT, MAX_REQUEST_TIMEOUT)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError("timeout must be a positive number of seconds")
+    return min(float(value), MAX_REQUEST_TIMEOUT)
+
+
+@contextmanager
+def start(seconds):
+    """Run the block under a deadline of `seconds` from now"""
+    deadline = Deadline(seconds)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def remaining():
+    """Seconds left before the deadline (may be negative), or None without one"""
+    deadline = _current.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def below(seconds):
+    """True if there is a deadline and less than `seconds` of it is left"""
+    left = remaining()
+    return left is not None and left < seconds
+
+
+def timeout(default=None):
+    """A timeout for a blocking call: the remaining budget, or default without a deadline"""
+    left = remaining()
+    if left is None:
+        return default
+    return max(left, 0.0) if default is None else max(min(left, default), 0.0)
+
+
+def degrade(name):
+    """Record that a stage chose cheaper behaviour because of the deadline"""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.degrade(name)
+
+
+def degradations():
+    deadline = _current.get()
+    return list(deadline.degradations) if deadline is not None else []
+
+
+def check(stage):
+    """
+    Raises:
+        DeadlineExceeded: If the deadline has passed before `stage` starts.
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
@@ -10,9 +10,6 @@ df = pd.read_csv('../data/data.csv')
 df.head()
 
 
-import minsearch
-
-
 # In[4]:
 
 
@@ -22,17 +19,10 @@ documents = df.to_dict(orient='records')
 # In[5]:
 
 
-index = minsearch.Index(
-    text_fields=['exercise_name', 'type_of_activity', 'type_of_equipment', 'body_part',
-       'type', 'muscle_groups_activated', 'instructions'],
-    keyword_fields=["ID"]
-)
-
-
-# In[6]:
-
+import injest
 
-index.fit(documents)
+# Fitted the same way as the app's index, with a version unique to this load
+index = injest.load_index('../data/data.csv', shared_index_path=None)
 
 
 # In[7]:
@@ -416,14 +406,23 @@ evaluate_search(gt_val, lambda q: minsearch_search(query=q["question"]))
 # In[47]:
 
 
+from retrieval_cache import RetrievalCache
+
+# Same cache implementation as the API: repeated evaluations of a boost setting are served from memory
+search_cache = RetrievalCache(name="evaluation_retrieval_cache")
+
+
 def minsearch_search_boosted(query, boost):
     """Perform a search using the minsearch index with boosting"""
-    results = index.search(
-        query=query,
-        boost_dict=boost,
-        num_results=10
+    # Keyed on the version of the index in use, so rebuilding the index invalidates the cache
+    return search_cache.search(
+        index.version, query, boost,
+        lambda: index.search(
+            query=query,
+            boost_dict=boost,
+            num_results=10
+        )
     )
-    return results
 
 
 # In[48]:
@@ -0,0 +1,212 @@
+"""
+Faceted pre-filtering on the categorical exercise fields.
+
+Every facet value (split on "/", so "Cardio/Strength" counts as both
+cardio and strength) gets a bitmap of the documents that have it, stored
+as a Python int with bit i set for document i. extract_facets() turns
+phrases in a question ("no equipment", "lower body") into facet
+constraints, unless the question names a specific exercise.
+FacetIndex.candidates() ANDs the bitmaps across facets and
+ORs them within a facet, so the text scorer only scores the documents
+that can match.
+"""
+import re
+
+import numpy as np
+
+FACET_FIELDS = ["type_of_activity", "type_of_equipment", "body_part", "type"]
+
+# Phrases that imply a facet value, matched longest first
+FACET_PHRASES = {
+    "type_of_equipment": {
+        "no equipment": "bodyweight",
+        "without equipment": "bodyweight",
+        "without any equipment": "bodyweight",
+        "body weight": "bodyweight",
+        "bodyweight": "bodyweight",
+        "dumbbells": "dumbbell",
+        "dumbbell": "dumbbell",
+        "kettlebells": "kettlebell",
+        "kettlebell": "kettlebell",
+        "barbell": "barbell",
+        "cable machine": "cable machine",
+        "cables": "cable machine",
+        "cable": "cable machine",
+        "smith machine": "smith machine",
+        "resistance bands": "resistance band",
+        "resistance band": "resistance band",
+        "medicine ball": "medicine ball",
+        "stability ball": "stability ball",
+        "trx": "trx",
+        "jump rope": "jump rope",
+        "battle ropes": "ropes",
+        "ab wheel": "ab wheel",
+    },
+    "body_part": {
+        "lower body": "lower body",
+        "lower-body": "lower body",
+        "leg day": "lower body",
+        "leg workout": "lower body",
+        "leg exercises": "lower body",
+        "for my legs": "lower body",
+        "for the legs": "lower body",
+        "for legs": "lower body",
+        "upper body": "upper body",
+        "upper-body": "upper body",
+        "arm workout": "upper body",
+        "arm exercises": "upper body",
+        "for my arms": "upper body",
+        "chest exercises": "upper body",
+        "chest workout": "upper body",
+        "core workout": "core",
+        "core exercises": "core",
+        "ab workout": "core",
+        "ab exercises": "core",
+        "for my abs": "core",
+        "for my core": "core",
+        "full body": "full body",
+        "full-body": "full body",
+        "whole body": "full body",
+        "total body": "full body",
+    },
+    "type_of_activity": {
+        "cardio": "cardio",
+        "mobility exercises": "mobility",
+        "mobility work": "mobility",
+        "mobility routine": "mobility",
+        "warm-up exercises": "warm-up",
+        "warm up exercises": "warm-up",
+        "warm-up routine": "warm-up",
+    },
+}
+
+# A facet phrase preceded by one of these ("without a barbell", "no dumbbells") is not a constraint
+NEGATIONS = {"no", "not", "without", "lack", "lacking", "don't", "dont", "instead", "replace",
+             "alternative", "alternatives", "except", "avoid"}
+NEGATION_WINDOW = 4
+
+_PHRASE_PATTERNS = {
+    field: re.compile(r"\b(" + "|".join(re.escape(p) for p in sorted(phrases, key=len, reverse=True)) + r")\b")
+    for field, phrases in FACET_PHRASES.items()
+}
+
+# Phrases that are themselves negative but mean a positive constraint
+POSITIVE_NEGATIONS = {"no equipment", "without equipment", "without any equipment"}
+
+
+def normalise_value(value):
+    """Lowercase a facet value and drop a plural 's' so 'Dumbbells' and 'Dumbbell' match"""
+    value = value.strip().lower()
+    if value.endswith("s") and not value.endswith("ss") and value not in ("abs", "ropes"):
+        value = value[:-1]
+    return value
+
+
+def normalise_name(text):
+    """Lowercase, turn punctuation into spaces and drop plural 's' per word"""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    return " ".join(w[:-1] if w.endswith("s") and len(w) > 3 else w for w in words)
+
+
+def split_values(raw):
+    """Split a stored facet value such as 'Cardio/Strength' into normalised atomic values"""
+    return {normalise_value(v) for v in str(raw).split("/") if v.strip()}
+
+
+def extract_facets(question):
+    """
+    Extract facet constraints implied by a question.
+
+    Negated mentions ("without a barbell") are ignored rather than
+    excluded: the user usually wants alternatives to an exercise that
+    uses the equipment, and that exercise is still useful context.
+
+    Returns:
+        dict: facet field -> set of normalised values, e.g. {"body_part": {"lower body"}}.
+    """
+    text = question.lower()
+    facets = {}
+    for field, pattern in _PHRASE_PATTERNS.items():
+        for match in pattern.finditer(text):
+            phrase = match.group(1)
+            if phrase not in POSITIVE_NEGATIONS:
+                preceding = re.findall(r"[\w']+", text[:match.start()])[-NEGATION_WINDOW:]
+                if NEGATIONS.intersection(preceding):
+                    continue
+            facets.setdefault(field, set()).add(normalise_value(FACET_PHRASES[field][phrase]))
+    return facets
+
+
+def parse_filters(filters):
+    """
+    Validate explicit API filters like {"body_part": "Lower Body", "type": ["Push", "Pull"]}.
+
+    Raises:
+        ValueError: If a field is not a facet or a value is not a string.
+    """
+    parsed = {}
+    for field, values in (filters or {}).items():
+        if field not in FACET_FIELDS:
+            raise ValueError(f"Unknown filter field: {field}")
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise ValueError(f"Filter values for {field} must be strings")
+        parsed[field] = set().union(*(split_values(v) for v in values))
+    return parsed
+
+
+class FacetIndex:
+    """
+    Bitmap index over the facet fields of a document list.
+
+    Args:
+        docs (list of dict): The indexed documents, in index order.
+    """
+
+    def __init__(self, docs):
+        self.n_docs = len(docs)
+        self.exercise_names = sorted({normalise_name(doc.get("exercise_name", "")) for doc in docs} - {""},
+                                     key=len, reverse=True)
+        self.bitmaps = {field: {} for field in FACET_FIELDS}
+        for i, doc in enumerate(docs):
+            bit = 1 << i
+            for field in FACET_FIELDS:
+                for value in split_values(doc.get(field, "")):
+                    self.bitmaps[field][value] = self.bitmaps[field].get(value, 0) | bit
+
+    def mentions_exercise(self, question):
+        """True if the question names an exercise from the catalogue"""
+        text = f" {normalise_name(question)} "
+        return any(f" {name} " in text for name in self.exercise_names)
+
+    def extract(self, question):
+        """
+        Facet constraints for a question, or {} when it asks about a named exercise.
+
+        A question about a specific exercise ("box squats with dumbbells instead
+        of a barbell?") is answered by that exercise, whatever its facets.
+        """
+        if self.mentions_exercise(question):
+            return {}
+        return extract_facets(question)
+
+    def bitmap(self, facets):
+        """AND across fields, OR within a field; None means no constraint"""
+        result = None
+        for field, values in facets.items():
+            field_bitmap = 0
+            for value in values:
+                field_bitmap |= self.bitmaps.get(field, {}).get(value, 0)
+            result = field_bitmap if result is None else result & field_bitmap
+        return result
+
+    def candidates(self, facets):
+        """Return the sorted document positions matching the facets, or None if unconstrained"""
+        bitmap = self.bitmap(facets)
+        if bitmap is None:
+            return None
+        n_bytes = (self.n_docs + 7) // 8
+        bits = np.unpackbits(np.frombuffer(bitmap.to_bytes(n_bytes, "little"), dtype=np.uint8),
+                             bitorder="little")
+        return np.flatnonzero(bits[:self.n_docs])
@@ -0,0 +1,234 @@
+"""
+Deterministic stand-in for Gemini.
+
+Use it in-process with LLM_BACKEND=fake, or start it as an HTTP server
+and point the app at it with LLM_BACKEND=http:
+
+    python fake_llm.py --port 8001
+
+Latency, streaming, token counts, error rates and rate limiting are
+configured through the FAKE_LLM_* environment variables or the
+FakeBackend constructor.
+"""
+import os
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm import LLMBackend, LLMError, LLMRateLimitError, LLMTimeoutError
+
+CHARS_PER_TOKEN = 4
+
+RELEVANCE_LABELS = ["RELEVANT", "PARTIALLY_RELEVANT", "NON_RELEVANT"]
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def count_tokens(text):
+    """Approximate token count (Gemini averages about 4 characters per token)"""
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+class FakeBackend(LLMBackend):
+    """
+    In-process fake LLM.
+
+    Answers depend only on the prompt, and errors are drawn from a seeded
+    random generator, so two runs with the same seed and call order see
+    the same failures.
+
+    Args:
+        latency (float): Base latency of a call, in seconds.
+        jitter (float): Extra uniform random latency, in seconds.
+        chunk_delay (float): Delay between streamed chunks, in seconds.
+        chunk_tokens (int): Tokens per streamed chunk.
+        completion_tokens (int): Length of a generated answer, in tokens.
+        error_rate (float): Probability that a call fails with LLMError.
+        rate_limit_rate (float): Probability that a call fails with LLMRateLimitError.
+        rpm (int): Requests per minute accepted before answering with 429s (0 disables it).
+        retry_after (float): Retry-After reported with rate-limit errors, in seconds.
+        seed (int): Seed of the random generator.
+    """
+
+    name = "fake"
+
+    def __init__(self,
+                 latency=None,
+                 jitter=None,
+                 chunk_delay=None,
+                 chunk_tokens=None,
+                 completion_tokens=None,
+                 error_rate=None,
+                 rate_limit_rate=None,
+                 rpm=None,
+                 retry_after=None,
+                 seed=None):
+        self.latency = latency if latency is not None else _env_float("FAKE_LLM_LATENCY", 0.5)
+        self.jitter = jitter if jitter is not None else _env_float("FAKE_LLM_JITTER", 0.0)
+        self.chunk_delay = chunk_delay if chunk_delay is not None else _env_float("FAKE_LLM_CHUNK_DELAY", 0.02)
+        self.chunk_tokens = chunk_tokens or int(os.getenv("FAKE_LLM_CHUNK_TOKENS", 8))
+        self.completion_tokens = completion_tokens or int(os.getenv("FAKE_LLM_COMPLETION_TOKENS", 120))
+        self.error_rate = error_rate if error_rate is not None else _env_float("FAKE_LLM_ERROR_RATE", 0.0)
+        self.rate_limit_rate = rate_limit_rate if rate_limit_rate is not None else _env_float("FAKE_LLM_RATE_LIMIT_RATE", 0.0)
+        self.rpm = rpm if rpm is not None else int(os.getenv("FAKE_LLM_RPM", 0))
+        self.retry_after = retry_after if retry_after is not None else _env_float("FAKE_LLM_RETRY_AFTER", 1.0)
+        self.seed = seed if seed is not None else int(os.getenv("FAKE_LLM_SEED", 42))
+
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+        self._recent_calls = deque()
+        self.calls = 0
+
+    def _admit(self):
+        """Decide the fate of a call: raise an error or return its latency"""
+        with self._lock:
+            self.calls += 1
+            now = time.monotonic()
+            if self.rpm:
+                while self._recent_calls and now - self._recent_calls[0] > 60:
+                    self._recent_calls.popleft()
+                if len(self._recent_calls) >= self.rpm:
+                    retry_after = 60 - (now - self._recent_calls[0])
+                    raise LLMRateLimitError("Fake quota exceeded", retry_after=retry_after)
+                self._recent_calls.append(now)
+            roll = self._rng.random()
+            latency = self.latency + self._rng.uniform(0, self.jitter)
+        if roll < self.rate_limit_rate:
+            raise LLMRateLimitError("Fake rate limit", retry_after=self.retry_after)
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise LLMError("Fake backend error")
+        return latency
+
+    def _answer(self, prompt):
+        """Build a deterministic answer that matches the kind of prompt"""
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        if '"Relevance"' in prompt:
+            label = RELEVANCE_LABELS[digest[0] % len(RELEVANCE_LABELS)]
+            return json.dumps({"Relevance": label,
+                               "Explanation": "Deterministic evaluation from the fake backend."})
+        if '"questions"' in prompt:
+            return json.dumps({"questions": [f"Fake question {i + 1} ({digest.hex()[:8]})?" for i in range(5)]})
+
+        words = prompt.split() or ["exercise"]
+        n_words = self.completion_tokens * CHARS_PER_TOKEN // 6
+        start = digest[1] % len(words)
+        return " ".join(words[(start + i) % len(words)] for i in range(n_words))
+
+    def _tokens_stats(self, prompt, text):
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(text)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def generate(self, prompt, model, timeout=None):
+        latency = self._admit()
+        text = self._answer(prompt)
+        if timeout is not None and latency > timeout:
+            time.sleep(max(timeout, 0))
+            raise LLMTimeoutError(f"Fake backend did not answer within {timeout:.1f}s")
+        time.sleep(latency)
+        return text, self._tokens_stats(prompt, text)
+
+    def stream(self, prompt, model):
+        latency = self._admit()
+        text = self._answer(prompt)
+        time.sleep(latency)
+        chunk_chars = self.chunk_tokens * CHARS_PER_TOKEN
+        for start in range(0, len(text), chunk_chars):
+            if start:
+                time.sleep(self.chunk_delay)
+            yield text[start:start + chunk_chars], None
+        yield "", self._tokens_stats(prompt, text)
+
+
+def make_handler(backend):
+    """Create a request handler class serving the given backend"""
+
+    class FakeLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_error(self, e):
+            if isinstance(e, LLMRateLimitError):
+                self._send_json(429, {"error": str(e)}, {"Retry-After": f"{e.retry_after or 1:.0f}"})
+            else:
+                self._send_json(500, {"error": str(e)})
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            prompt = body.get("prompt", "")
+            model = body.get("model", "fake")
+
+            if self.path == "/generate":
+                try:
+                    text, usage = backend.generate(prompt, model)
+                except LLMError as e:
+                    self._send_error(e)
+                    return
+                self._send_json(200, {"text": text, "usage": usage})
+            elif self.path == "/stream":
+                chunks = backend.stream(prompt, model)
+                try:
+                    first = next(chunks)
+                except LLMError as e:
+                    self._send_error(e)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for text, usage in [first, *chunks]:
+                    self._write_chunk((json.dumps({"text": text, "usage": usage}) + "\n").encode("utf-8"))
+                self._write_chunk(b"")
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeLLMHandler
+
+
+def serve(host="127.0.0.1", port=8001, backend=None):
+    """Run the fake LLM as an HTTP server until interrupted"""
+    server = ThreadingHTTPServer((host, port), make_handler(backend or FakeBackend()))
+    print(f"[INFO] Fake LLM listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deterministic fake Gemini server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+    serve(args.host, args.port)
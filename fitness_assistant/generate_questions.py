@@ -0,0 +1,219 @@
+"""
+Generate the retrieval ground truth: questions a user might ask about each exercise.
+
+Documents are processed concurrently by a pool of workers. The calls go
+through rag.llm_gemini at batch priority, so they share the model's quota
+with the API without starving it. Every response must be JSON with
+QUESTIONS_PER_DOC distinct questions; malformed responses are retried.
+Results are appended to the output file as soon as a document is done,
+and documents already in the file are skipped, so an interrupted run
+resumes where it stopped.
+
+    python generate_questions.py --output ../data/ground-trunth-retrieval.csv --workers 8
+    python generate_questions.py --output questions.jsonl    # {"id": .., "questions": [..]} per line
+"""
+import os
+import re
+import csv
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import llm
+import injest
+import rate_limit
+from rag import llm_gemini
+
+logger = logging.getLogger(__name__)
+
+QUESTIONS_PER_DOC = 5
+MIN_QUESTION_WORDS = 4
+
+prompt_template = """
+You emulate a user of our fitness assistant application.
+Formulate 5 questions a user might ask based on the provided exercise.
+Make the questions specific to the exercise.
+The record should contain the answers to the questions, and the questions should be complete and not too short.
+Use as few words as possible from the record.
+
+The record:
+
+exercise_name: {exercise_name}
+type_of_activity: {type_of_activity}
+type_of_equipment: {type_of_equipment}
+body_part: {body_part} type: {type}
+muscle_groups_activated: {muscle_groups_activated}
+instructions: {instructions}
+
+Provide the output as a pure JSON string, without wrapping it in Markdown code fences, code blocks, or any other formatting.
+Example output:
+
+{{"questions": ["question1", "question2", "question3", "question4", "question5"]}}
+Don't provide answers, just questions.
+""".strip()
+
+retry_suffix = """
+
+Your previous reply could not be used: {error}. Reply with the JSON object only."""
+
+
+class InvalidQuestions(ValueError):
+    """Raised when an LLM response is not a usable list of questions"""
+
+
+def parse_questions(response):
+    """
+    Validate an LLM response and return its questions.
+
+    Raises:
+        InvalidQuestions: If the response is not JSON with enough distinct, complete questions.
+    """
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", response.strip())
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise InvalidQuestions(f"not valid JSON ({e.msg})")
+    questions = data.get("questions") if isinstance(data, dict) else None
+    if not isinstance(questions, list):
+        raise InvalidQuestions('no "questions" list')
+
+    seen = set()
+    valid = []
+    for question in questions:
+        if not isinstance(question, str) or len(question.split()) < MIN_QUESTION_WORDS:
+            continue
+        question = " ".join(question.split())
+        if question.lower() not in seen:
+            seen.add(question.lower())
+            valid.append(question)
+    if len(valid) < QUESTIONS_PER_DOC:
+        raise InvalidQuestions(f"{len(valid)} usable questions instead of {QUESTIONS_PER_DOC}")
+    return valid[:QUESTIONS_PER_DOC]
+
+
+def generate_questions(doc, model, max_retries=3):
+    """
+    Generate questions for one document, retrying malformed responses and LLM errors.
+
+    Returns:
+        tuple: (questions, stats) where stats has attempts, prompt_tokens, completion_tokens and cost.
+    """
+    prompt = prompt_template.format(**doc)
+    stats = {"attempts": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+    error = None
+    rejection = None  # why the last response was unusable, told to the model on the retry
+    for attempt in range(max_retries + 1):
+        full_prompt = prompt if rejection is None else prompt + retry_suffix.format(error=rejection)
+        stats["attempts"] += 1
+        try:
+            response, tokens_stats = llm_gemini(full_prompt, model=model,
+                                                priority=rate_limit.PRIORITY_BATCH)
+        except llm.LLMError as e:
+            error = f"LLM error ({e})"
+            logger.warning(f"Document {doc['ID']}: attempt {attempt + 1} failed, {error}")
+            continue
+        stats["prompt_tokens"] += tokens_stats["prompt_tokens"]
+        stats["completion_tokens"] += tokens_stats["completion_tokens"]
+        stats["cost"] += tokens_stats.get("cost", 0.0)
+        try:
+            return parse_questions(response), stats
+        except InvalidQuestions as e:
+            error = rejection = str(e)
+            logger.warning(f"Document {doc['ID']}: attempt {attempt + 1} rejected, {error}")
+    raise InvalidQuestions(f"document {doc['ID']}: {error} after {stats['attempts']} attempts")
+
+
+def load_documents(data_path):
+    with open(data_path, newline="") as f:
+        return [dict(row, ID=int(row["ID"])) for row in csv.DictReader(f)]
+
+
+def done_ids(output_path):
+    """IDs of the documents that already have questions in the output file"""
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, newline="") as f:
+        if output_path.endswith(".jsonl"):
+            return {json.loads(line)["id"] for line in f if line.strip()}
+        return {int(row["id"]) for row in csv.DictReader(f)}
+
+
+class ResultWriter:
+    """Append results to a CSV (id, question rows) or JSONL file, flushing after every document"""
+
+    def __init__(self, output_path):
+        self.jsonl = output_path.endswith(".jsonl")
+        is_new = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        self.file = open(output_path, "a", newline="")
+        if not self.jsonl:
+            self.writer = csv.writer(self.file)
+            if is_new:
+                self.writer.writerow(["id", "question"])
+
+    def write(self, doc_id, questions):
+        if self.jsonl:
+            self.file.write(json.dumps({"id": doc_id, "questions": questions}) + "\n")
+        else:
+            self.writer.writerows((doc_id, question) for question in questions)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def run(data_path, output_path, model, workers, max_retries, limit=None):
+    documents = load_documents(data_path)
+    skip = done_ids(output_path)
+    todo = [doc for doc in documents if doc["ID"] not in skip][:limit]
+    print(f"[INFO] {len(documents)} documents, {len(skip)} already done, {len(todo)} to generate")
+
+    totals = {"docs": 0, "failed": 0, "attempts": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+    writer = ResultWriter(output_path)
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(generate_questions, doc, model, max_retries): doc for doc in todo}
+            for future in as_completed(futures):
+                doc = futures[future]
+                try:
+                    questions, stats = future.result()
+                except Exception as e:
+                    totals["failed"] += 1
+                    logger.error(f"Document {doc['ID']} failed: {e}")
+                    continue
+                # Only this thread writes, so rows of different documents never interleave
+                writer.write(doc["ID"], questions)
+                totals["docs"] += 1
+                for key in ("attempts", "prompt_tokens", "completion_tokens", "cost"):
+                    totals[key] += stats[key]
+                if totals["docs"] % 25 == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"[INFO] {totals['docs']}/{len(todo)} documents, "
+                          f"{totals['docs'] / elapsed * 60:.1f} docs/min")
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"[INFO] Generated questions for {totals['docs']} documents in {elapsed:.1f}s "
+          f"({totals['docs'] / elapsed * 60 if elapsed else 0:.1f} docs/min), {totals['failed']} failed")
+    print(f"[INFO] {totals['attempts']} LLM calls, {totals['prompt_tokens']} prompt tokens, "
+          f"{totals['completion_tokens']} completion tokens, ${totals['cost']:.4f}")
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate retrieval ground-truth questions for every exercise")
+    parser.add_argument("--data", default=injest.DATA_PATH, help="Exercise catalogue CSV")
+    parser.add_argument("--output", default="../data/ground-trunth-retrieval.csv",
+                        help="Output .csv (id, question) or .jsonl file; existing documents are skipped")
+    parser.add_argument("--model", default="gemini-1.5-flash")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent LLM calls")
+    parser.add_argument("--max-retries", type=int, default=3, help="Retries for a malformed response")
+    parser.add_argument("--limit", type=int, default=None, help="Generate at most this many documents")
+    args = parser.parse_args()
+
+    # rag configures INFO logging on import; per-call logs would drown the progress lines
+    logging.getLogger().setLevel(logging.WARNING)
+    run(args.data, args.output, args.model, args.workers, args.max_retries, args.limit)
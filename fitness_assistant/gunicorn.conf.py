@@ -0,0 +1,69 @@
+"""
+Gunicorn settings for serving the API.
+
+A request spends almost all of its time waiting on the LLM (answer, then
+relevance judge), so each worker runs a pool of threads. The app is loaded
+once in the master (`preload_app`): the index, facet bitmaps and reranker
+weights are built in `when_ready`, before forking, and the workers share
+those pages copy-on-write. Each worker creates its LLM client in
+`post_worker_init`, before it accepts requests, so GET /ready turns 200
+without a cold first request. Workers are recycled after a number of
+requests, and the timeouts are long enough for a slow or retried LLM call.
+
+Every setting can be overridden with a GUNICORN_* environment variable:
+
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import gc
+import os
+import multiprocessing
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', 5000)}")
+
+# Retrieval is the only CPU work, so one process per core is enough (at least
+# two, so a recycled worker never leaves the server with none); the threads
+# cover the time spent waiting on the LLM and Postgres
+workers = int(os.getenv("GUNICORN_WORKERS", max(2, multiprocessing.cpu_count())))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Recycle workers to bound slow memory growth; the jitter stops them all restarting at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+# One /ask makes two LLM calls, each of which may wait for quota and be retried
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Heartbeat files on tmpfs, so a slow container disk cannot make workers look hung
+worker_tmp_dir = os.getenv("GUNICORN_WORKER_TMP_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def when_ready(server):
+    if preload_app:
+        # Build the index in the master so every worker shares it
+        import rag
+        rag.warmup()
+        # Move everything loaded so far out of the garbage collector's reach, so
+        # collections in the workers do not touch (and copy) the shared pages
+        gc.collect()
+        gc.freeze()
+        server.log.info(f"Preloaded app, {gc.get_freeze_count()} objects frozen before forking")
+
+
+def post_worker_init(worker):
+    # LLM clients hold connections and threads that must not cross a fork, so
+    # each worker creates its own; the index is only built here without preload
+    import rag
+    rag.warmup()
+    rag.llm.get_backend().warmup()
+    # Start shipping at once, including what a previous worker left in the spool
+    import spool
+    if spool.enabled():
+        spool.get_spool()
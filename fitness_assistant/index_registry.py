@@ -0,0 +1,346 @@
+"""
+Search indexes for several tenants, each with its own exercise catalogue.
+
+A tenant's catalogue is a CSV file. The catalogues are listed in
+TENANT_CATALOGUES, either as a JSON object or as the path to a JSON file
+({"gym-a": "../data/gym-a.csv", ...}). If CATALOGUE_DIR is set, any
+<CATALOGUE_DIR>/<tenant>.csv is found too. The "default" tenant always
+uses DATA_PATH.
+
+Catalogues are loaded on first use. A load builds the index, the facet
+bitmaps and the query analyser. Loaded catalogues are kept in LRU order
+while their estimated size stays under INDEX_REGISTRY_MAX_MB; beyond that
+the least recently used ones are dropped (never the default tenant), and
+they are loaded again when next asked for. Requests already using a
+dropped catalogue keep it until they finish.
+
+Catalogues share what is equal between them. Vocabulary terms are
+interned strings, so a term used by ten gyms is stored once. Identical
+documents (the same exercise row in several CSV files) are one dict.
+
+A request selects its catalogue with use(); code that reads the index
+calls current(), which gives the default catalogue outside a request:
+
+    with index_registry.use("gym-a"):
+        index_registry.current().index
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import injest
+import facets
+import metrics
+import query_analysis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+INDEX_REGISTRY_MAX_BYTES = int(float(os.getenv("INDEX_REGISTRY_MAX_MB", 512)) * 2**20)
+TENANT_CATALOGUES = os.getenv("TENANT_CATALOGUES")
+CATALOGUE_DIR = os.getenv("CATALOGUE_DIR")
+
+TENANT_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_current = contextvars.ContextVar("catalogue", default=None)
+
+
+class UnknownTenant(KeyError):
+    """Raised for a tenant with no catalogue"""
+
+
+def configured_catalogues(setting=TENANT_CATALOGUES):
+    """tenant -> CSV path from TENANT_CATALOGUES (inline JSON or a JSON file)"""
+    if not setting:
+        return {}
+    if setting.lstrip().startswith("{"):
+        return json.loads(setting)
+    with open(setting) as f:
+        return json.load(f)
+
+
+def catalogue_path(tenant):
+    """
+    The CSV file of a tenant's catalogue.
+
+    Raises:
+        UnknownTenant: If the tenant name is invalid or has no catalogue.
+    """
+    if tenant == DEFAULT_TENANT:
+        return injest.DATA_PATH
+    if not isinstance(tenant, str) or not TENANT_PATTERN.match(tenant):
+        raise UnknownTenant(f"Invalid tenant {tenant!r}")
+    path = _catalogues.get(tenant)
+    if path is None and CATALOGUE_DIR:
+        candidate = os.path.join(CATALOGUE_DIR, f"{tenant}.csv")
+        if os.path.exists(candidate):
+            path = candidate
+    if path is None:
+        raise UnknownTenant(f"No catalogue for tenant {tenant!r}")
+    return path
+
+
+def shared_index_path(tenant):
+    """Each tenant gets its own shared index file (see shared_index.py)"""
+    if not injest.SHARED_INDEX_PATH or tenant == DEFAULT_TENANT:
+        return injest.SHARED_INDEX_PATH
+    return f"{injest.SHARED_INDEX_PATH}.{tenant}"
+
+
+class DocumentPool:
+    """
+    One dict per distinct document across all loaded catalogues.
+
+    Documents are counted by the catalogues holding them, and forgotten
+    once none does.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}  # content key -> [doc, catalogues holding it, estimated bytes]
+        self.nbytes = 0
+
+    @staticmethod
+    def key(doc):
+        # default=str also makes pandas' NaN cells compare equal
+        return json.dumps(doc, sort_keys=True, default=str)
+
+    def share(self, docs):
+        """The documents, with each replaced by the pooled dict of the same content"""
+        keys = [self.key(doc) for doc in docs]
+        shared = []
+        with self._lock:
+            for key, doc in zip(keys, docs):
+                entry = self._docs.get(key)
+                if entry is None:
+                    entry = self._docs[key] = [doc, 0, document_bytes(doc)]
+                    self.nbytes += entry[2]
+                entry[1] += 1
+                shared.append(entry[0])
+        return shared, keys
+
+    def release(self, keys):
+        with self._lock:
+            for key in keys:
+                entry = self._docs[key]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._docs[key]
+                    self.nbytes -= entry[2]
+
+    def __len__(self):
+        return len(self._docs)
+
+
+def document_bytes(doc):
+    return sys.getsizeof(doc) + sum(sys.getsizeof(value) for value in doc.values())
+
+
+def intern_vocabulary(index):
+    """Make every fitted vectorizer's terms interned strings, shared with the other catalogues"""
+    for vectorizer in index.vectorizers.values():
+        if hasattr(vectorizer, "vocabulary_"):
+            vectorizer.vocabulary_ = {sys.intern(term): column
+                                      for term, column in vectorizer.vocabulary_.items()}
+
+
+def estimate_bytes(catalogue):
+    """
+    Private memory of a catalogue, apart from its documents and vocabulary strings.
+
+    Counts the TF-IDF matrices, the vocabulary and query analysis tables
+    and the facet bitmaps. For a shared index the matrices live in the
+    page cache, shared by the workers, but they are counted all the same.
+    """
+    index = catalogue.index
+    total = 0
+    for matrix in index.text_matrices.values():
+        total += matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    for vectorizer in index.vectorizers.values():
+        vocabulary = getattr(vectorizer, "vocabulary_", None)
+        total += sys.getsizeof(vocabulary) if vocabulary is not None else vectorizer.vocab.nbytes
+    total += catalogue.query_analyser.nbytes()
+    total += sum(sys.getsizeof(bitmap) for values in catalogue.facet_index.bitmaps.values()
+                 for bitmap in values.values())
+    return total
+
+
+class Catalogue:
+    """
+    Everything retrieval needs for one tenant: index, facet bitmaps and query analyser.
+
+    Args:
+        tenant (str): Tenant the catalogue belongs to.
+        data_path (str): CSV file it was loaded from.
+        index: A fitted minsearch.Index or shared_index.SharedIndex.
+        documents (DocumentPool): Pool the index's documents are shared through.
+    """
+
+    def __init__(self, tenant, data_path, index, documents=None):
+        self.tenant = tenant
+        self.data_path = data_path
+        intern_vocabulary(index)
+        self.doc_keys = []
+        if documents is not None:
+            index.docs, self.doc_keys = documents.share(index.docs)
+        self.index = index
+        self.facet_index = facets.FacetIndex(index.docs)
+        self.query_analyser = query_analysis.QueryAnalyser(index)
+        self.position_by_id = {doc["ID"]: i for i, doc in enumerate(index.docs)}
+        self.nbytes = estimate_bytes(self)
+        self.doc_bytes = sum(document_bytes(doc) for doc in index.docs)
+
+    @property
+    def version(self):
+        return self.index.version
+
+
+class IndexRegistry:
+    """
+    Lazily loaded catalogues, least recently used dropped first past a memory budget.
+
+    Args:
+        max_bytes (int): Budget for the estimated size of the loaded catalogues.
+        pinned (tuple): Tenants that are never dropped.
+    """
+
+    def __init__(self, max_bytes=INDEX_REGISTRY_MAX_BYTES, pinned=(DEFAULT_TENANT,)):
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.documents = DocumentPool()
+        self._lock = threading.Lock()
+        self._catalogues = OrderedDict()  # tenant -> Catalogue, least recently used first
+        self._load_locks = {}
+        self._stats = {}  # tenant -> {"hits", "loads", "evictions", "load_seconds"}, kept after eviction
+
+    def _tenant_stats(self, tenant):
+        return self._stats.setdefault(tenant, {"hits": 0, "loads": 0, "evictions": 0, "load_seconds": 0.0})
+
+    def get(self, tenant=DEFAULT_TENANT, count_hit=True):
+        """
+        The tenant's catalogue, loading it if needed.
+
+        Args:
+            count_hit (bool): Count the lookup in the tenant's hits (once per request).
+        Raises:
+            UnknownTenant: If the tenant has no catalogue.
+        """
+        with self._lock:
+            catalogue = self._catalogues.get(tenant)
+            if catalogue is not None:
+                self._catalogues.move_to_end(tenant)
+                if count_hit:
+                    self._tenant_stats(tenant)["hits"] += 1
+                return catalogue
+        data_path = catalogue_path(tenant)
+        # One load per tenant at a time; other tenants are served meanwhile
+        with self._lock:
+            load_lock = self._load_locks.setdefault(tenant, threading.Lock())
+        with load_lock:
+            with self._lock:
+                catalogue = self._catalogues.get(tenant)
+                if catalogue is not None:
+                    if count_hit:
+                        self._tenant_stats(tenant)["hits"] += 1
+                    return catalogue
+            return self._load(tenant, data_path)
+
+    def reload(self, tenant=DEFAULT_TENANT, data_path=None):
+        """Load the tenant's catalogue again (from data_path if given) and replace the loaded one"""
+        data_path = data_path or catalogue_path(tenant)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(tenant, threading.Lock())
+        with load_lock:
+            return self._load(tenant, data_path)
+
+    def _load(self, tenant, data_path):
+        started = time.perf_counter()
+        index = injest.load_index(data_path, shared_index_path=shared_index_path(tenant))
+        catalogue = Catalogue(tenant, data_path, index, self.documents)
+        seconds = time.perf_counter() - started
+        with self._lock:
+            replaced = self._catalogues.pop(tenant, None)
+            self._catalogues[tenant] = catalogue
+            if replaced is not None:
+                self.documents.release(replaced.doc_keys)
+            stats = self._tenant_stats(tenant)
+            stats["loads"] += 1
+            stats["load_seconds"] += seconds
+            self._evict(keep=tenant)
+        metrics.inc("index_registry.loads")
+        logger.info(f"Catalogue for tenant {tenant} loaded from {data_path} in {seconds:.2f}s "
+                    f"({len(index.docs)} documents, ~{catalogue.nbytes / 2**20:.1f} MiB)")
+        return catalogue
+
+    def _evict(self, keep):
+        """Drop least recently used catalogues until the budget is met; call with the lock held"""
+        while self._total_bytes() > self.max_bytes:
+            victim = next((tenant for tenant in self._catalogues
+                           if tenant != keep and tenant not in self.pinned), None)
+            if victim is None:
+                break
+            # Its documents that no other catalogue holds leave the pool now, before the next check
+            self.documents.release(self._catalogues.pop(victim).doc_keys)
+            self._tenant_stats(victim)["evictions"] += 1
+            metrics.inc("index_registry.evictions")
+            logger.info(f"Catalogue for tenant {victim} evicted")
+
+    def _total_bytes(self):
+        return sum(catalogue.nbytes for catalogue in self._catalogues.values()) + self.documents.nbytes
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total_bytes()
+
+    def stats(self):
+        """tenant -> loaded, estimated bytes, documents, hits, loads and evictions"""
+        with self._lock:
+            result = {}
+            for tenant, counts in self._stats.items():
+                catalogue = self._catalogues.get(tenant)
+                result[tenant] = dict(counts,
+                                      loaded=catalogue is not None,
+                                      bytes=catalogue.nbytes + catalogue.doc_bytes if catalogue else 0,
+                                      documents=len(catalogue.index.docs) if catalogue else 0)
+            return result
+
+
+_catalogues = configured_catalogues()
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Return the process-wide index registry"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = IndexRegistry()
+                metrics.set_gauge("index_registry.bytes", _registry.total_bytes)
+                metrics.set_gauge("index_registry.shared_documents", lambda: len(_registry.documents))
+                metrics.set_gauge("index_registry.tenants", _registry.stats)
+    return _registry
+
+
+@contextmanager
+def use(tenant):
+    """Serve the block from the tenant's catalogue, loading it if needed"""
+    token = _current.set(get_registry().get(tenant))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current():
+    """The catalogue selected with use(), or the default tenant's"""
+    catalogue = _current.get()
+    return catalogue if catalogue is not None else get_registry().get(DEFAULT_TENANT, count_hit=False)
@@ -1,26 +1,46 @@
-
-import pandas as pd
-import minsearch
-
 import os
+import itertools
 
 DATA_PATH = os.getenv('DATA_PATH', '../data/data.csv')
+# When set, workers share one memory-mapped copy of the index (see shared_index.py)
+SHARED_INDEX_PATH = os.getenv('SHARED_INDEX_PATH')
 
+# Every load gets a new version, so caches keyed on it never serve results from an older index
+_index_versions = itertools.count(1)
 
-def load_index(data_path: str = DATA_PATH) -> minsearch.Index:
+
+def load_index(data_path: str = DATA_PATH, shared_index_path: str = SHARED_INDEX_PATH) -> "minsearch.Index":
     """
     Load the index from a CSV file.
     Args:
         data_path (str): Path to the CSV file containing the data.
+        shared_index_path (str): Shared index file for this CSV; None to build a private index.
     Returns:
-        minsearch.Index: An index object containing the data from the CSV file.
+        minsearch.Index: An index object containing the data from the CSV file,
+        with a `version` attribute that is unique for every load. With
+        shared_index_path set, a shared_index.SharedIndex with the same attributes.
     """
+    if shared_index_path:
+        import shared_index
+        index = shared_index.load(data_path, shared_index_path, build=build_index)
+    else:
+        index = build_index(data_path)
+    index.version = next(_index_versions)
+    return index
+
+
+def build_index(data_path: str) -> "minsearch.Index":
+    """Fit a minsearch index on the CSV file"""
+    # pandas and minsearch (which pulls in scikit-learn) are imported here rather
+    # than at module level, so importing the app stays fast until the index is built
+    import pandas as pd
+    import minsearch
+
     # Load the data from the CSV file
     if not data_path:
         raise ValueError("data_path must be provided")
  
-    df = pd.read_csv('../data/data.csv')
-    df.head()
+    df = pd.read_csv(data_path)
     documents = df.to_dict(orient='records')
 
     index = minsearch.Index(
@@ -0,0 +1,212 @@
+import os
+import json
+import logging
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_BACKEND_URL = os.getenv("LLM_BACKEND_URL", "http://localhost:8001")
+
+
+class LLMError(Exception):
+    """Raised when an LLM backend fails to produce a response"""
+
+
+class LLMTimeoutError(LLMError):
+    """Raised when an LLM call does not finish within its timeout"""
+
+
+class LLMRateLimitError(LLMError):
+    """Raised when an LLM backend rejects a request because of quota (HTTP 429)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMBackend:
+    """
+    Interface every LLM backend implements.
+
+    generate() returns the answer text and a tokens_stats dict with the
+    keys prompt_tokens, completion_tokens and total_tokens, and optionally
+    cached_tokens (the part of prompt_tokens read from a context cache).
+    With a timeout (seconds) it raises LLMTimeoutError when the call takes longer.
+    stream() yields (text_chunk, tokens_stats) tuples, where tokens_stats
+    is None for every chunk except the last one.
+    """
+
+    name = "base"
+
+    def warmup(self):
+        """Create clients and connections ahead of the first call"""
+
+    def ready(self):
+        return True
+
+    def generate(self, prompt, model, timeout=None):
+        raise NotImplementedError
+
+    def stream(self, prompt, model):
+        text, tokens_stats = self.generate(prompt, model)
+        yield text, tokens_stats
+
+
+class GeminiBackend(LLMBackend):
+    """Backend calling the real Gemini API through google.genai"""
+
+    name = "gemini"
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        """Initialize the Gemini client once and reuse it for every call"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google import genai
+                    try:
+                        self._client = genai.Client(api_key=self.api_key)
+                        logger.info("Gemini client initialized successfully")
+                    except Exception as e:
+                        logger.error(f"Failed to initialize Gemini client: {e}")
+                        raise
+        return self._client
+
+    def warmup(self):
+        self.get_client()
+
+    def ready(self):
+        return self._client is not None
+
+    @staticmethod
+    def _tokens_stats(usage_metadata):
+        return {
+            "prompt_tokens": usage_metadata.prompt_token_count or 0,
+            "completion_tokens": usage_metadata.candidates_token_count or 0,
+            "total_tokens": usage_metadata.total_token_count or 0,
+            # Part of prompt_tokens served from Gemini's context cache, billed at a discount
+            "cached_tokens": getattr(usage_metadata, "cached_content_token_count", None) or 0,
+        }
+
+    @staticmethod
+    def _translate_error(e):
+        if getattr(e, "code", None) == 429:
+            return LLMRateLimitError(str(e))
+        return LLMError(str(e))
+
+    def generate(self, prompt, model, timeout=None):
+        import httpx
+        from google.genai import errors, types
+        client = self.get_client()
+        config = None
+        if timeout is not None:
+            config = types.GenerateContentConfig(http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+        try:
+            response = client.models.generate_content(model=model, contents=prompt, config=config)
+        except errors.APIError as e:
+            raise self._translate_error(e) from e
+        except httpx.TimeoutException as e:
+            raise LLMTimeoutError(f"No response from {model} within {timeout:.1f}s") from e
+        return response.text, self._tokens_stats(response.usage_metadata)
+
+    def stream(self, prompt, model):
+        from google.genai import errors
+        client = self.get_client()
+        usage_metadata = None
+        try:
+            for chunk in client.models.generate_content_stream(model=model, contents=prompt):
+                if chunk.usage_metadata is not None:
+                    usage_metadata = chunk.usage_metadata
+                if chunk.text:
+                    yield chunk.text, None
+        except errors.APIError as e:
+            raise self._translate_error(e) from e
+        if usage_metadata is not None:
+            yield "", self._tokens_stats(usage_metadata)
+
+
+class HttpBackend(LLMBackend):
+    """Backend talking to a fake LLM server started with `python fake_llm.py`"""
+
+    name = "http"
+
+    def __init__(self, base_url=LLM_BACKEND_URL, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _check(self, response):
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            raise LLMRateLimitError(response.text,
+                                    retry_after=float(retry_after) if retry_after else None)
+        if response.status_code != 200:
+            raise LLMError(f"LLM server returned {response.status_code}: {response.text}")
+
+    def generate(self, prompt, model, timeout=None):
+        try:
+            response = self.session.post(f"{self.base_url}/generate",
+                                         json={"prompt": prompt, "model": model},
+                                         timeout=self.timeout if timeout is None else min(self.timeout, timeout))
+        except requests.Timeout as e:
+            raise LLMTimeoutError(f"No response from {model} within {timeout or self.timeout:.1f}s") from e
+        self._check(response)
+        body = response.json()
+        return body["text"], body["usage"]
+
+    def stream(self, prompt, model):
+        with self.session.post(f"{self.base_url}/stream",
+                               json={"prompt": prompt, "model": model},
+                               timeout=self.timeout, stream=True) as response:
+            self._check(response)
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                yield event.get("text", ""), event.get("usage")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name=LLM_BACKEND):
+    """Create a backend by name: gemini, fake or http"""
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "fake":
+        import fake_llm
+        return fake_llm.FakeBackend()
+    if name == "http":
+        return HttpBackend()
+    raise ValueError(f"Unknown LLM backend: {name}")
+
+
+def get_backend():
+    """Return the process-wide backend selected with the LLM_BACKEND variable"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+                logger.info(f"Using LLM backend '{_backend.name}'")
+    return _backend
+
+
+def backend_ready():
+    """True once the backend exists and has its client set up (see LLMBackend.warmup)"""
+    return _backend is not None and _backend.ready()
+
+
+def set_backend(backend):
+    """Replace the process-wide backend (used by benchmarks and soak tests)"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
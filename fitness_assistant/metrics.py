@@ -0,0 +1,30 @@
+"""
+In-process counters and gauges served as JSON by the /metrics endpoint.
+"""
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+
+def inc(name, value=1):
+    """Increase a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """Set a gauge to a value, or to a callable evaluated on every snapshot"""
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot():
+    """Return the current value of every counter and gauge"""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    for name, value in gauges.items():
+        gauges[name] = value() if callable(value) else value
+    return {"counters": counters, "gauges": gauges}
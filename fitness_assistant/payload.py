@@ -0,0 +1,162 @@
+"""
+Smaller, cheaper JSON responses.
+
+- Field projection: /ask takes `fields` (query string or JSON body), a
+  comma-separated list of dotted paths such as
+  `conversation_id,answer_data.answer`, or a named preset from
+  FIELD_PRESETS (`minimal`).
+- Fast serialisation: when orjson is installed, OrjsonProvider replaces
+  Flask's JSON provider, so every jsonify() uses it. Otherwise the stdlib
+  encoder is used with compact separators and without sorting keys.
+- Compression: JSON responses of at least COMPRESS_MIN_BYTES are
+  compressed with brotli (if installed) or gzip, as negotiated through
+  Accept-Encoding.
+"""
+import os
+import gzip
+import json
+
+from flask.json.provider import DefaultJSONProvider, _default
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used instead
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 512))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 5))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 5))
+
+FIELD_PRESETS = {
+    "minimal": ["conversation_id", "session_id", "answer_data.answer"],
+}
+
+
+def _fallback(obj):
+    # NumPy scalars reach the response through the retrieval scores; orjson rejects float subclasses
+    if isinstance(obj, float):
+        return float(obj)
+    if hasattr(obj, "item"):
+        return obj.item()
+    return _default(obj)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that serialises with orjson; keys are not sorted"""
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_fallback).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_fallback),
+                                        mimetype=self.mimetype)
+
+
+def configure_json(app):
+    """Use orjson for jsonify() when available, compact stdlib JSON otherwise"""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+    else:
+        app.json.sort_keys = False
+        app.json.compact = True
+
+
+def dumps(obj):
+    """Serialise obj to JSON bytes the way responses are"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_fallback)
+    return json.dumps(obj, separators=(",", ":"), default=_fallback).encode()
+
+
+def parse_fields(value):
+    """
+    Parse a fields parameter into a list of dotted paths, or None for everything.
+
+    Args:
+        value: A comma-separated string, a list of strings, a preset name or None.
+    Raises:
+        ValueError: If the value is not a string or list of strings.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        if value in FIELD_PRESETS:
+            return FIELD_PRESETS[value]
+        value = value.split(",")
+    if not isinstance(value, list) or not all(isinstance(field, str) for field in value):
+        raise ValueError("fields must be a comma-separated string or a list of strings")
+    return [field.strip() for field in value if field.strip()]
+
+
+def project(data, fields):
+    """
+    Keep only the given dotted paths of a nested dict; paths that are absent are skipped.
+
+    >>> project({"a": 1, "b": {"c": 2, "d": 3}}, ["b.c"])
+    {'b': {'c': 2}}
+    """
+    if fields is None:
+        return data
+    result = {}
+    for field in fields:
+        source, target = data, result
+        *parents, leaf = field.split(".")
+        for key in parents:
+            source = source.get(key) if isinstance(source, dict) else None
+            if source is None:
+                break
+            target = target.setdefault(key, {})
+        else:
+            if isinstance(source, dict) and leaf in source:
+                target[leaf] = source[leaf]
+    return result
+
+
+def accepted_encoding(accept_encoding):
+    """The best supported encoding in an Accept-Encoding header, or None"""
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            offered[name.lower()] = q
+    # Brotli is smaller at similar speed, so it wins ties
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = max(candidates, key=lambda name: offered.get(name, offered.get("*", 0.0)))
+    return best if offered.get(best, offered.get("*", 0.0)) > 0 else None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response, accept_encoding):
+    """Compress a JSON response in place if the client accepts it and it is large enough"""
+    if (response.direct_passthrough or not response.is_json
+            or "Content-Encoding" in response.headers or response.status_code < 200):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = accepted_encoding(accept_encoding or "")
+    if encoding is None:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
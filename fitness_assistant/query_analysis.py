@@ -0,0 +1,373 @@
+"""
+Query analysis: one tokenisation per query, shared by all text fields.
+
+The vectorizers fitted by minsearch tokenise the query once per field and
+only match exact terms, so "squat" misses "squats" and a typo like
+"deltiods" matches nothing. QueryAnalyser instead:
+
+1. tokenises the query once, the way the vectorizers do (lowercase, two or
+   more word characters);
+2. corrects tokens that are not in the index vocabulary, in any form, to the
+   closest vocabulary term, using a symmetric-delete index built at load
+   time (edit distance 1, or 2 for words of MAX_DISTANCE_2_LENGTH
+   characters and more; ties go to the term in the most documents);
+3. for every field, looks each token up in the field's vocabulary, and
+   falls back to the variant of the field sharing its stem ("squat" ->
+   "squats" in exercise names);
+4. builds the field's TF-IDF vector from those columns with the field's
+   IDF weights and L2 norm, as the vectorizer would.
+
+The document side is untouched, so the index, boosts and reranker stay as
+they are. Results are memoised per query (QUERY_ANALYSIS_CACHE_SIZE).
+
+The lookup tables (stems, document frequencies, deletes) are sorted
+fixed-width byte arrays searched with np.searchsorted, like the shared
+index vocabularies. build_tables() computes them once. shared_index.write()
+stores them in the shared file, so workers attached to it map them instead
+of building per-worker dicts.
+"""
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+QUERY_ANALYSIS_CACHE_SIZE = int(os.getenv("QUERY_ANALYSIS_CACHE_SIZE", 4096))
+MIN_CORRECTION_LENGTH = 4
+MAX_DISTANCE_2_LENGTH = 8
+
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")  # TfidfVectorizer's default token_pattern
+
+# Common words a question is made of; never "corrected" to a vocabulary term ("what" -> "that")
+COMMON_WORDS = frozenset("""
+about above after again against also always and any are because been before being below between
+both but can could did does doing down during each few for from further had has have having her
+here hers him his how into its just many may might more most much must myself not now off once
+only other our ours out over own same she should some such than that the their them then there
+these they this those through too under until very was were what when where which while who whom
+why will with would you your yours best good better well need want like make get help give tell
+show know use used using
+""".split())
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def stem(token):
+    """
+    Light suffix stripping for plurals and verb forms.
+
+    Only used to group vocabulary variants, so it only has to be consistent,
+    not linguistically exact: "presses"/"press", "squats"/"squatting"/"squat".
+    """
+    if len(token) <= 3 or token.isdigit():
+        return token
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "y"
+    for suffix in ("sses", "xes", "ches", "shes"):
+        if token.endswith(suffix):
+            return token[:-2]
+    if token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        token = token[:-1]
+    for suffix in ("ing", "ed"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[:-len(suffix)]
+            # "squatting" -> "squatt" -> "squat"
+            if len(token) > 3 and token[-1] == token[-2] and token[-1] not in "lsz":
+                token = token[:-1]
+            break
+    return token
+
+
+def deletes(term, distance):
+    """Every string obtained by deleting up to `distance` characters from term"""
+    result = {term}
+    frontier = {term}
+    for _ in range(distance):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word))}
+        result |= frontier
+    return result
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance (adjacent transpositions count 1), capped at limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def max_distance(token):
+    return 2 if len(token) >= MAX_DISTANCE_2_LENGTH else 1
+
+
+def field_vocabulary(vectorizer):
+    """(terms, idf) of a fitted TfidfVectorizer or a shared_index.SharedVectorizer"""
+    if hasattr(vectorizer, "vocabulary_"):
+        terms = [None] * len(vectorizer.vocabulary_)
+        for term, column in vectorizer.vocabulary_.items():
+            terms[column] = term
+        return terms, np.asarray(vectorizer.idf_)
+    return [term.decode() for term in vectorizer.vocab], np.asarray(vectorizer.idf)
+
+
+def sorted_keys(keys):
+    """Byte strings as a sorted fixed-width array, and the order that sorts them"""
+    encoded = [key.encode() for key in keys]
+    width = max((len(key) for key in encoded), default=1)
+    array = np.array(encoded, dtype=f"S{width}")
+    order = np.argsort(array, kind="stable")
+    return array[order], order
+
+
+def key_range(keys, key):
+    """(start, stop) of the entries equal to key in a sorted byte-string array"""
+    encoded = key.encode()
+    if len(encoded) > keys.dtype.itemsize or len(keys) == 0:
+        return 0, 0
+    return int(np.searchsorted(keys, encoded, "left")), int(np.searchsorted(keys, encoded, "right"))
+
+
+def find(keys, key):
+    """Position of key in a sorted byte-string array, or -1"""
+    start, stop = key_range(keys, key)
+    return start if stop > start else -1
+
+
+def key_ranges(keys, tokens):
+    """key_range() of many tokens at once, as (starts, stops) arrays"""
+    starts = np.zeros(len(tokens), dtype=np.int64)
+    stops = np.zeros(len(tokens), dtype=np.int64)
+    encoded = [token.encode() for token in tokens]
+    fits = np.flatnonzero([len(token) <= keys.dtype.itemsize for token in encoded])
+    if len(fits) and len(keys):
+        candidates = np.array([encoded[i] for i in fits], dtype=keys.dtype)
+        starts[fits] = np.searchsorted(keys, candidates, "left")
+        stops[fits] = np.searchsorted(keys, candidates, "right")
+    return starts, stops
+
+
+def find_all(keys, tokens):
+    """Positions of the tokens in a sorted byte-string array, -1 for those not in it"""
+    starts, stops = key_ranges(keys, tokens)
+    return np.where(stops > starts, starts, -1)
+
+
+def build_tables(index):
+    """
+    The lookup tables of QueryAnalyser as flat arrays.
+
+    Per text field, "<field>.stems" and "<field>.stem_columns" map each stem
+    to the column of its most common variant. "terms" and "term_df" give
+    the documents containing each vocabulary term (over all fields), and
+    "delete_keys"/"delete_terms" map each deletion variant to positions in
+    "terms".
+    """
+    tables = {}
+    document_frequency = Counter()
+    for field in index.text_fields:
+        terms, idf = field_vocabulary(index.vectorizers[field])
+        stem_columns = {}
+        for column in np.argsort(idf, kind="stable")[::-1]:  # most common variant written last
+            stem_columns[stem(terms[column])] = int(column)
+        stems, order = sorted_keys(list(stem_columns))
+        tables[f"{field}.stems"] = stems
+        tables[f"{field}.stem_columns"] = np.array(list(stem_columns.values()), dtype=np.int32)[order]
+        # Documents containing each term, for breaking correction ties
+        counts = np.diff(index.text_matrices[field].tocsc().indptr)
+        for term, count in zip(terms, counts):
+            document_frequency[term] += int(count)
+
+    terms, order = sorted_keys(list(document_frequency))
+    tables["terms"] = terms
+    tables["term_df"] = np.array(list(document_frequency.values()), dtype=np.int32)[order]
+    variants = []
+    positions = []
+    for position, term in enumerate(term.decode() for term in terms):
+        if len(term) >= MIN_CORRECTION_LENGTH - 1 and not term.isdigit():
+            for variant in deletes(term, max_distance(term)):
+                variants.append(variant)
+                positions.append(position)
+    tables["delete_keys"], order = sorted_keys(variants)
+    tables["delete_terms"] = np.array(positions, dtype=np.int32)[order]
+    return tables
+
+
+class QueryAnalyser:
+    """
+    Tokenisation, spelling correction and per-field TF-IDF vectors for queries.
+
+    Args:
+        index: A fitted minsearch.Index or shared_index.SharedIndex.
+        cache_size (int): Queries memoised by vectors().
+    """
+
+    def __init__(self, index, cache_size=QUERY_ANALYSIS_CACHE_SIZE):
+        self.text_fields = list(index.text_fields)
+        # A shared index carries the tables in its file; a private one gets them built here
+        tables = getattr(index, "analysis_tables", None) or build_tables(index)
+        self.tables = tables
+        self.vectorizers = [index.vectorizers[field] for field in self.text_fields]
+        self.n_terms = []
+        self.idf = []
+        for vectorizer in self.vectorizers:
+            idf = np.asarray(vectorizer.idf_ if hasattr(vectorizer, "vocabulary_") else vectorizer.idf)
+            self.n_terms.append(len(idf))
+            self.idf.append(idf)
+        self.stems = [tables[f"{field}.stems"] for field in self.text_fields]
+        self.stem_columns = [tables[f"{field}.stem_columns"] for field in self.text_fields]
+        self.terms = tables["terms"]
+        self.term_df = tables["term_df"]
+        self.delete_keys = tables["delete_keys"]
+        self.delete_terms = tables["delete_terms"]
+        self.vectors = lru_cache(maxsize=cache_size)(self._vectors)
+        self.correct = lru_cache(maxsize=cache_size)(self._correct)
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.tables.values())
+
+    def is_known(self, token):
+        if find(self.terms, token) >= 0:
+            return True
+        token_stem = stem(token)
+        return any(find(stems, token_stem) >= 0 for stems in self.stems)
+
+    def _correct(self, token):
+        """The closest vocabulary term to an unknown token, or the token itself"""
+        if not self.correctable(token) or self.is_known(token):
+            return token
+        candidates = set()
+        for variant in deletes(token, max_distance(token)):
+            start, stop = key_range(self.delete_keys, variant)
+            candidates.update(self.delete_terms[start:stop].tolist())
+        return self.closest(token, candidates)
+
+    @staticmethod
+    def correctable(token):
+        return len(token) >= MIN_CORRECTION_LENGTH and not token.isdigit() and token not in COMMON_WORDS
+
+    def closest(self, token, candidates):
+        """The candidate term (positions in terms) closest to the token within its distance, or the token"""
+        limit = max_distance(token)
+        best = None
+        for position in candidates:
+            term = self.terms[position].decode()
+            distance = edit_distance(token, term, limit)
+            if distance <= limit:
+                key = (distance, -int(self.term_df[position]), term)
+                best = min(best, key) if best else key
+        return best[2] if best else token
+
+    def analyse(self, query):
+        """Corrected tokens of the query"""
+        return [self.correct(token) for token in tokenize(query)]
+
+    def column(self, token, j):
+        """Column of the token in field j's vocabulary, or None"""
+        vectorizer = self.vectorizers[j]
+        if hasattr(vectorizer, "vocabulary_"):
+            return vectorizer.vocabulary_.get(token)
+        # Shared vocabularies are sorted, and a term's position is its column
+        position = find(vectorizer.vocab, token)
+        return position if position >= 0 else None
+
+    def field_columns(self, tokens, j):
+        """Columns of field j matched by the tokens, exactly or by stem"""
+        matched = []
+        for token in tokens:
+            column = self.column(token, j)
+            if column is None:
+                position = find(self.stems[j], stem(token))
+                if position >= 0:
+                    column = int(self.stem_columns[j][position])
+            if column is not None:
+                matched.append(column)
+        return matched
+
+    def _row(self, tokens, j):
+        counts = Counter(self.field_columns(tokens, j))
+        columns = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=float, count=len(counts)) * self.idf[j][columns]
+        norm = np.sqrt(weights @ weights)
+        return columns, (weights / norm if norm else weights)
+
+    def _vectors(self, query):
+        """One 1 x vocabulary TF-IDF row per text field (memoised per query)"""
+        tokens = self.analyse(query)
+        vectors = []
+        for j in range(len(self.text_fields)):
+            columns, weights = self._row(tokens, j)
+            vectors.append(csr_matrix((weights, columns, [0, len(columns)]), shape=(1, self.n_terms[j])))
+        return vectors
+
+    def field_columns_all(self, tokens, token_stems, j):
+        """Column of each token in field j, exactly or by stem, -1 if none; field_columns for many tokens"""
+        vectorizer = self.vectorizers[j]
+        if hasattr(vectorizer, "vocabulary_"):
+            columns = np.array([vectorizer.vocabulary_.get(token, -1) for token in tokens], dtype=np.int64)
+        else:
+            columns = find_all(vectorizer.vocab, tokens)
+        missing = np.flatnonzero(columns < 0)
+        positions = find_all(self.stems[j], [token_stems[i] for i in missing])
+        by_stem = positions >= 0
+        columns[missing[by_stem]] = self.stem_columns[j][positions[by_stem]]
+        return columns
+
+    def correct_all(self, tokens):
+        """correct() for many distinct tokens, checking the vocabulary for all of them at once"""
+        known = find_all(self.terms, tokens) >= 0
+        token_stems = [stem(token) for token in tokens]
+        for stems in self.stems:
+            known |= find_all(stems, token_stems) >= 0
+        unknown = [token for token, is_known in zip(tokens, known) if not is_known and self.correctable(token)]
+        # The deletion variants of every unknown token are looked up together
+        variants = [(token, variant) for token in unknown for variant in deletes(token, max_distance(token))]
+        starts, stops = key_ranges(self.delete_keys, [variant for _, variant in variants])
+        candidates = {token: set() for token in unknown}
+        for (token, _), start, stop in zip(variants, starts.tolist(), stops.tolist()):
+            if stop > start:
+                candidates[token].update(self.delete_terms[start:stop].tolist())
+        corrections = {token: self.closest(token, candidates[token]) for token in unknown}
+        return [corrections.get(token, token) for token in tokens]
+
+    def matrices(self, queries):
+        """
+        One (queries x vocabulary) TF-IDF matrix per text field, for batch scoring.
+
+        Each distinct token of the batch is corrected and looked up once, and
+        the rows, equal to those of vectors(), are built with array operations.
+        """
+        tokenized = [tokenize(query) for query in queries]
+        distinct = {}
+        token_ids = np.array([distinct.setdefault(token, len(distinct))
+                              for tokens in tokenized for token in tokens], dtype=np.int64)
+        rows = np.repeat(np.arange(len(queries)), [len(tokens) for tokens in tokenized])
+        corrected = self.correct_all(list(distinct))
+        corrected_stems = [stem(token) for token in corrected]
+
+        result = []
+        for j in range(len(self.text_fields)):
+            n_terms = self.n_terms[j]
+            columns = self.field_columns_all(corrected, corrected_stems, j)[token_ids]
+            matched = columns >= 0
+            # Repeated (row, column) pairs are the term counts
+            cells, counts = np.unique(rows[matched] * n_terms + columns[matched], return_counts=True)
+            cell_rows, cell_columns = np.divmod(cells, n_terms)
+            weights = counts * self.idf[j][cell_columns]
+            norms = np.sqrt(np.bincount(cell_rows, weights=weights ** 2, minlength=len(queries)))[cell_rows]
+            weights = np.divide(weights, norms, out=weights, where=norms > 0)
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(cell_rows, minlength=len(queries)))])
+            result.append(csr_matrix((weights, cell_columns, indptr), shape=(len(queries), n_terms)))
+        return result
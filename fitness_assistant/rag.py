@@ -1,42 +1,205 @@
-from google import genai
 import injest
+import index_registry
+from retrieval_cache import RetrievalCache
+import llm
+import rate_limit
+import sessions
+import rerank
+import tracing
+import costs
+import admission
+import deadlines
+import stages
 from time import time
 import os
 import re
 import logging
 import json
+import threading
+import numpy as np
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
 
-index = injest.load_index()
+# The default tenant's catalogue, set by warmup() on first use or from the gunicorn hooks, so
+# importing this module stays cheap. Requests read the catalogue of their tenant through
+# index_registry.current(); these are for the offline tools (evaluation, reranker training).
+index = None
+facet_index = None
+query_analyser = None
+position_by_id = None
+reranker = None
+_warmup_lock = threading.Lock()
 
+retrieval_cache = RetrievalCache()
 
-def search(query, boost):
-    """Perform a search using the minsearch index with boosting"""
-    results = index.search(
-        query=query,
-        boost_dict=boost,
-        num_results=10
-    )
-    return results
+BOOST = {'body_part': 0.947771590052861,
+         'exercise_name': 2.8439224585464493,
+         'instructions': 0.6987228015703881,
+         'muscle_groups_activated': 0.49261344050772715,
+         'type': 2.587600420079811,
+         'type_of_activity': 0.3898333128794963,
+         'type_of_equipment': 1.234288967556835
+         }
 
 
+def query_vectors(query):
+    """TF-IDF vector of the analysed query for every text field of the index (memoised per query)"""
+    return index_registry.current().query_analyser.vectors(query)
 
-def minsearch_search_improved(query):
-    """Perform a search using the minsearch index with optimized boosting"""
 
-    boost = {'body_part': 0.947771590052861,
-            'exercise_name': 2.8439224585464493,
-            'instructions': 0.6987228015703881,
-            'muscle_groups_activated': 0.49261344050772715,
-            'type': 2.587600420079811,
-            'type_of_activity': 0.3898333128794963,
-            'type_of_equipment': 1.234288967556835
-            }
-    return search(query=query, boost=boost)
+def field_scores(query, candidates=None, query_vecs=None):
+    """
+    Cosine similarity of the query with every text field of the candidate documents.
+
+    Args:
+        query_vecs (list): Precomputed query_vectors(query), to score several batches of one query.
+
+    Returns:
+        np.ndarray: (n_candidates x n_text_fields) matrix, all documents if candidates is None.
+    """
+    index = index_registry.current().index
+    n_docs = len(index.docs) if candidates is None else len(candidates)
+    sims = np.zeros((n_docs, len(index.text_fields)))
+    for j, query_vec in enumerate(query_vecs or query_vectors(query)):
+        field = index.text_fields[j]
+        if query_vec.nnz == 0:
+            continue
+        matrix = index.text_matrices[field]
+        if candidates is not None:
+            matrix = matrix[candidates]
+        # Rows and query vectors are L2-normalised, so the dot product is the cosine similarity
+        sims[:, j] = (matrix @ query_vec.T).toarray().ravel()
+    return sims
+
+
+def score_candidates(query, boost, candidates=None, num_results=10):
+    """Score the candidate documents (all of them if None) with the index's TF-IDF fields"""
+    index = index_registry.current().index
+    weights = np.array([boost.get(field, 1) for field in index.text_fields])
+    scores = field_scores(query, candidates) @ weights
+    n_docs = len(scores)
+    if num_results < n_docs:
+        top = np.argpartition(-scores, num_results)[:num_results]
+    else:
+        top = np.arange(n_docs)
+    top = top[np.argsort(-scores[top], kind="stable")]
+    if candidates is not None:
+        return [index.docs[candidates[i]] for i in top if scores[i] > 0]
+    return [index.docs[i] for i in top if scores[i] > 0]
+
+
+def search(query, boost, filters=None, num_results=10):
+    """Perform a search using the minsearch index with boosting, restricted to the facet filters"""
+    catalogue = index_registry.current()
+
+    def run_search():
+        candidates = catalogue.facet_index.candidates(filters) if filters else None
+        return score_candidates(query, boost, candidates, num_results=num_results)
+
+    return retrieval_cache.search(catalogue.version, query, boost, run_search,
+                                  filters=filters, num_results=num_results)
+
+
+def warmup():
+    """
+    Load the default tenant's catalogue and the reranker unless that is already done.
+
+    Safe to call from several threads; only the first call does the work.
+    """
+    global reranker
+    if index is not None:
+        return index
+    with _warmup_lock:
+        if index is None:
+            started = time()
+            catalogue = index_registry.get_registry().get(index_registry.DEFAULT_TENANT, count_hit=False)
+            reranker = rerank.LinearReranker.load(text_fields=catalogue.index.text_fields)
+            # Published last, so a thread that sees the index also sees the rest
+            _publish(catalogue)
+            logger.info(f"Index built in {time() - started:.2f}s ({len(index.docs)} documents)")
+    return index
+
+
+def _publish(catalogue):
+    global index, facet_index, query_analyser, position_by_id
+    facet_index = catalogue.facet_index
+    query_analyser = catalogue.query_analyser
+    position_by_id = catalogue.position_by_id
+    index = catalogue.index
+
+
+def readiness():
+    """Which of the lazily initialised parts are ready to serve"""
+    return {
+        "index": index is not None,
+        "reranker": reranker is not None,
+        "llm_client": llm.backend_ready(),
+    }
+
+
+def reload_index(data_path=injest.DATA_PATH):
+    """Rebuild the default tenant's index from data_path; cached retrieval results for the old index are dropped"""
+    global reranker
+    catalogue = index_registry.get_registry().reload(index_registry.DEFAULT_TENANT, data_path)
+    with _warmup_lock:
+        if reranker is None:
+            reranker = rerank.LinearReranker.load(text_fields=catalogue.index.text_fields)
+        _publish(catalogue)
+    retrieval_cache.clear()
+    logger.info(f"Index reloaded from {data_path} (version {index.version})")
+    return index
+
+
+
+def minsearch_search_improved(query, filters=None, num_results=10):
+    """
+    Perform a search using the minsearch index with optimized boosting.
+
+    Facet constraints found in the query are applied first; explicit
+    filters (already parsed with facets.parse_filters) override them per
+    field. If the constraints found in the query leave nothing, the search
+    runs unfiltered; if the query text matches nothing within explicit
+    filters, the first matching documents are returned.
+    """
+    warmup()
+    catalogue = index_registry.current()
+    facet_index = catalogue.facet_index
+    facet_filters = facet_index.extract(query)
+    facet_filters.update(filters or {})
+    results = search(query=query, boost=BOOST, filters=facet_filters, num_results=num_results)
+    if not results and facet_filters:
+        if filters:
+            return [catalogue.index.docs[i] for i in facet_index.candidates(facet_filters)[:num_results]]
+        results = search(query=query, boost=BOOST, num_results=num_results)
+    return results
+
+
+def rerank_results(query, candidates, ranker=None, k=rerank.RERANK_TOP_K,
+                   budget_ms=rerank.RERANK_BUDGET_MS):
+    """
+    Rescore a first-stage candidate pool with the linear reranker and keep the best k.
+
+    Without a trained reranker the first k candidates are returned unchanged.
+    """
+    ranker = ranker or reranker
+    if ranker is None or not candidates:
+        return candidates[:k]
+    catalogue = index_registry.current()
+    positions = [catalogue.position_by_id[doc["ID"]] for doc in candidates]
+    query_vecs = query_vectors(query)
+    boost_weights = np.array([BOOST.get(field, 1) for field in catalogue.index.text_fields])
+    with tracing.span("rerank") as rerank_span:
+        top, stats = ranker.rerank(query, candidates,
+                                   lambda start, stop: field_scores(query, positions[start:stop], query_vecs),
+                                   boost_weights, catalogue.facet_index.extract(query), k=k, budget_ms=budget_ms)
+        rerank_span.set_attribute("candidates", stats["candidates"])
+        rerank_span.set_attribute("scored", stats["scored"])
+    if stats["scored"] < stats["candidates"]:
+        logger.info(f"Rerank budget reached after {stats['scored']}/{stats['candidates']} candidates")
+    return top
 
 
 
@@ -50,6 +213,20 @@ CONTEXT:
 {context}
 """.strip()
 
+prompt_template_with_history = """
+You're a fitness instructor. Answer the QUESTION based on the CONTEXT from our exercises database.
+Use only the facts from the CONTEXT when answering the QUESTION.
+Use the CONVERSATION HISTORY only to understand what the QUESTION refers to.
+
+CONVERSATION HISTORY:
+{history}
+
+QUESTION: {question}
+
+CONTEXT: 
+{context}
+""".strip()
+
 entry_template = """
     'exercise_name': {exercise_name}
     'type_of_activity': {type_of_activity}
@@ -62,7 +239,7 @@ entry_template = """
     """.strip()
 
 
-def build_prompt(query, search_results):
+def build_prompt(query, search_results, history=""):
 
 
     context = ""
@@ -70,76 +247,50 @@ def build_prompt(query, search_results):
     for doc in search_results:
         context = context + entry_template.format(**doc) + "\n\n"
 
-    prompt = prompt_template.format(question=query, context=context).strip()
+    if history:
+        prompt = prompt_template_with_history.format(question=query, context=context,
+                                                     history=history).strip()
+    else:
+        prompt = prompt_template.format(question=query, context=context).strip()
     return prompt
 
 
 
-def get_gemini_client():
-    """Initialize Gemini client"""
-    try:
-        client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-        logger.info("Gemini client initialized successfully")
-        return client
-    except Exception as e:
-        logger.error(f"Failed to initialize Gemini client: {e}")
-        raise
-
-def calculate_gemini_cost(prompt_tokens: int,
-                          candidate_tokens: int,
-                          input_cost_per_token: float = 0.075 / 1_000_000,
-                          output_cost_per_token: float = 0.30 / 1_000_000
-                          ) -> float:
+def llm_gemini(prompt, model="gemini-1.5-flash", priority=rate_limit.PRIORITY_INTERACTIVE):
     """
-    Calculates the estimated cost of a Gemini API call using fixed rates for Gemini 1.5 Flash.
-    (Rates: Input = $0.075/M tokens, Output = $0.30/M tokens)
+    Get response from Gemini through the configured LLM backend, within the model's quota.
 
-    Args:
-        prompt_tokens (int): The number of tokens in the input prompt.
-        candidate_tokens (int): The number of tokens in the generated response (completion).
-
-    Returns:
-        float: The estimated total cost in USD.
+    The call is added to the daily spend, and its cost in USD is returned in tokens_stats["cost"].
     """
-    # Rates for Gemini 1.5 Flash (as of recent updates), per single token
-    # Always verify these with the official Google AI for Developers pricing page!
-    
-    total_cost = (prompt_tokens * input_cost_per_token) + \
-                 (candidate_tokens * output_cost_per_token)
-
-    return total_cost
-
-def llm_gemini(prompt, model="gemini-1.5-flash"):
-    """Get response from Gemini"""
-    try:
-        client = get_gemini_client()
-        response = client.models.generate_content(
-            model=model, 
-            contents=prompt
-        )
-        prompt_tokens = response.usage_metadata.prompt_token_count
-        total_tokens = response.usage_metadata.total_token_count
-        candidate_tokens = response.usage_metadata.candidates_token_count
-       
-        tokens_stats = {
-            "prompt_tokens": prompt_tokens,
-            "total_tokens": total_tokens,
-            "completion_tokens": candidate_tokens
-            
-        }
-        
-
-        # gemini_cost = (prompt_tokens * 0.00035 + completion_tokens * 0.00105) / 1000
-        
+    limiter = rate_limit.get_rate_limiter()
+    estimated_tokens = rate_limit.estimate_tokens(prompt)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        # Under a request deadline, neither the quota wait nor the call may outlast it
+        deadlines.check(f"LLM call to {model}")
+        with tracing.span("llm.quota_wait", {"model": model, "attempt": attempt}):
+            limiter.acquire(model, estimated_tokens, priority=priority,
+                            timeout=deadlines.timeout(rate_limit.PRIORITY_TIMEOUT.get(priority)))
+        try:
+            answer, tokens_stats = llm.get_backend().generate(prompt, model, timeout=deadlines.timeout())
+        except llm.LLMRateLimitError as e:
+            limiter.penalise(model, e.retry_after)
+            if attempt < LLM_MAX_RETRIES and not deadlines.below(deadlines.NO_RETRY_BELOW):
+                logger.warning(f"Gemini rate limit hit for model {model}, retrying")
+                continue
+            logger.error(f"Gemini request failed: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Gemini request failed: {e}")
+            raise
+        # The bucket was charged the prompt estimate; settle it on the whole usage, answer included
+        limiter.settle(model, estimated_tokens, tokens_stats["prompt_tokens"] + tokens_stats["completion_tokens"])
+        cost = costs.get_spend_tracker().record(model, tokens_stats)
         logger.info(f"Gemini response received for model {model}")
-        return response.text, tokens_stats
-    except Exception as e:
-        logger.error(f"Gemini request failed: {e}")
-        raise
+        return answer, dict(tokens_stats, cost=cost)
 
 
 
-def evaluate_relevance(question, answer, model="gemini-2.0-flash"):
+def evaluate_relevance(question, answer, model="gemini-2.0-flash", priority=rate_limit.PRIORITY_JUDGE):
     """Evaluate answer relevance using Gemini-1.5-flash"""
     prompt_template = """
         You are an expert judge evaluating a generated answer in a Question-Answering (QA) system. You do NOT have access to a reference answer.
@@ -171,7 +322,7 @@ def evaluate_relevance(question, answer, model="gemini-2.0-flash"):
         
     
     prompt = prompt_template.format(question=question, answer_llm=answer)
-    evaluation, tokens_stats = llm_gemini(prompt, model=model)
+    evaluation, tokens_stats = llm_gemini(prompt, model=model, priority=priority)
     
     
     try:
@@ -186,27 +337,125 @@ def evaluate_relevance(question, answer, model="gemini-2.0-flash"):
     
 
 
-def rag(query, model="gemini-1.5-flash"):
-    t0 = time()
-    
-    search_results = minsearch_search_improved(query)
-    prompt = build_prompt(query, search_results)
-    answer, tokens_stats = llm_gemini(prompt, model=model)
-    gemini_cost_rag = calculate_gemini_cost(
-        prompt_tokens=tokens_stats["prompt_tokens"],
-        candidate_tokens=tokens_stats["completion_tokens"]
-    )
-    
-    evaluation, rel_tokens_stats = evaluate_relevance(question=query,
-                       answer=answer, model="gemini-2.0-flash")
-    gemini_cost_eval = calculate_gemini_cost(
-        prompt_tokens=rel_tokens_stats["prompt_tokens"],
-        candidate_tokens=rel_tokens_stats["completion_tokens"],
-        input_cost_per_token = 0.10 / 1_000_000,
-        output_cost_per_token = 0.40 / 1_000_000
-        
+SUMMARY_MODEL = "gemini-2.0-flash"
+
+summary_prompt_template = """
+Summarise this conversation between a user and a fitness assistant in at most {max_words} words.
+Keep the exercises, goals, equipment and constraints the user mentioned. Reply with the summary only.
+
+PREVIOUS SUMMARY: {summary}
+
+CONVERSATION:
+{turns}
+""".strip()
+
+
+def summarise_history(summary, turns):
+    """Fold older session turns into the rolling summary"""
+    prompt = summary_prompt_template.format(
+        max_words=sessions.SUMMARY_TOKEN_BUDGET * 3 // 4,
+        summary=summary or "(none)",
+        turns="\n".join(f"User: {t['question']}\nAssistant: {t['answer']}" for t in turns)
     )
-    gemini_cost = gemini_cost_rag + gemini_cost_eval
+    new_summary, _ = llm_gemini(prompt, model=SUMMARY_MODEL,
+                                priority=rate_limit.PRIORITY_JUDGE)
+    return new_summary.strip()
+
+
+JUDGE_MODEL = "gemini-2.0-flash"
+
+
+def rag(query, model="gemini-1.5-flash", session=None, filters=None,
+        priority=rate_limit.PRIORITY_INTERACTIVE):
+    """
+    Answer a question from the retrieved exercises and judge the answer's relevance.
+
+    `priority` is the quota priority of the answer call; the judge never runs
+    above PRIORITY_JUDGE. Offline callers pass PRIORITY_BATCH.
+
+    Retrieval runs at the same time as the LLM client setup (only needed on a
+    cold backend); the answer waits for both, and the judge for the answer.
+    answer_data["critical_path"] names the stages that set the response time.
+    """
+    t0 = time()
+    warmup()
+
+    def retrieve():
+        search_query = sessions.rewrite_query(session, query)
+        # A shorter context makes the answer call faster when little time is left
+        fewer_hits = deadlines.below(deadlines.FEWER_HITS_BELOW)
+        if fewer_hits:
+            deadlines.degrade("fewer_hits")
+        with tracing.span("retrieval") as retrieval_span:
+            if reranker is not None:
+                candidates = minsearch_search_improved(search_query, filters=filters,
+                                                       num_results=rerank.RERANK_POOL)
+                search_results = rerank_results(search_query, candidates,
+                                                k=deadlines.FEWER_HITS if fewer_hits else rerank.RERANK_TOP_K)
+            else:
+                search_results = minsearch_search_improved(search_query, filters=filters,
+                                                           num_results=deadlines.FEWER_HITS if fewer_hits else 10)
+            retrieval_span.set_attribute("hits", len(search_results))
+            retrieval_span.set_attribute("filtered", bool(filters))
+        return search_results
+
+    def generate_answer(search_results, _client):
+        prompt = build_prompt(query, search_results, history=sessions.format_history(session))
+        # Budget guards read in-memory spend counters, never Postgres
+        answer_model = costs.get_spend_tracker().answer_model(model)
+        if deadlines.below(deadlines.FAST_MODEL_BELOW) and costs.MODEL_DOWNGRADES.get(answer_model, answer_model) != answer_model:
+            answer_model = costs.MODEL_DOWNGRADES[answer_model]
+            deadlines.degrade("fast_model")
+        # Requests can wait in the admission queue; don't pay for an answer nobody will read
+        admission.cancel_point("llm.answer")
+        with tracing.span("llm.answer", {"model": answer_model}) as answer_span:
+            answer, tokens_stats = llm_gemini(prompt, model=answer_model, priority=priority)
+            answer_span.set_attribute("prompt_tokens", tokens_stats["prompt_tokens"])
+            answer_span.set_attribute("completion_tokens", tokens_stats["completion_tokens"])
+        return answer, tokens_stats, answer_model
+
+    def judge(answered):
+        answer = answered[0]
+        admission.cancel_point("llm.judge")
+        with tracing.span("llm.judge", {"model": JUDGE_MODEL}) as judge_span:
+            skip_reason = None
+            if costs.get_spend_tracker().should_skip_judge():
+                skip_reason = "daily LLM budget threshold reached"
+            elif deadlines.below(deadlines.SKIP_JUDGE_BELOW):
+                skip_reason = "request deadline too close"
+                deadlines.degrade("judge_skipped")
+            if skip_reason is None:
+                try:
+                    evaluation, rel_tokens_stats = evaluate_relevance(question=query,
+                                       answer=answer, model=JUDGE_MODEL,
+                                       priority=max(priority, rate_limit.PRIORITY_JUDGE))
+                except (llm.LLMTimeoutError, rate_limit.RateLimitTimeout, deadlines.DeadlineExceeded) as e:
+                    # The answer is ready; an unfinished judgement must not cost the user it
+                    skip_reason = f"judge did not finish before the deadline ({e})"
+                    deadlines.degrade("judge_timeout")
+            if skip_reason is not None:
+                evaluation = {
+                    "Relevance": "UNKNOWN",
+                    "Explanation": f"Not evaluated: {skip_reason}"
+                }
+                rel_tokens_stats = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost": 0.0}
+                judge_span.set_attribute("skipped", True)
+            judge_span.set_attribute("relevance", evaluation["Relevance"])
+            judge_span.set_attribute("prompt_tokens", rel_tokens_stats["prompt_tokens"])
+        return evaluation, rel_tokens_stats
+
+    graph = stages.StageGraph("rag")
+    graph.add("retrieval", retrieve)
+    # Creating the Gemini client takes a while on a cold worker; it doesn't need the search results
+    graph.add("llm.client", lambda: None if llm.backend_ready() else llm.get_backend().warmup())
+    graph.add("llm.answer", generate_answer, deps=["retrieval", "llm.client"])
+    graph.add("llm.judge", judge, deps=["llm.answer"])
+    results = graph.run()
+    answer, tokens_stats, model = results["llm.answer"]
+    evaluation, rel_tokens_stats = results["llm.judge"]
+    timings = graph.timings()
+    critical_path, _ = graph.critical_path()
+    gemini_cost = tokens_stats["cost"] + rel_tokens_stats["cost"]
     
     t1 = time()
     response_time = t1 - t0
@@ -224,14 +473,14 @@ def rag(query, model="gemini-1.5-flash"):
         "eval_completion_tokens": rel_tokens_stats["completion_tokens"],
         "eval_total_tokens": rel_tokens_stats["total_tokens"],
         "gemini_cost": gemini_cost,
+        "retrieval_time": timings["retrieval"]["duration"],
+        "llm_time": timings["llm.answer"]["duration"],
+        "judge_time": timings["llm.judge"]["duration"],
+        "degradations": deadlines.degradations(),
+        "critical_path": critical_path,
     }
     
     
     
  
     return answer_data
-
-
-
-
-
@@ -0,0 +1,286 @@
+"""
+Client-side quota management for LLM calls.
+
+Every model gets two token buckets: one for requests per minute and one
+for tokens per minute. A call takes one request and its estimated prompt
+tokens before it is sent. Once the real usage (prompt plus completion
+tokens) is known, the difference is settled.
+
+Bucket state lives either in process memory or, when RATE_LIMIT_SHM_PATH
+is set, in a small memory-mapped file guarded by flock. In that mode all
+gunicorn workers on a host share one budget.
+
+Callers have priorities. Within a process, waiters are served in
+priority order. Across processes, lower priorities may only spend the
+part of the bucket above a reserve, which leaves headroom for /ask traffic.
+"""
+import os
+import json
+import math
+import mmap
+import time
+import heapq
+import fcntl
+import struct
+import logging
+import zlib
+import itertools
+import threading
+
+from llm import LLMRateLimitError
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_JUDGE = 1
+PRIORITY_BATCH = 2
+
+# Fraction of each bucket that a priority level must leave untouched
+PRIORITY_RESERVE = {
+    PRIORITY_INTERACTIVE: 0.0,
+    PRIORITY_JUDGE: 0.2,
+    PRIORITY_BATCH: 0.5,
+}
+
+# How long a caller waits for quota before giving up (None waits forever)
+PRIORITY_TIMEOUT = {
+    PRIORITY_INTERACTIVE: 10.0,
+    PRIORITY_JUDGE: 30.0,
+    PRIORITY_BATCH: None,
+}
+
+# Gemini paid tier 1 limits; override with LLM_RATE_LIMITS='{"model": {"rpm": .., "tpm": ..}}'
+DEFAULT_LIMITS = {
+    "gemini-1.5-flash": {"rpm": 2000, "tpm": 4_000_000},
+    "gemini-1.5-flash-8b": {"rpm": 4000, "tpm": 4_000_000},
+    "gemini-2.0-flash": {"rpm": 2000, "tpm": 4_000_000},
+    "gemini-2.0-flash-lite": {"rpm": 4000, "tpm": 4_000_000},
+}
+
+CHARS_PER_TOKEN = 4
+
+
+class RateLimitTimeout(LLMRateLimitError):
+    """Raised when no quota became available before the caller's timeout"""
+
+
+def estimate_tokens(text):
+    """Estimate prompt tokens before sending (Gemini averages about 4 characters per token)"""
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def load_limits():
+    """Per-model limits: the defaults updated with LLM_RATE_LIMITS"""
+    limits = dict(DEFAULT_LIMITS)
+    override = os.getenv("LLM_RATE_LIMITS")
+    if override:
+        limits.update(json.loads(override))
+    return limits
+
+
+class LocalBucketStore:
+    """Bucket levels kept in process memory"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def update(self, model, fn):
+        with self._lock:
+            state = self._buckets.get(model)
+            state = fn(state)
+            self._buckets[model] = state
+            return state
+
+
+class SharedBucketStore:
+    """
+    Bucket levels kept in a memory-mapped file shared by every process on the host.
+
+    The file holds a fixed table of slots, one per model, each packed as
+    (model hash, request level, token level, last refill, blocked until).
+    """
+
+    SLOT = struct.Struct("<Q4d")
+    SLOTS = 64
+
+    def __init__(self, path):
+        self.path = path
+        size = self.SLOT.size * self.SLOTS
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _slot(self, model):
+        key = zlib.crc32(model.encode("utf-8")) + 1
+        start = key % self.SLOTS
+        for i in range(self.SLOTS):
+            slot = (start + i) % self.SLOTS
+            slot_key = self.SLOT.unpack_from(self._mm, slot * self.SLOT.size)[0]
+            if slot_key in (0, key):
+                return slot, key, slot_key == 0
+        raise RuntimeError(f"No free rate-limit slot in {self.path}")
+
+    def update(self, model, fn):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                slot, key, empty = self._slot(model)
+                offset = slot * self.SLOT.size
+                state = None if empty else self.SLOT.unpack_from(self._mm, offset)[1:]
+                state = fn(state)
+                self.SLOT.pack_into(self._mm, offset, key, *state)
+                return state
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """
+    Per-model request and token budgets with priority scheduling.
+
+    Args:
+        limits (dict): Model name -> {"rpm": int, "tpm": int}. Models without limits are not throttled.
+        store: LocalBucketStore or SharedBucketStore holding the bucket levels.
+    """
+
+    def __init__(self, limits=None, store=None):
+        self.limits = limits if limits is not None else load_limits()
+        self.store = store or LocalBucketStore()
+        self._cond = threading.Condition()
+        self._waiters = {}
+        self._seq = itertools.count()
+        self.stats = {"acquired": 0, "waited_seconds": 0.0, "timeouts": 0, "penalties": 0}
+
+    def _take(self, model, tokens, reserve):
+        """Try to take quota; return 0 on success or the seconds to wait otherwise"""
+        limit = self.limits[model]
+        rpm, tpm = limit["rpm"], limit["tpm"]
+        # A prompt larger than the whole bucket would never fit, so it only needs a full bucket
+        tokens = min(tokens, tpm)
+        result = {}
+
+        def refill_and_take(state):
+            now = time.monotonic()
+            if state is None:
+                state = (rpm, tpm, now, 0.0)
+            requests_level, tokens_level, last, blocked_until = state
+            elapsed = max(0.0, now - last)
+            requests_level = min(rpm, requests_level + elapsed * rpm / 60)
+            tokens_level = min(tpm, tokens_level + elapsed * tpm / 60)
+
+            if now < blocked_until:
+                result["wait"] = blocked_until - now
+                return requests_level, tokens_level, now, blocked_until
+
+            need_requests = min(1 + reserve * rpm, rpm)
+            need_tokens = min(tokens + reserve * tpm, tpm)
+            if requests_level >= need_requests and tokens_level >= need_tokens:
+                result["wait"] = 0.0
+                return requests_level - 1, tokens_level - tokens, now, blocked_until
+
+            result["wait"] = max((need_requests - requests_level) * 60 / rpm,
+                                 (need_tokens - tokens_level) * 60 / tpm,
+                                 0.001)
+            return requests_level, tokens_level, now, blocked_until
+
+        self.store.update(model, refill_and_take)
+        return result["wait"]
+
+    def acquire(self, model, tokens, priority=PRIORITY_INTERACTIVE, timeout=-1):
+        """
+        Block until the model has quota for one request of `tokens` prompt tokens.
+
+        Args:
+            model (str): Model the request will be sent to.
+            tokens (int): Estimated prompt tokens of the request.
+            priority (int): PRIORITY_INTERACTIVE, PRIORITY_JUDGE or PRIORITY_BATCH.
+            timeout (float): Seconds to wait at most; defaults to the priority's timeout.
+
+        Raises:
+            RateLimitTimeout: If no quota became available in time.
+        """
+        if model not in self.limits:
+            return
+        if timeout == -1:
+            timeout = PRIORITY_TIMEOUT.get(priority)
+        reserve = PRIORITY_RESERVE.get(priority, 0.0)
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        entry = (priority, next(self._seq))
+
+        with self._cond:
+            waiters = self._waiters.setdefault(model, [])
+            heapq.heappush(waiters, entry)
+            try:
+                while True:
+                    if waiters[0] == entry:
+                        wait = self._take(model, tokens, reserve)
+                        if wait == 0:
+                            break
+                    else:
+                        # Someone with a higher priority (or who came first) is ahead of us
+                        wait = 0.05
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.stats["timeouts"] += 1
+                            raise RateLimitTimeout(f"No quota for {model} within {timeout:.1f}s")
+                        wait = min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                waiters.remove(entry)
+                heapq.heapify(waiters)
+                self._cond.notify_all()
+
+        self.stats["acquired"] += 1
+        self.stats["waited_seconds"] += time.monotonic() - started
+
+    def settle(self, model, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real prompt and completion usage is known"""
+        if model not in self.limits or actual_tokens is None:
+            return
+        delta = actual_tokens - estimated_tokens
+
+        def adjust(state):
+            requests_level, tokens_level, last, blocked_until = state or self._full(model)
+            return requests_level, tokens_level - delta, last, blocked_until
+
+        self.store.update(model, adjust)
+
+    def penalise(self, model, retry_after=None):
+        """Stop sending to a model after the API answered 429"""
+        if model not in self.limits:
+            return
+        self.stats["penalties"] += 1
+        pause = retry_after or 1.0
+
+        def block(state):
+            state = state or self._full(model)
+            requests_level, tokens_level, last, blocked_until = state
+            return 0.0, tokens_level, last, max(blocked_until, time.monotonic() + pause)
+
+        self.store.update(model, block)
+
+    def _full(self, model):
+        limit = self.limits[model]
+        return limit["rpm"], limit["tpm"], time.monotonic(), 0.0
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                shm_path = os.getenv("RATE_LIMIT_SHM_PATH")
+                store = SharedBucketStore(shm_path) if shm_path else LocalBucketStore()
+                _limiter = RateLimiter(store=store)
+                logger.info(f"Rate limiter using {'shared file ' + shm_path if shm_path else 'process memory'}")
+    return _limiter
@@ -0,0 +1,253 @@
+"""
+Replay recorded questions against a candidate configuration.
+
+Questions are streamed out of the `conversations` table with a server-side
+cursor and answered again by rag() with the candidate settings, several at a
+time. Only a bounded number of questions is read ahead, so memory stays
+constant for any amount of history. Each answer is compared with what was
+recorded for the same question. The report gives latency, tokens, cost and
+relevance before and after, and the exit code fails the deploy gate when a
+delta crosses its threshold.
+
+A candidate is a JSON file; every key is optional:
+
+    {
+      "model": "gemini-2.0-flash",          # answer model (default: the recorded one)
+      "judge_model": "gemini-2.0-flash",
+      "boost": {"exercise_name": 3.0, ...},  # merged into rag.BOOST
+      "prompt_template": "path/to/prompt.txt",
+      "rerank": false
+    }
+
+    python replay.py --config candidate.json --since 2025-06-01 --limit 500 --workers 8
+    LLM_BACKEND=fake python replay.py --limit 1000    # current config, retrieval and pipeline cost only
+
+Replayed LLM calls run at PRIORITY_BATCH, so they only use quota that live
+traffic leaves over, and their spend is tracked in this process only: it is
+not written to `llm_spend_daily` and does not trip the production budget
+guards.
+
+Conversations are replayed as standalone questions, without session history.
+Latency is only comparable when the replay uses the same LLM backend as
+production; with the fake backend, compare retrieval_time.
+"""
+import sys
+import json
+import time
+import argparse
+import logging
+import statistics
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import db
+import rag
+import costs
+import rate_limit
+
+logger = logging.getLogger(__name__)
+
+RELEVANCE_SCORES = {"RELEVANT": 1.0, "PARTIALLY_RELEVANT": 0.5, "NON_RELEVANT": 0.0}
+
+# metric -> (recorded column, candidate answer_data key)
+COMPARED = {
+    "response_time": ("response_time", "response_time"),
+    "retrieval_time": ("retrieval_time", "retrieval_time"),
+    "llm_time": ("llm_time", "llm_time"),
+    "prompt_tokens": ("prompt_tokens", "prompt_tokens"),
+    "completion_tokens": ("completion_tokens", "completion_tokens"),
+    "eval_total_tokens": ("eval_total_tokens", "eval_total_tokens"),
+    "cost": ("gemini_cost", "gemini_cost"),
+    "relevance": ("relevance", "relevance"),
+}
+
+
+def apply_config(config):
+    """
+    Switch rag to the candidate settings; this process only serves the replay.
+
+    Returns:
+        str or None: The answer model to use, None to reuse the recorded one.
+    """
+    if "boost" in config:
+        rag.BOOST = dict(rag.BOOST, **config["boost"])
+    if "judge_model" in config:
+        rag.JUDGE_MODEL = config["judge_model"]
+    if "prompt_template" in config:
+        with open(config["prompt_template"]) as f:
+            rag.prompt_template = f.read().strip()
+    rag.warmup()
+    if config.get("rerank") is False:
+        rag.reranker = None
+    return config.get("model")
+
+
+def metric_value(name, value):
+    if name == "relevance":
+        return RELEVANCE_SCORES.get(value)
+    return None if value is None else float(value)
+
+
+def replay_one(row, model):
+    """Answer a recorded question again; returns (row, answer_data or None, error)"""
+    try:
+        return row, rag.rag(row["question"], model=model or row["model_used"],
+                            priority=rate_limit.PRIORITY_BATCH), None
+    except Exception as e:
+        return row, None, str(e)
+
+
+class Comparison:
+    """Running recorded/candidate values per metric; only numbers are kept, never rows"""
+
+    def __init__(self):
+        self.values = {name: ([], []) for name in COMPARED}
+        self.relevance = {"recorded": {}, "candidate": {}}
+        self.replayed = 0
+        self.errors = 0
+
+    def add(self, row, answer_data):
+        self.replayed += 1
+        for name, (column, key) in COMPARED.items():
+            recorded = metric_value(name, row.get(column))
+            candidate = metric_value(name, answer_data.get(key))
+            # Only paired values are compared; older rows have no stage timings
+            if recorded is not None and candidate is not None:
+                self.values[name][0].append(recorded)
+                self.values[name][1].append(candidate)
+        for side, label in (("recorded", row.get("relevance")), ("candidate", answer_data.get("relevance"))):
+            self.relevance[side][label] = self.relevance[side].get(label, 0) + 1
+
+    def summary(self):
+        """metric -> {n, recorded, candidate, delta, delta_pct, recorded_p95, candidate_p95}"""
+        result = {}
+        for name, (recorded, candidate) in self.values.items():
+            if not recorded:
+                continue
+            before, after = statistics.fmean(recorded), statistics.fmean(candidate)
+            result[name] = {
+                "n": len(recorded),
+                "recorded": before,
+                "candidate": after,
+                "delta": after - before,
+                "delta_pct": (after - before) / before * 100 if before else None,
+            }
+            if name.endswith("_time"):
+                result[name]["recorded_p95"] = percentile(recorded, 0.95)
+                result[name]["candidate_p95"] = percentile(candidate, 0.95)
+        return result
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(rows, model=None, workers=8, output=None):
+    """Replay rows with up to `workers` in flight and return the Comparison"""
+    comparison = Comparison()
+    out = open(output, "w") if output else None
+
+    def collect(futures):
+        for future in futures:
+            row, answer_data, error = future.result()
+            if error is not None:
+                comparison.errors += 1
+                logger.warning(f"Conversation {row['id']} failed: {error}")
+                continue
+            comparison.add(row, answer_data)
+            if out:
+                out.write(json.dumps({
+                    "id": str(row["id"]),
+                    "question": row["question"],
+                    "recorded": {column: row.get(column) for column, _ in COMPARED.values()},
+                    "candidate": {key: answer_data.get(key) for _, key in COMPARED.values()},
+                }) + "\n")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = set()
+            for row in rows:
+                # Read ahead by at most two batches of work, so the cursor sets the pace
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(pool.submit(replay_one, row, model))
+            collect(wait(in_flight).done)
+    finally:
+        if out:
+            out.close()
+    return comparison
+
+
+def check_gate(summary, max_latency_pct, max_cost_pct, max_relevance_drop):
+    """Descriptions of the deltas that exceed the thresholds"""
+    failures = []
+    latency = summary.get("response_time")
+    if latency and latency["delta_pct"] is not None and latency["delta_pct"] > max_latency_pct:
+        failures.append(f"response_time +{latency['delta_pct']:.1f}% > {max_latency_pct}%")
+    cost = summary.get("cost")
+    if cost and cost["delta_pct"] is not None and cost["delta_pct"] > max_cost_pct:
+        failures.append(f"cost +{cost['delta_pct']:.1f}% > {max_cost_pct}%")
+    relevance = summary.get("relevance")
+    if relevance and -relevance["delta"] > max_relevance_drop:
+        failures.append(f"relevance score {relevance['delta']:+.3f} < -{max_relevance_drop}")
+    return failures
+
+
+def print_report(comparison, elapsed):
+    print(f"{comparison.replayed} questions replayed in {elapsed:.1f}s, {comparison.errors} errors")
+    print(f"{'metric':<18} {'n':>6} {'recorded':>12} {'candidate':>12} {'delta':>12} {'delta %':>8}")
+    for name, stats in comparison.summary().items():
+        pct = f"{stats['delta_pct']:+.1f}" if stats["delta_pct"] is not None else "-"
+        print(f"{name:<18} {stats['n']:>6} {stats['recorded']:>12.4g} {stats['candidate']:>12.4g} "
+              f"{stats['delta']:>+12.4g} {pct:>8}")
+        if "recorded_p95" in stats:
+            print(f"{'  p95':<18} {'':>6} {stats['recorded_p95']:>12.4g} {stats['candidate_p95']:>12.4g}")
+    labels = sorted(set(comparison.relevance["recorded"]) | set(comparison.relevance["candidate"]), key=str)
+    for label in labels:
+        print(f"{str(label):<18} {'':>6} {comparison.relevance['recorded'].get(label, 0):>12} "
+              f"{comparison.relevance['candidate'].get(label, 0):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded questions against a candidate configuration")
+    parser.add_argument("--config", help="Candidate configuration (JSON); the current one if omitted")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Replay conversations from this time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Replay conversations before this time")
+    parser.add_argument("--model-used", help="Only replay conversations answered by this model")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=8, help="Questions answered at once")
+    parser.add_argument("--output", help="Write per-question recorded/candidate values as JSON lines")
+    parser.add_argument("--max-latency-regression", type=float, default=10.0, help="Percent")
+    parser.add_argument("--max-cost-regression", type=float, default=10.0, help="Percent")
+    parser.add_argument("--max-relevance-drop", type=float, default=0.02,
+                        help="Drop in mean relevance score (RELEVANT=1, PARTIALLY_RELEVANT=0.5)")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    model = apply_config(config)
+    costs.set_spend_tracker(costs.SpendTracker(daily_budget=None, persist=False))
+    # rag configures INFO logging on import; per-call logs would drown the report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rows = db.iter_conversations(since=args.since, until=args.until,
+                                 model_used=args.model_used, limit=args.limit)
+    started = time.perf_counter()
+    comparison = run(rows, model=model, workers=args.workers, output=args.output)
+    print_report(comparison, time.perf_counter() - started)
+
+    failures = check_gate(comparison.summary(), args.max_latency_regression,
+                          args.max_cost_regression, args.max_relevance_drop)
+    for failure in failures:
+        print(f"[FAIL] {failure}")
+    if failures or comparison.errors:
+        sys.exit(1)
+    print("[OK] Candidate within thresholds")
+
+
+if __name__ == "__main__":
+    main()
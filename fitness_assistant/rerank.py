@@ -0,0 +1,271 @@
+"""
+Second-stage reranking of search results.
+
+The first stage (TF-IDF with boosts) retrieves a wide candidate pool.
+A learned linear ranker rescores the pool, and only the best k documents
+go into the prompt. The ranker uses per-field similarities, the
+first-stage score and rank, and exercise-name and facet agreement
+features. It is trained on data/ground-trunth-retrieval.csv:
+
+    python rerank.py train      # fit and save the weights to data/reranker.json
+    python rerank.py evaluate   # hit rate / MRR, prompt tokens and latency vs. first stage only
+
+Scoring runs in batches under a time budget. When the budget runs out,
+the candidates not yet scored keep their first-stage order behind the
+scored ones.
+"""
+import os
+import json
+import time
+import zlib
+import argparse
+import logging
+
+import numpy as np
+
+import facets
+
+logger = logging.getLogger(__name__)
+
+RERANKER_PATH = os.getenv("RERANKER_PATH", "../data/reranker.json")
+GROUND_TRUTH_PATH = "../data/ground-trunth-retrieval.csv"
+RERANK_POOL = int(os.getenv("RERANK_POOL", 50))
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", 5))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", 20))
+RERANK_BATCH_SIZE = 16
+
+EXTRA_FEATURES = ["first_stage_score", "reciprocal_rank", "name_overlap", "name_mentioned", "facet_matches"]
+
+
+def feature_names(text_fields):
+    return [f"sim_{field}" for field in text_fields] + EXTRA_FEATURES
+
+
+def extract_features(query, docs, field_sims, boost_weights, query_facets, start=0):
+    """
+    Feature matrix for docs[start:start + len(field_sims)] in first-stage order.
+
+    Args:
+        field_sims (np.ndarray): Per-field similarities of these documents (n x n_fields).
+        boost_weights (np.ndarray): First-stage boost per field.
+        query_facets (dict): Facets extracted from the query.
+    """
+    query_name = f" {facets.normalise_name(query)} "
+    query_words = set(query_name.split())
+    first_stage = field_sims @ boost_weights
+    rows = []
+    for i, doc in enumerate(docs[start:start + len(field_sims)]):
+        name = facets.normalise_name(doc.get("exercise_name", ""))
+        name_words = set(name.split())
+        matches = sum(1 for field, values in query_facets.items()
+                      if values & facets.split_values(doc.get(field, "")))
+        rows.append([
+            first_stage[i],
+            1.0 / (start + i + 1),
+            len(name_words & query_words) / len(name_words) if name_words else 0.0,
+            1.0 if name and f" {name} " in query_name else 0.0,
+            matches,
+        ])
+    return np.hstack([field_sims, np.array(rows).reshape(len(rows), len(EXTRA_FEATURES))])
+
+
+class LinearReranker:
+    """
+    Linear model over standardised features; a higher score ranks a document higher.
+
+    Args:
+        weights (list): One weight per feature.
+        bias (float): Intercept (does not change the ranking, kept for probabilities).
+        mean (list): Feature means used for standardisation.
+        scale (list): Feature standard deviations used for standardisation.
+        features (list): Feature names, one per weight.
+    """
+
+    def __init__(self, weights, bias, mean, scale, features):
+        self.weights = np.asarray(weights, dtype=float)
+        self.bias = float(bias)
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.features = list(features)
+
+    @classmethod
+    def load(cls, path=RERANKER_PATH, text_fields=None):
+        """
+        Load a trained ranker, or return None if there is none at path.
+
+        Args:
+            text_fields (list): Text fields of the index it will rank for; its
+                features must be the ones extract_features() gives for them.
+        Raises:
+            ValueError: If the features do not match the index fields.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        if text_fields is not None and data["features"] != feature_names(text_fields):
+            raise ValueError(f"Reranker {path} was trained on features {data['features']}, "
+                             f"the index gives {feature_names(text_fields)}; retrain it")
+        return cls(data["weights"], data["bias"], data["mean"], data["scale"], data["features"])
+
+    def save(self, path=RERANKER_PATH, **info):
+        with open(path, "w") as f:
+            json.dump({
+                "features": self.features,
+                "weights": self.weights.tolist(),
+                "bias": self.bias,
+                "mean": self.mean.tolist(),
+                "scale": self.scale.tolist(),
+                **info,
+            }, f, indent=2)
+
+    def score(self, features):
+        return ((features - self.mean) / self.scale) @ self.weights + self.bias
+
+    def rerank(self, query, docs, sims_fn, boost_weights, query_facets,
+               k=RERANK_TOP_K, budget_ms=RERANK_BUDGET_MS, batch_size=RERANK_BATCH_SIZE):
+        """
+        Rescore docs (in first-stage order) and return the best k.
+
+        Args:
+            sims_fn: Callable (start, stop) -> per-field similarities of docs[start:stop].
+            budget_ms (float): Time budget; None scores every batch.
+
+        Returns:
+            tuple: (top k docs, stats dict with scored count and elapsed milliseconds).
+        """
+        started = time.perf_counter()
+        scores = []
+        for start in range(0, len(docs), batch_size):
+            if budget_ms is not None and start and (time.perf_counter() - started) * 1000 > budget_ms:
+                break
+            sims = sims_fn(start, min(start + batch_size, len(docs)))
+            features = extract_features(query, docs, sims, boost_weights, query_facets, start=start)
+            scores.extend(self.score(features))
+
+        scored = len(scores)
+        order = sorted(range(scored), key=lambda i: -scores[i]) + list(range(scored, len(docs)))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        return [docs[i] for i in order[:k]], {"scored": scored, "candidates": len(docs),
+                                              "elapsed_ms": elapsed_ms}
+
+
+def _split(question):
+    """Deterministic 80/20 train/test split by question text"""
+    return "test" if zlib.crc32(question.encode("utf-8")) % 5 == 0 else "train"
+
+
+def _load_ground_truth():
+    import pandas as pd
+    return pd.read_csv(GROUND_TRUTH_PATH).to_dict(orient="records")
+
+
+def _pool_features(rag, question):
+    docs = rag.minsearch_search_improved(question, num_results=RERANK_POOL)
+    positions = [rag.position_by_id[d["ID"]] for d in docs]
+    sims = rag.field_scores(question, positions) if docs else np.zeros((0, len(rag.index.text_fields)))
+    boost_weights = np.array([rag.BOOST.get(f, 1) for f in rag.index.text_fields])
+    features = extract_features(question, docs, sims, boost_weights, rag.facet_index.extract(question))
+    return docs, features
+
+
+def train(path=RERANKER_PATH, epochs=500, learning_rate=0.1, l2=1e-3):
+    """Fit a pointwise logistic ranker on the training split of the ground truth"""
+    import rag
+
+    X, y = [], []
+    for q in _load_ground_truth():
+        if _split(q["question"]) != "train":
+            continue
+        docs, features = _pool_features(rag, q["question"])
+        if not any(d["ID"] == q["id"] for d in docs):
+            continue
+        X.append(features)
+        y.extend(1.0 if d["ID"] == q["id"] else 0.0 for d in docs)
+    X = np.vstack(X)
+    y = np.array(y)
+
+    mean = X.mean(axis=0)
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1.0
+    Xs = (X - mean) / scale
+    # Weight positives up so the single relevant document per question is not drowned out
+    sample_weight = np.where(y == 1, (y == 0).sum() / max((y == 1).sum(), 1), 1.0)
+
+    w = np.zeros(X.shape[1])
+    b = 0.0
+    for _ in range(epochs):
+        p = 1 / (1 + np.exp(-(Xs @ w + b)))
+        grad = sample_weight * (p - y)
+        w -= learning_rate * (Xs.T @ grad / len(y) + l2 * w)
+        b -= learning_rate * grad.mean()
+
+    reranker = LinearReranker(w, b, mean, scale, feature_names(rag.index.text_fields))
+    reranker.save(path, pool_size=RERANK_POOL, training_rows=int(len(y)))
+    print(f"[INFO] Trained reranker on {len(y)} candidates, saved to {path}")
+    return reranker
+
+
+def evaluate(k=RERANK_TOP_K, budget_ms=RERANK_BUDGET_MS, split="test"):
+    """Compare first-stage top 10 with reranked top k: quality, prompt tokens and latency"""
+    import rag
+    from rate_limit import estimate_tokens
+
+    rag.warmup()
+    reranker = LinearReranker.load(text_fields=rag.index.text_fields)
+    if reranker is None:
+        raise SystemExit(f"No reranker at {RERANKER_PATH}, run `python rerank.py train` first")
+
+    questions = [q for q in _load_ground_truth() if split == "all" or _split(q["question"]) == split]
+    results = {"baseline": [], "reranked": []}
+    tokens = {"baseline": [], "reranked": []}
+    rerank_ms = []
+    added_ms = []
+    for q in questions:
+        # Both searches start from the same state: query analysis done, nothing cached
+        rag.query_vectors(q["question"])
+        rag.retrieval_cache.clear()
+        started = time.perf_counter()
+        baseline = rag.minsearch_search_improved(q["question"])
+        baseline_ms = (time.perf_counter() - started) * 1000
+
+        rag.retrieval_cache.clear()
+        started = time.perf_counter()
+        pool = rag.minsearch_search_improved(q["question"], num_results=RERANK_POOL)
+        pool_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        reranked = rag.rerank_results(q["question"], pool, ranker=reranker, k=k, budget_ms=budget_ms)
+        rerank_ms.append((time.perf_counter() - started) * 1000)
+        added_ms.append(pool_ms + rerank_ms[-1] - baseline_ms)
+
+        for name, docs in (("baseline", baseline), ("reranked", reranked)):
+            ids = [d["ID"] for d in docs]
+            results[name].append(ids.index(q["id"]) + 1 if q["id"] in ids else 0)
+            tokens[name].append(estimate_tokens(rag.build_prompt(q["question"], docs)))
+
+    print(f"Questions: {len(questions)} ({split} split), reranked top {k}, budget {budget_ms} ms")
+    for name, ranks in results.items():
+        ranks = np.array(ranks)
+        hit_rate = (ranks > 0).mean()
+        mrr = np.where(ranks > 0, 1 / np.maximum(ranks, 1), 0).mean()
+        print(f"{name:>9}: hit_rate={hit_rate:.4f} mrr={mrr:.4f} "
+              f"prompt_tokens={np.mean(tokens[name]):.0f}")
+    reduction = 1 - np.mean(tokens["reranked"]) / np.mean(tokens["baseline"])
+    print(f"Prompt token reduction: {reduction:.1%}")
+    print(f"Rerank stage: mean={np.mean(rerank_ms):.2f} ms p95={np.percentile(rerank_ms, 95):.2f} ms")
+    print(f"Added latency (pool search and rerank vs. top 10 search): "
+          f"mean={np.mean(added_ms):.2f} ms p95={np.percentile(added_ms, 95):.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the second-stage reranker")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--k", type=int, default=RERANK_TOP_K)
+    parser.add_argument("--budget-ms", type=float, default=RERANK_BUDGET_MS)
+    parser.add_argument("--split", choices=["train", "test", "all"], default="test")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train()
+    else:
+        evaluate(k=args.k, budget_ms=args.budget_ms, split=args.split)
@@ -0,0 +1,63 @@
+"""
+Cache for retrieval results.
+
+Keys are built from the query's token bag, not its raw text. TF-IDF
+ignores case, punctuation and word order, so "Squats for legs?" and
+"legs for squats" share an entry. The boosts, filters, number of results
+and index version are part of the key too, so rebuilding or reloading
+the index makes every old entry unreachable, and the catalogues of
+different tenants never share entries.
+"""
+import os
+import re
+
+import metrics
+from cache import LRUCache
+
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 8192))
+
+# The default token pattern of sklearn's TfidfVectorizer, which minsearch uses
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def token_bag(query):
+    """Sorted tokens of the query, duplicates kept because term counts matter to TF-IDF"""
+    return tuple(sorted(TOKEN_PATTERN.findall(query.lower())))
+
+
+def freeze(mapping):
+    """Hashable, order-independent form of a boost or filter dict"""
+    if not mapping:
+        return ()
+    return tuple(sorted((k, tuple(sorted(v)) if isinstance(v, (set, list, tuple)) else v)
+                        for k, v in mapping.items()))
+
+
+class RetrievalCache:
+    """
+    LRU cache of search results shared by the API and the evaluation code.
+
+    Args:
+        max_entries (int): Maximum number of cached result lists.
+        name (str): Prefix of the metrics exposed for this cache.
+    """
+
+    def __init__(self, max_entries=RETRIEVAL_CACHE_SIZE, name="retrieval_cache"):
+        self._cache = LRUCache(max_entries=max_entries)
+        metrics.set_gauge(f"{name}.hit_ratio", self._cache.hit_ratio)
+        metrics.set_gauge(f"{name}.hits", lambda: self._cache.hits)
+        metrics.set_gauge(f"{name}.misses", lambda: self._cache.misses)
+        metrics.set_gauge(f"{name}.saved_seconds", lambda: self._cache.saved_seconds)
+
+    def search(self, index_version, query, boost, search_fn, filters=None, num_results=10):
+        """Return search_fn() results for this query, computing them only on a miss"""
+        # Several catalogues (one per tenant) are served at once, so entries for other
+        # versions stay; those of a replaced index are unreachable and age out
+        key = (index_version, token_bag(query), freeze(boost), freeze(filters), num_results)
+        return list(self._cache.get_or_compute(key, search_fn))
+
+    def stats(self):
+        return self._cache.stats()
+
+    def clear(self):
+        self._cache.clear()
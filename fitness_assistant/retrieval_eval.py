@@ -0,0 +1,212 @@
+"""
+Batched evaluation of search quality on the retrieval ground truth.
+
+All questions are scored in one pass. Each text field's TF-IDF matrix for
+the questions is multiplied by the document matrix, the boosted sum gives
+a (questions x documents) score matrix, and argpartition turns it into a
+(questions x k) matrix of document ids. Facet constraints are applied as
+a mask, with the same fallback to unfiltered search as
+rag.minsearch_search_improved. Hit rate, MRR, recall@k and nDCG@k are
+then computed with NumPy, with bootstrap confidence intervals.
+
+Run it as a regression gate after changing the index, boosts or facets:
+
+    python retrieval_eval.py                                  # print metrics
+    python retrieval_eval.py --save-baseline     # to ../data/retrieval_baseline.json
+    python retrieval_eval.py --gate --tolerance 0.005
+"""
+import sys
+import csv
+import json
+import time
+import argparse
+
+import numpy as np
+
+import rag
+
+GROUND_TRUTH_PATH = "../data/ground-trunth-retrieval.csv"
+BASELINE_PATH = "../data/retrieval_baseline.json"
+GATED_METRICS = ["hit_rate", "mrr"]
+
+
+def load_ground_truth(path=GROUND_TRUTH_PATH):
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    return [row["question"] for row in rows], np.array([int(row["id"]) for row in rows])
+
+
+def score_matrix(questions, boost):
+    """(questions x documents) boosted TF-IDF scores, as computed by rag.score_candidates"""
+    index = rag.warmup()
+    scores = np.zeros((len(questions), len(index.docs)))
+    query_matrices = rag.query_analyser.matrices(questions)
+    for field, query_matrix in zip(index.text_fields, query_matrices):
+        scores += boost.get(field, 1) * (query_matrix @ index.text_matrices[field].T).toarray()
+    return scores
+
+
+def add_typos(questions, rate, seed=42):
+    """
+    Misspell a fraction of the words of four letters or more, to measure spelling tolerance.
+
+    Each chosen word gets one random edit: a deleted, doubled or replaced
+    letter, or two adjacent letters swapped.
+    """
+    rng = np.random.default_rng(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+
+    def misspell(word):
+        i = int(rng.integers(1, len(word) - 1))
+        edit = rng.integers(4)
+        if edit == 0:
+            return word[:i] + word[i + 1:]
+        if edit == 1:
+            return word[:i] + word[i] + word[i:]
+        if edit == 2:
+            return word[:i] + letters[rng.integers(26)] + word[i + 1:]
+        return word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]
+
+    return [" ".join(misspell(word) if len(word) >= 4 and word.isalpha() and rng.random() < rate else word
+                     for word in question.split())
+            for question in questions]
+
+
+def facet_mask(questions):
+    """Boolean (questions x documents) mask of the facet candidates; all True where unconstrained"""
+    rag.warmup()
+    mask = np.ones((len(questions), len(rag.index.docs)), dtype=bool)
+    for i, question in enumerate(questions):
+        candidates = rag.facet_index.candidates(rag.facet_index.extract(question))
+        if candidates is not None:
+            mask[i] = False
+            mask[i, candidates] = True
+    return mask
+
+
+def search_all(questions, boost=None, k=10, facets=True):
+    """
+    Top-k document ids for every question in one batched pass.
+
+    Returns:
+        np.ndarray: (questions x k) ids in rank order; -1 where fewer than k documents score above zero.
+    """
+    scores = score_matrix(questions, boost or rag.BOOST)
+    if facets:
+        filtered = np.where(facet_mask(questions), scores, 0.0)
+        # Like minsearch_search_improved: if the facets leave nothing, search unfiltered
+        scores = np.where((filtered > 0).any(axis=1, keepdims=True), filtered, scores)
+
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    doc_ids = np.array([doc["ID"] for doc in rag.index.docs])
+    return np.where(top_scores > 0, doc_ids[top], -1)
+
+
+def per_question_metrics(result_ids, relevant_ids, k=None):
+    """
+    Metric values for every question (one relevant document each).
+
+    Returns:
+        dict: metric name -> (questions,) array.
+    """
+    k = k or result_ids.shape[1]
+    relevance = result_ids[:, :k] == relevant_ids[:, None]
+    hit = relevance.any(axis=1)
+    rank = relevance.argmax(axis=1) + 1
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    return {
+        "hit_rate": hit.astype(float),
+        "mrr": np.where(hit, 1.0 / rank, 0.0),
+        f"recall@{k}": relevance.sum(axis=1).astype(float),  # one relevant document per question
+        f"ndcg@{k}": relevance @ discounts,  # the ideal DCG with one relevant document is 1
+    }
+
+
+def bootstrap_ci(values, n_resamples=1000, confidence=0.95, seed=42):
+    """Percentile bootstrap confidence interval of the mean"""
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(values), size=(n_resamples, len(values)))
+    means = values[samples].mean(axis=1)
+    alpha = (1 - confidence) / 2
+    return float(np.quantile(means, alpha)), float(np.quantile(means, 1 - alpha))
+
+
+def evaluate(questions, relevant_ids, boost=None, k=10, cutoffs=(1, 5, 10), facets=True,
+             n_resamples=1000):
+    """
+    Evaluate search on the ground truth.
+
+    Returns:
+        dict: metric name -> {"value", "ci_low", "ci_high"}.
+    """
+    result_ids = search_all(questions, boost=boost, k=k, facets=facets)
+    report = {}
+    for cutoff in [None, *cutoffs]:
+        for name, values in per_question_metrics(result_ids, relevant_ids, cutoff).items():
+            if name in report:
+                continue
+            low, high = bootstrap_ci(values, n_resamples) if n_resamples else (None, None)
+            report[name] = {"value": float(values.mean()), "ci_low": low, "ci_high": high}
+    return report
+
+
+def check_gate(report, baseline, tolerance):
+    """Names of the gated metrics that fell more than tolerance below the baseline"""
+    return [name for name in GATED_METRICS
+            if name in baseline and report[name]["value"] < baseline[name]["value"] - tolerance]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate search quality on the retrieval ground truth")
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--no-facets", action="store_true", help="Evaluate text scoring without facet filters")
+    parser.add_argument("--typos", type=float, default=0.0, metavar="RATE",
+                        help="Misspell this fraction of the longer words first (spelling tolerance)")
+    parser.add_argument("--resamples", type=int, default=1000, help="Bootstrap resamples (0 disables the CIs)")
+    parser.add_argument("--save-baseline", metavar="PATH", nargs="?", const=BASELINE_PATH,
+                        help="Write the metrics as the new baseline")
+    parser.add_argument("--gate", metavar="PATH", nargs="?", const=BASELINE_PATH,
+                        help="Fail if a metric regressed against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.005)
+    args = parser.parse_args()
+
+    questions, relevant_ids = load_ground_truth(args.ground_truth)
+    if args.typos:
+        questions = add_typos(questions, args.typos)
+    rag.warmup()
+    started = time.perf_counter()
+    report = evaluate(questions, relevant_ids, k=args.k, facets=not args.no_facets,
+                      n_resamples=args.resamples)
+    elapsed = time.perf_counter() - started
+
+    print(f"{len(questions)} questions evaluated in {elapsed * 1000:.0f} ms")
+    for name, metric in report.items():
+        ci = f"  [{metric['ci_low']:.4f}, {metric['ci_high']:.4f}]" if metric["ci_low"] is not None else ""
+        print(f"{name:>10}: {metric['value']:.4f}{ci}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[INFO] Baseline saved to {args.save_baseline}")
+
+    if args.gate:
+        with open(args.gate) as f:
+            baseline = json.load(f)
+        regressed = check_gate(report, baseline, args.tolerance)
+        for name in regressed:
+            print(f"[FAIL] {name} {report[name]['value']:.4f} < baseline {baseline[name]['value']:.4f}"
+                  f" - {args.tolerance}")
+        if regressed:
+            sys.exit(1)
+        print("[OK] No regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
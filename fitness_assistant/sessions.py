@@ -0,0 +1,207 @@
+"""
+Multi-turn conversation sessions.
+
+A session keeps a rolling summary plus the most recent turns. Answers are
+stored truncated. Once the turns outgrow the token budget, the oldest
+ones are folded into the summary, so the history added to a prompt stays
+bounded however long the conversation gets.
+
+Sessions are cached in an in-memory LRU and written through to the
+`sessions` table in Postgres. Every gunicorn worker has its own cache, so
+a cached session that was last loaded or saved more than
+SESSION_REVALIDATE_SECONDS ago is checked against the version stored in
+Postgres before it is used. Whatever the cache holds, a save only
+succeeds if nobody saved the session since it was read; when another
+worker won, the session is reloaded and the turn added to its version.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import db
+import metrics
+from rate_limit import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10_000))
+HISTORY_TOKEN_BUDGET = int(os.getenv("SESSION_HISTORY_TOKEN_BUDGET", 600))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SESSION_SUMMARY_TOKEN_BUDGET", 200))
+SESSION_REVALIDATE_SECONDS = float(os.getenv("SESSION_REVALIDATE_SECONDS", 5))
+RECENT_TURNS = 2
+ANSWER_CHARS = 400
+FOLLOW_UP_MAX_WORDS = 8
+SAVE_ATTEMPTS = 3
+
+# Openings that continue the previous question: "and for beginners?", "what about kettlebells?"
+FOLLOW_UP_OPENERS = [("and",), ("also",), ("or",), ("but",), ("same",),
+                     ("what", "about"), ("how", "about"), ("what", "else"), ("anything", "else")]
+# Words that refer back to the previous turn wherever they are: "is it safe?", "are those hard?"
+ANAPHORA = {"it", "its", "itself", "they", "them", "those", "these", "ones", "another", "alternative",
+            "alternatives", "instead"}
+# "this"/"that" refer back unless they open a relative clause ("exercises that target the glutes")
+DEMONSTRATIVES = {"this", "that"}
+RELATIVE_CLAUSE_VERBS = {"is", "are", "can", "will", "do", "does", "don", "doesn", "work", "works",
+                         "target", "targets", "help", "helps", "use", "uses", "build", "builds",
+                         "train", "trains", "hit", "hits", "strengthen", "strengthens", "improve",
+                         "improves", "need", "needs", "require", "requires"}
+
+
+def _history_tokens(session):
+    text = session["summary"] + " ".join(t["question"] + " " + t["answer"] for t in session["turns"])
+    return estimate_tokens(text)
+
+
+def is_follow_up(words):
+    """True if a question (as lowercase words) continues the previous one rather than standing alone"""
+    if not words or len(words) > FOLLOW_UP_MAX_WORDS:
+        return False
+    if any(tuple(words[:len(opener)]) == opener for opener in FOLLOW_UP_OPENERS):
+        return True
+    for i, word in enumerate(words):
+        if word in ANAPHORA:
+            return True
+        if word in DEMONSTRATIVES and (i == 0 or i == len(words) - 1
+                                       or words[i + 1] not in RELATIVE_CLAUSE_VERBS):
+            return True
+    return words[-1] == "one"  # "an easier one?"
+
+
+def rewrite_query(session, question):
+    """
+    Make a follow-up question self-contained for retrieval.
+
+    A short question that refers back to the previous turn ("and for
+    beginners?", "is it safe for my knees?") borrows the previous question,
+    so the search still finds the exercise the user is talking about.
+    Standalone questions ("what is a deadlift?") are searched as they are.
+    """
+    if session is None or not session["turns"]:
+        return question
+    if is_follow_up(re.findall(r"\w+", question.lower())):
+        return f"{session['turns'][-1]['question']} {question}"
+    return question
+
+
+def format_history(session):
+    """Render the summary and recent turns for the prompt, or '' for a new session"""
+    if session is None or (not session["summary"] and not session["turns"]):
+        return ""
+    lines = []
+    if session["summary"]:
+        lines.append(f"Summary of earlier conversation: {session['summary']}")
+    for turn in session["turns"]:
+        lines.append(f"User: {turn['question']}")
+        lines.append(f"Assistant: {turn['answer']}")
+    return "\n".join(lines)
+
+
+def fallback_summary(summary, turns):
+    """Summarise without an LLM by keeping the questions the user asked"""
+    asked = "; ".join(turn["question"] for turn in turns)
+    text = f"{summary} The user asked: {asked}".strip()
+    max_chars = SUMMARY_TOKEN_BUDGET * 4
+    return text[-max_chars:]
+
+
+class SessionStore:
+    """
+    LRU cache of sessions backed by Postgres.
+
+    Args:
+        max_sessions (int): Sessions kept in memory; the least recently used ones are dropped first.
+    """
+
+    def __init__(self, max_sessions=SESSION_CACHE_SIZE):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._turn_locks = {}
+        self._checked = {}  # session id -> when its cached version was last known to be current
+
+    def _remember(self, session):
+        """Cache a session just loaded or saved, so its version is current"""
+        with self._lock:
+            self._sessions[session["id"]] = session
+            self._sessions.move_to_end(session["id"])
+            self._checked[session["id"]] = time.monotonic()
+            while len(self._sessions) > self.max_sessions:
+                session_id, _ = self._sessions.popitem(last=False)
+                self._turn_locks.pop(session_id, None)
+                self._checked.pop(session_id, None)
+
+    def _turn_lock(self, session_id):
+        with self._lock:
+            return self._turn_locks.setdefault(session_id, threading.Lock())
+
+    def _load(self, session_id):
+        row = db.get_session(session_id)
+        if row is None:
+            return {"id": session_id, "summary": "", "turns": [], "version": 0}
+        return {"id": session_id, "summary": row["summary"], "turns": row["turns"], "version": row["version"]}
+
+    def get_or_create(self, session_id):
+        """Return the session with this id, loading it from Postgres or creating it"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                checked = self._checked.get(session_id, 0)
+
+        if session is not None:
+            if time.monotonic() - checked < SESSION_REVALIDATE_SECONDS:
+                return session
+            # Another worker may have added turns since this one cached the session
+            if (db.get_session_version(session_id) or 0) == session["version"]:
+                with self._lock:
+                    self._checked[session_id] = time.monotonic()
+                return session
+            metrics.inc("sessions.stale")
+        session = self._load(session_id)
+        self._remember(session)
+        return session
+
+    def _with_turn(self, session, question, answer, summarise):
+        """The summary and turns of `session` after adding a turn, compressed if over budget"""
+        summary = session["summary"]
+        turns = session["turns"] + [{"question": question, "answer": answer[:ANSWER_CHARS]}]
+
+        if _history_tokens({"summary": summary, "turns": turns}) > HISTORY_TOKEN_BUDGET \
+                and len(turns) > RECENT_TURNS:
+            old_turns = turns[:-RECENT_TURNS]
+            try:
+                summary = (summarise or fallback_summary)(summary, old_turns)
+            except Exception as e:
+                logger.warning(f"Session summarisation failed, using fallback: {e}")
+                summary = fallback_summary(summary, old_turns)
+            summary = summary[:SUMMARY_TOKEN_BUDGET * 4]
+            turns = turns[-RECENT_TURNS:]
+        return summary, turns
+
+    def add_turn(self, session, question, answer, summarise=None):
+        """
+        Record a turn, compress the history if it is over budget, and persist the session.
+
+        The save is conditional on the version the session was read at. If
+        another worker saved it first, the session is reloaded and the turn
+        added again on top, up to SAVE_ATTEMPTS times.
+
+        Args:
+            summarise: Callable (summary, turns) -> new summary; defaults to fallback_summary.
+        """
+        with self._turn_lock(session["id"]):
+            for _ in range(SAVE_ATTEMPTS):
+                summary, turns = self._with_turn(session, question, answer, summarise)
+                version = db.save_session(session["id"], summary, turns, session["version"])
+                if version is not None:
+                    session.update(summary=summary, turns=turns, version=version)
+                    break
+                metrics.inc("sessions.conflicts")
+                fresh = self._load(session["id"])
+                session.update(summary=fresh["summary"], turns=fresh["turns"], version=fresh["version"])
+            else:
+                logger.warning(f"Session {session['id']} kept changing, turn not saved")
+        self._remember(session)
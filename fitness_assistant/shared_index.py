@@ -0,0 +1,231 @@
+"""
+Search index in a memory-mapped file, shared by all workers on a host.
+
+A fitted minsearch.Index keeps its state in Python objects: TF-IDF
+vectorizers with dict vocabularies, sparse matrices and the document list.
+Every process that builds or unpickles one holds a private copy. Here the
+numeric state is written once as flat arrays into a single file:
+
+- the CSR data, indices and indptr of every text field,
+- the IDF vector of every field,
+- the vocabulary of every field, as a sorted fixed-width byte array,
+- the document ids, and the documents as one JSON blob,
+- the query analysis tables (query_analysis.build_tables()): stems,
+  document frequencies and the spelling-correction delete index.
+
+Workers mmap the file read-only and wrap the arrays without copying, so
+N workers share one physical copy through the page cache. Vocabulary
+lookups are a binary search (np.searchsorted) over the sorted terms,
+with no per-worker dict. Queries are vectorised the way the fitted
+TfidfVectorizer does it (lowercase, tokens of two or more word
+characters, raw counts times IDF, L2-normalised). SharedIndex exposes the
+attributes rag uses (text_fields, vectorizers, text_matrices, docs), so
+it can stand in for minsearch.Index.
+
+Set SHARED_INDEX_PATH (e.g. /dev/shm/fitness-index.bin) to use it. The
+file is rebuilt when the catalogue CSV changes.
+"""
+import os
+import re
+import json
+import mmap
+import fcntl
+import struct
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import query_analysis
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FITIDX02"
+ALIGNMENT = 64
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")  # TfidfVectorizer's default token_pattern
+
+
+def source_fingerprint(data_path):
+    """Identifies one version of the catalogue CSV"""
+    stat = os.stat(data_path)
+    return {"path": os.path.abspath(data_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write(index, path, source=None):
+    """
+    Write a fitted minsearch.Index to path as flat arrays.
+
+    The file is written next to path and renamed into place, so readers
+    never see a partial file.
+    """
+    arrays = {}
+    for field in index.text_fields:
+        vectorizer = index.vectorizers[field]
+        terms = sorted(vectorizer.vocabulary_, key=lambda term: term.encode())
+        # Columns follow the sorted vocabulary, so a term's position is its column
+        new_column = np.empty(len(terms), dtype=np.int32)
+        for position, term in enumerate(terms):
+            new_column[vectorizer.vocabulary_[term]] = position
+        matrix = index.text_matrices[field].tocsr()
+        remapped = csr_matrix((matrix.data, new_column[matrix.indices], matrix.indptr), shape=matrix.shape)
+        remapped.sort_indices()
+        idf = np.empty(len(terms))
+        idf[new_column] = vectorizer.idf_
+        width = max((len(term.encode()) for term in terms), default=1)
+        arrays[f"{field}.data"] = remapped.data.astype(np.float64)
+        arrays[f"{field}.indices"] = remapped.indices.astype(np.int32)
+        arrays[f"{field}.indptr"] = remapped.indptr.astype(np.int32)
+        arrays[f"{field}.idf"] = idf
+        arrays[f"{field}.vocab"] = np.array([term.encode() for term in terms], dtype=f"S{width}")
+    arrays["doc_ids"] = np.array([doc["ID"] for doc in index.docs], dtype=np.int64)
+    arrays["docs"] = np.frombuffer(json.dumps(index.docs).encode(), dtype=np.uint8)
+    # Built against the sorted columns, as the workers will read them
+    for name, array in query_analysis.build_tables(_Remapped(index, arrays)).items():
+        arrays[f"analysis.{name}"] = array
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({
+        "text_fields": list(index.text_fields),
+        "keyword_fields": list(index.keyword_fields),
+        "n_docs": len(index.docs),
+        "source": source,
+        "arrays": layout,
+    }).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class _Remapped:
+    """The sorted-column view of an index that write() is about to store"""
+
+    def __init__(self, index, arrays):
+        self.text_fields = index.text_fields
+        self.vectorizers = {field: SharedVectorizer(arrays[f"{field}.vocab"], arrays[f"{field}.idf"])
+                            for field in index.text_fields}
+        self.text_matrices = {
+            field: csr_matrix((arrays[f"{field}.data"], arrays[f"{field}.indices"], arrays[f"{field}.indptr"]),
+                              shape=(len(index.docs), len(arrays[f"{field}.vocab"])))
+            for field in index.text_fields
+        }
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a shared index file")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(header_len)), len(MAGIC) + 8 + header_len
+
+
+class SharedVectorizer:
+    """
+    Read-only TF-IDF vectorizer over a sorted vocabulary array.
+
+    transform() gives the same vectors as the fitted TfidfVectorizer.
+    """
+
+    def __init__(self, vocab, idf):
+        self.vocab = vocab
+        self.idf = idf
+        self.width = vocab.dtype.itemsize
+
+    def columns(self, tokens):
+        """Vocabulary columns of the tokens that are in the vocabulary"""
+        encoded = [token.encode() for token in tokens]
+        candidates = np.array([t for t in encoded if len(t) <= self.width], dtype=self.vocab.dtype)
+        if len(candidates) == 0 or len(self.vocab) == 0:
+            return np.empty(0, dtype=np.int64)
+        positions = np.searchsorted(self.vocab, candidates)
+        positions[positions == len(self.vocab)] = 0
+        return positions[self.vocab[positions] == candidates]
+
+    def transform(self, texts):
+        indptr = [0]
+        indices = []
+        data = []
+        for text in texts:
+            columns, counts = np.unique(self.columns(TOKEN_PATTERN.findall(str(text).lower())),
+                                        return_counts=True)
+            weights = counts * self.idf[columns]
+            norm = np.sqrt(weights @ weights)
+            indices.append(columns)
+            data.append(weights / norm if norm else weights)
+            indptr.append(indptr[-1] + len(columns))
+        return csr_matrix((np.concatenate(data) if data else np.empty(0),
+                           np.concatenate(indices) if indices else np.empty(0, dtype=np.int64),
+                           np.array(indptr)), shape=(len(texts), len(self.vocab)))
+
+
+class SharedIndex:
+    """
+    Index attached to a shared index file; the arrays are views of the mapping.
+
+    Args:
+        path (str): File written by write().
+    """
+
+    def __init__(self, path):
+        header, header_end = read_header(path)
+        data_start = -(-header_end // ALIGNMENT) * ALIGNMENT
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def array(name):
+            spec = header["arrays"][name]
+            count = int(np.prod(spec["shape"])) if spec["shape"] else 1
+            return np.frombuffer(self._mmap, dtype=np.dtype(spec["dtype"]), count=count,
+                                 offset=data_start + spec["offset"]).reshape(spec["shape"])
+
+        self.path = path
+        self.source = header["source"]
+        self.text_fields = header["text_fields"]
+        self.keyword_fields = header["keyword_fields"]
+        self.doc_ids = array("doc_ids")
+        self.docs = json.loads(array("docs").tobytes())
+        self.analysis_tables = {name[len("analysis."):]: array(name)
+                                for name in header["arrays"] if name.startswith("analysis.")}
+        self.vectorizers = {}
+        self.text_matrices = {}
+        for field in self.text_fields:
+            vectorizer = SharedVectorizer(array(f"{field}.vocab"), array(f"{field}.idf"))
+            self.vectorizers[field] = vectorizer
+            self.text_matrices[field] = csr_matrix(
+                (array(f"{field}.data"), array(f"{field}.indices"), array(f"{field}.indptr")),
+                shape=(header["n_docs"], len(vectorizer.vocab)), copy=False)
+
+    def nbytes(self):
+        return len(self._mmap)
+
+
+def load(data_path, path, build):
+    """
+    Attach to the shared index for data_path, building the file first if it is missing or stale.
+
+    Args:
+        build (callable): Returns a fitted minsearch.Index for data_path.
+    """
+    source = source_fingerprint(data_path)
+    # Only one process builds; the others wait on the lock and then attach to its file
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            stale = not os.path.exists(path) or read_header(path)[0]["source"] != source
+        except (ValueError, OSError, KeyError) as e:
+            logger.warning(f"Unreadable shared index {path} ({e}), rebuilding")
+            stale = True
+        if stale:
+            write(build(data_path), path, source)
+            logger.info(f"Shared index written to {path}")
+    return SharedIndex(path)
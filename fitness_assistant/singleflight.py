@@ -0,0 +1,250 @@
+"""
+Single-flight execution: concurrent calls with the same key share one computation.
+
+Within a process the first caller (the leader) runs the function and
+every duplicate waits for its result. When a shared directory is given,
+leaders in different gunicorn workers also coordinate: they take a
+flock on a lock file of their key, and the winner publishes its result as
+a JSON file for the others to pick up.
+
+Followers wait within their own request deadline and stop at once when
+their client disconnects. While they wait they do no work, so they give
+their admission slot back, and take one again before computing themselves
+(after a cross-worker leader failed or took too long).
+
+The leader computes under its own deadline. An outcome shaped by that
+deadline (a DeadlineExceeded, or what deadline_bound flags, such as a
+degraded answer) is not handed to followers whose deadline ends later:
+they run again, coalescing among themselves, and such outcomes are not
+published to other workers.
+"""
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+
+import metrics
+import admission
+import deadlines
+
+logger = logging.getLogger(__name__)
+
+WAIT_POLL_SECONDS = 0.05
+# A follower runs a deadline-bound outcome again only with this much more time than the leader had
+RECOMPUTE_MIN_EXTRA_SECONDS = 1.0
+
+
+def normalise_question(question):
+    """Lowercase, drop punctuation and collapse whitespace so trivial variants share a key"""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.deadline = deadlines.current()
+
+
+def _deadline_exceeded(result, error):
+    return isinstance(error, deadlines.DeadlineExceeded)
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls by key.
+
+    Args:
+        shared_dir (str): Directory for cross-worker coordination (e.g. under /dev/shm). None keeps it in-process.
+        wait_timeout (float): Seconds a cross-worker follower waits for another worker before computing itself.
+        result_ttl (float): Seconds a published cross-worker result stays on disk.
+    """
+
+    def __init__(self, shared_dir=None, wait_timeout=30.0, result_ttl=5.0):
+        self.shared_dir = shared_dir
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def do(self, key, fn, deadline_bound=None):
+        """
+        Run fn() once for all concurrent callers with the same key.
+
+        Args:
+            deadline_bound (callable): deadline_bound(result, error) tells whether an outcome
+                depended on the leader's deadline; by default only DeadlineExceeded does.
+        Returns:
+            tuple: (result, shared) where shared is True if the result came from another caller.
+        Raises:
+            DeadlineExceeded: If the request deadline passes while waiting.
+            ClientDisconnected: If the client disconnects while waiting.
+            Overloaded: If a follower that has to compute itself gets no admission slot back.
+        """
+        deadline_bound = deadline_bound or _deadline_exceeded
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.inc("singleflight.coalesced")
+            # Waiting is no work, so the slot goes to a request that has some
+            admission.release_slot()
+            self._wait(call.done.is_set, call.done.wait, "single-flight wait")
+            # A leader that got no slot back, or ran out of time when this caller has more,
+            # says nothing about this caller's outcome, so it runs again
+            if isinstance(call.error, admission.Overloaded) or \
+                    (deadline_bound(call.result, call.error) and self._outlives(call.deadline)):
+                metrics.inc("singleflight.recomputed")
+                return self.do(key, fn, deadline_bound)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        metrics.inc("singleflight.leaders")
+        try:
+            # A follower that became leader gave its slot back while waiting
+            with admission.readmit():
+                if self.shared_dir:
+                    call.result, shared = self._do_shared(key, fn, deadline_bound)
+                else:
+                    call.result, shared = fn(), False
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @staticmethod
+    def _outlives(leader_deadline):
+        """True if the current request's deadline ends clearly after the leader's"""
+        if leader_deadline is None:
+            return False
+        mine = deadlines.current()
+        return mine is None or mine.expires_at - leader_deadline.expires_at >= RECOMPUTE_MIN_EXTRA_SECONDS
+
+    def _wait(self, ready, sleep, stage, limit=None):
+        """
+        Wait until ready() within the request deadline, checking for a disconnected client.
+
+        Args:
+            sleep (callable): Blocks for up to the given seconds (returning early once ready is fine).
+            limit (float): Seconds after which to give up and return False; None waits for the deadline.
+        Returns:
+            bool: Whether ready() became true.
+        """
+        started = time.monotonic()
+        while not ready():
+            admission.cancel_point(stage)
+            deadlines.check(stage)
+            if limit is not None and time.monotonic() - started >= limit:
+                return False
+            sleep(deadlines.timeout(WAIT_POLL_SECONDS))
+        return True
+
+    def _do_shared(self, key, fn, deadline_bound):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        # One lock file per key, so unrelated questions never wait for each other
+        lock_path = os.path.join(self.shared_dir, f"{digest}.lock")
+        result_path = os.path.join(self.shared_dir, f"{digest}.json")
+        started = time.time()
+
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is computing the same key; wait for it
+                admission.release_slot()
+                if self._wait_for_lock(fd):
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    result = self._read_result(result_path, started)
+                    if result is not None:
+                        metrics.inc("singleflight.coalesced_cross_worker")
+                        return result, True
+                # The other worker failed or is too slow; compute with a slot of our own
+                with admission.readmit():
+                    return fn(), False
+
+            try:
+                result = fn()
+            except Exception:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                self._remove_lock(lock_path)
+                raise
+            try:
+                if not deadline_bound(result, None):
+                    self._publish(result_path, result)
+                return result, False
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _wait_for_lock(self, fd):
+        def locked():
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                return False
+
+        return self._wait(locked, time.sleep, "single-flight wait", limit=self.wait_timeout)
+
+    def _read_result(self, path, not_before):
+        try:
+            if os.path.getmtime(path) < not_before:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _publish(self, path, result):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Could not publish single-flight result: {e}")
+            return
+        timer = threading.Timer(self.result_ttl, self._remove, args=(path,))
+        timer.daemon = True
+        timer.start()
+
+    def _remove(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) >= self.result_ttl:
+                os.remove(path)
+        except OSError:
+            pass
+        self._remove_lock(path[:-len(".json")] + ".lock")
+
+    def _remove_lock(self, lock_path):
+        # Drop the key's lock file unless a leader holds it. A worker that opened it
+        # just before may still lock the removed file; at worst it computes on its own.
+        try:
+            fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(lock_path)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,361 @@
+"""
+Write-ahead spool for conversation and feedback rows.
+
+/ask and /feedback never write to Postgres themselves. Each row is appended
+as a JSON line to a local spool file, and a background shipper inserts the
+rows into Postgres in bulk. While Postgres is slow or down, requests still
+succeed and the rows wait on disk; they are shipped once the database
+answers again.
+
+- Appends are group-committed: a writer thread fsyncs the file at most
+  every SPOOL_FSYNC_INTERVAL seconds, and append() returns once its record
+  is on disk.
+- Each process writes its own segment files in SPOOL_DIR:
+  <owner>-<seq>.active while being written, <owner>-<seq>.ready once
+  closed. The owner holds a flock on <owner>.lock for its lifetime.
+  Segments of an owner whose lock is free (a worker that died or was
+  recycled) are adopted by the next shipper that looks.
+- The shipper closes the active segment, ships the ready segments oldest
+  first, up to SPOOL_BATCH_SIZE rows per transaction, and deletes each one
+  once it is shipped, SPOOL_SHIP_INTERVAL after the first append it has
+  not shipped yet. Inserts are idempotent: conversations are keyed on
+  their id, and feedback on its event_id. A segment that fails half way is
+  simply shipped again. Failures back off from 1 s up to SPOOL_MAX_BACKOFF.
+- Feedback can reach the shipper before its conversation row, when the
+  conversation is spooled by another worker. That feedback is written to
+  a <owner>-<seq>.delayed segment and retried with a per-record backoff
+  (1 s doubling up to SPOOL_MAX_BACKOFF) for up to
+  SPOOL_FEEDBACK_RETRY_SECONDS.
+- Creating and renaming segments is followed by an fsync of SPOOL_DIR, so
+  a crash cannot lose a segment that appends were acknowledged in.
+
+Set SPOOL_DIR to an empty string to write to Postgres directly.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "../data/spool")
+SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", 0.005))
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", 500))
+SPOOL_SHIP_INTERVAL = float(os.getenv("SPOOL_SHIP_INTERVAL", 0.5))
+SPOOL_MAX_BACKOFF = float(os.getenv("SPOOL_MAX_BACKOFF", 30))
+SPOOL_FEEDBACK_RETRY_SECONDS = float(os.getenv("SPOOL_FEEDBACK_RETRY_SECONDS", 600))
+SPOOL_APPEND_TIMEOUT = 5
+FEEDBACK_RETRY_DELAY = 1.0
+
+
+class SpoolError(Exception):
+    """Raised when a record could not be made durable in time"""
+
+
+def enabled():
+    return bool(SPOOL_DIR)
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def fsync_directory(path):
+    """Make file creations and renames in a directory durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def retry_delay(attempts):
+    """Seconds before the next attempt to ship a feedback record that has failed `attempts` times"""
+    return min(FEEDBACK_RETRY_DELAY * 2 ** (attempts - 1), SPOOL_MAX_BACKOFF)
+
+
+def read_segment(path):
+    """Records of a segment; a line torn by a crash mid-append is skipped"""
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping a torn record in {path}")
+    return records
+
+
+class Spool:
+    """
+    This process's append-only spool files and the thread shipping them to Postgres.
+
+    Args:
+        directory (str): Where the segment files are kept.
+        ship (callable): Inserts (conversations, feedback) and returns the
+            event_ids of feedback whose conversation is not in the database.
+    """
+
+    def __init__(self, directory=SPOOL_DIR, ship=None, fsync_interval=SPOOL_FSYNC_INTERVAL,
+                 batch_size=SPOOL_BATCH_SIZE):
+        self.directory = directory
+        self.ship = ship or _ship_to_db
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        os.makedirs(directory, exist_ok=True)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._owner_lock = open(os.path.join(directory, f"{self.owner}.lock"), "w")
+        fcntl.flock(self._owner_lock, fcntl.LOCK_EX)
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._seq = 0
+        self._fd = None
+        self._active_path = None
+        self._active_records = 0
+        self._written = 0  # appends made, and appends fsynced, since start
+        self._synced = 0
+        self._closed = False
+        self.depth = 0  # records of this process not yet shipped
+        self.healthy = True
+        self._delayed = {}  # path of a .delayed segment -> when its first record is due
+        self._wake = threading.Event()
+        self._open_segment()
+        self._flusher = threading.Thread(target=self._flush_loop, name="spool-fsync", daemon=True)
+        self._flusher.start()
+        self._shipper = threading.Thread(target=self._ship_loop, name="spool-shipper", daemon=True)
+        self._shipper.start()
+
+    def _segment_path(self, seq, state):
+        return os.path.join(self.directory, f"{self.owner}-{seq:08d}.{state}")
+
+    def _open_segment(self):
+        self._seq += 1
+        self._active_path = self._segment_path(self._seq, "active")
+        self._fd = os.open(self._active_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fsync_directory(self.directory)
+        self._active_records = 0
+
+    def append(self, records, timeout=SPOOL_APPEND_TIMEOUT):
+        """
+        Append records (dicts with a "type") and return once they are on disk.
+
+        Raises:
+            SpoolError: If the spool is closed, or the fsync did not happen within timeout seconds.
+        """
+        data = b"".join(json.dumps(record, default=str).encode() + b"\n" for record in records)
+        with self._cond:
+            if self._closed:
+                raise SpoolError("Spool is closed")
+            os.write(self._fd, data)
+            self._active_records += len(records)
+            self.depth += len(records)
+            self._written += 1
+            target = self._written
+            self._cond.notify_all()
+            # Group commit: one fsync by the flusher covers every append made meanwhile
+            if not self._cond.wait_for(lambda: self._synced >= target, timeout):
+                raise SpoolError(f"Spool fsync took more than {timeout}s")
+        metrics.inc("spool.appended", len(records))
+        self._wake.set()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._written > self._synced or self._closed)
+                if self._closed:
+                    return
+            # Let concurrent appends join this fsync
+            time.sleep(self.fsync_interval)
+            with self._cond:
+                if self._closed:
+                    return
+                target = self._written
+                try:
+                    os.fsync(self._fd)
+                except OSError as e:
+                    # Appenders time out with SpoolError; the next round tries again
+                    logger.error(f"Spool fsync failed: {e}")
+                    continue
+                self._synced = target
+                self._cond.notify_all()
+
+    def _rotate(self):
+        """Close the active segment if it has records, making it ready to ship"""
+        with self._cond:
+            if self._closed or self._active_records == 0:
+                return
+            os.fsync(self._fd)
+            self._synced = self._written
+            os.close(self._fd)
+            os.rename(self._active_path, self._segment_path(self._seq, "ready"))
+            self._open_segment()  # fsyncs the directory, covering the rename too
+
+    def _adopt_orphans(self):
+        """Take over the segments of owners whose process has gone"""
+        owners = {name[:-len(".lock")] for name in os.listdir(self.directory) if name.endswith(".lock")}
+        for owner in owners - {self.owner}:
+            lock_path = os.path.join(self.directory, f"{owner}.lock")
+            try:
+                lock = open(lock_path, "a")
+            except OSError:
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still alive
+                for name in sorted(os.listdir(self.directory)):
+                    if name.startswith(f"{owner}-") and name.endswith((".active", ".ready", ".delayed")):
+                        with self._cond:
+                            self._seq += 1
+                            adopted = self._segment_path(self._seq, "ready")
+                        os.rename(os.path.join(self.directory, name), adopted)
+                        records = len(read_segment(adopted))
+                        with self._cond:
+                            self.depth += records
+                        logger.info(f"Adopted {records} spooled records from {name}")
+                fsync_directory(self.directory)
+                os.unlink(lock_path)
+
+    def _ready_segments(self):
+        """Ready segments, and delayed ones whose first record is due, oldest first"""
+        prefix = f"{self.owner}-"
+        ready = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.startswith(prefix) and name.endswith(".ready")]
+        current_time = time.time()
+        ready += [path for path, due in list(self._delayed.items()) if due <= current_time]
+        return sorted(ready)
+
+    def _ship_segment(self, path):
+        records = read_segment(path)
+        # Feedback retried too recently waits in a delayed segment again, without a round trip
+        current_time = time.time()
+        due = [r for r in records if r.get("next_attempt", 0) <= current_time]
+        waiting = [r for r in records if r.get("next_attempt", 0) > current_time]
+        retry = []
+        for start in range(0, len(due), self.batch_size):
+            batch = due[start:start + self.batch_size]
+            conversations = [r for r in batch if r["type"] == "conversation"]
+            feedback = [r for r in batch if r["type"] == "feedback"]
+            missing = set(self.ship(conversations, feedback))
+            retry.extend(r for r in feedback if r["event_id"] in missing)
+            metrics.inc("spool.shipped", len(batch) - len(missing))
+        self._delay(self._retryable(retry) + waiting)
+        os.unlink(path)
+        self._delayed.pop(path, None)
+        with self._cond:
+            self.depth -= len(records)
+
+    def _retryable(self, feedback):
+        """Feedback to retry later, with its next attempt time; feedback that is too old is dropped"""
+        keep = []
+        for record in feedback:
+            age = (datetime.now(timezone.utc) - datetime.fromisoformat(record["timestamp"])).total_seconds()
+            if age < SPOOL_FEEDBACK_RETRY_SECONDS:
+                attempts = record.get("attempts", 0) + 1
+                keep.append(dict(record, attempts=attempts, next_attempt=time.time() + retry_delay(attempts)))
+            else:
+                metrics.inc("spool.feedback_dropped")
+                logger.warning(f"Dropping feedback {record['event_id']}: conversation "
+                               f"{record['conversation_id']} not found")
+        return keep
+
+    def _delay(self, records):
+        """Write records to a new delayed segment, shipped once the first of them is due"""
+        if not records:
+            return
+        with self._cond:
+            self._seq += 1
+            path = self._segment_path(self._seq, "delayed")
+        with open(path, "wb") as f:
+            f.write(b"".join(json.dumps(record, default=str).encode() + b"\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        fsync_directory(self.directory)
+        self._delayed[path] = min(record["next_attempt"] for record in records)
+        with self._cond:
+            self.depth += len(records)
+
+    def ship_pending(self):
+        """Ship everything spooled so far; raises if Postgres fails"""
+        self._rotate()
+        for path in self._ready_segments():
+            self._ship_segment(path)
+
+    def _ship_loop(self):
+        backoff = 0
+        while True:
+            if backoff:
+                time.sleep(backoff)
+            else:
+                # Woken by appends; let a few more arrive so they ship in one batch
+                if self._wake.wait(1.0):
+                    time.sleep(SPOOL_SHIP_INTERVAL)
+            self._wake.clear()
+            if self._closed:
+                return
+            try:
+                self._adopt_orphans()
+                self.ship_pending()
+            except Exception as e:
+                if self.healthy:
+                    logger.warning(f"Shipping the spool failed, will retry: {e}")
+                self.healthy = False
+                metrics.inc("spool.ship_failures")
+                backoff = min(max(backoff * 2, 1.0), SPOOL_MAX_BACKOFF)
+            else:
+                self.healthy = True
+                backoff = 0
+
+    def close(self):
+        """Sync and close the active segment; the next process adopts what was not shipped"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._cond.notify_all()
+        self._wake.set()
+        self._owner_lock.close()
+
+
+def conversation_record(conversation_id, **columns):
+    return dict(columns, type="conversation", id=conversation_id, timestamp=now())
+
+
+def feedback_record(conversation_id, feedback, event_id=None):
+    return {"type": "feedback", "event_id": event_id or str(uuid.uuid4()),
+            "conversation_id": conversation_id, "feedback": feedback, "timestamp": now()}
+
+
+def _ship_to_db(conversations, feedback):
+    import db
+    return db.save_spooled(conversations, feedback)
+
+
+_spool = None
+_spool_pid = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """Return this process's spool, created on first use so it is never inherited across a fork"""
+    global _spool, _spool_pid
+    if _spool is None or _spool_pid != os.getpid():
+        with _spool_lock:
+            if _spool is None or _spool_pid != os.getpid():
+                _spool = Spool()
+                _spool_pid = os.getpid()
+                atexit.register(_spool.close)
+                metrics.set_gauge("spool.depth", lambda: _spool.depth)
+                metrics.set_gauge("spool.healthy", lambda: _spool.healthy)
+    return _spool
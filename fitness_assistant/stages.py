@@ -0,0 +1,164 @@
+"""
+Run the stages of one request as a small dependency graph.
+
+A stage is a function with the names of the stages it needs. The results of
+those stages are passed to it as arguments, in the order of its deps.
+Stages whose dependencies are met run at the same time:
+
+    graph = stages.StageGraph("ask")
+    graph.add("db.connect", db.get_pool().prepare)
+    graph.add("rag", lambda: rag(question))
+    graph.add("db.save", save, deps=["rag", "db.connect"])
+    results = graph.run()
+    graph.critical_path()    # (["rag", "db.save"], 1.93)
+
+The calling thread runs one ready stage itself and hands the others to a
+shared pool of STAGE_WORKERS threads. If the caller has nothing left to do
+and a stage it handed off has not started yet, it takes the stage back and
+runs it. A graph therefore never waits on a full pool, even when graphs
+are nested (rag's graph runs inside /ask's). Each stage runs in a copy of
+the caller's context, so it sees the same trace, deadline and disconnect
+probe; spans it opens are children of the caller's span.
+
+After run(), critical_path() returns the chain of stages that set the
+total time, and timings() returns when each stage started and how long it
+ran.
+"""
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", 8))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the process-wide stage pool, created on first use so it is never inherited across a fork"""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+                _executor_pid = os.getpid()
+    return _executor
+
+
+class Stage:
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.start = None
+        self.end = None
+
+
+class StageGraph:
+    """
+    Stages of one request, run concurrently where their dependencies allow.
+
+    Args:
+        name (str): Prefix of the critical_path metrics.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.results = {}
+        self._started = None
+
+    def add(self, name, fn, deps=()):
+        """Add a stage; fn is called with the results of deps, in order"""
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = Stage(name, fn, deps)
+
+    def _run_stage(self, stage):
+        stage.start = time.perf_counter()
+        try:
+            return stage.fn(*[self.results[dep] for dep in stage.deps])
+        finally:
+            stage.end = time.perf_counter()
+
+    def _submit(self, stage):
+        context = contextvars.copy_context()
+        return get_executor().submit(context.run, self._run_stage, stage)
+
+    def run(self):
+        """
+        Run every stage and return {stage name: result}.
+
+        Raises:
+            Exception: The first error raised by a stage; stages that depend on it do not run.
+        """
+        self._started = time.perf_counter()
+        pending = dict(self.stages)
+        running = {}  # future -> stage
+        try:
+            while True:
+                for future in [f for f in running if f.done()]:
+                    self.results[running.pop(future).name] = future.result()
+                if not pending and not running:
+                    break
+                ready = [s for s in pending.values() if all(d in self.results for d in s.deps)]
+                for stage in ready:
+                    del pending[stage.name]
+                for stage in ready[1:]:
+                    running[self._submit(stage)] = stage
+                if ready:
+                    self.results[ready[0].name] = self._run_stage(ready[0])
+                    continue
+                if not running:
+                    raise RuntimeError(f"Stages {sorted(pending)} have unmet dependencies")
+                # Nothing to do here: take back a handed-off stage that has not started, or wait
+                for future, stage in list(running.items()):
+                    if future.cancel():
+                        del running[future]
+                        self.results[stage.name] = self._run_stage(stage)
+                        break
+                else:
+                    wait(running, return_when=FIRST_COMPLETED)
+        finally:
+            for future in running:
+                future.cancel()
+        self._report()
+        return self.results
+
+    def timings(self):
+        """{stage: {"start": seconds after run() began, "duration": seconds}} of the stages that ran"""
+        return {
+            stage.name: {"start": stage.start - self._started, "duration": stage.end - stage.start}
+            for stage in self.stages.values() if stage.end is not None
+        }
+
+    def critical_path(self):
+        """
+        The chain of stages that set the total time, and its length in seconds.
+
+        It starts from the stage that finished last and follows, at each
+        step, the dependency that finished last.
+        """
+        finished = [stage for stage in self.stages.values() if stage.end is not None]
+        if not finished:
+            return [], 0.0
+        stage = max(finished, key=lambda s: s.end)
+        path = [stage]
+        while stage.deps:
+            stage = max((self.stages[dep] for dep in stage.deps), key=lambda s: s.end)
+            path.append(stage)
+        path.reverse()
+        return [s.name for s in path], path[-1].end - self._started
+
+    def _report(self):
+        path, _ = self.critical_path()
+        for name in path:
+            stage = self.stages[name]
+            metrics.inc(f"critical_path.{self.name}.{name}")
+            metrics.inc(f"critical_path.{self.name}.{name}.seconds", stage.end - stage.start)
@@ -0,0 +1,242 @@
+"""
+Lightweight per-request tracing.
+
+A trace is a tree of spans (name, start and end time, attributes) kept on a
+context variable, so code deep in the call stack can open a span without
+passing the trace around:
+
+    with tracing.start_trace("ask"):
+        with tracing.span("retrieval") as span:
+            span.set_attribute("hits", len(results))
+        span.duration   # seconds
+
+Spans are always timed (two perf_counter calls each), so stage durations
+can be stored with every conversation. Only a sampled fraction of requests
+(TRACE_SAMPLE_RATE) get a trace that records the spans; outside a trace a
+span is timed and nothing else. Traces are converted to OTLP/JSON and
+written by a background thread, either as JSON lines to TRACE_EXPORT_FILE or POSTed to an
+OTLP/HTTP collector at TRACE_EXPORT_URL (e.g. http://localhost:4318/v1/traces).
+"""
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.0))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+TRACE_EXPORT_URL = os.getenv("TRACE_EXPORT_URL")
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "fitness-assistant")
+EXPORT_QUEUE_SIZE = 1000
+EXPORT_BATCH_SIZE = 50
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, span_id, parent_id, attributes=None):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration = time.perf_counter() - self._start
+
+
+class Trace:
+    """
+    The spans of one request.
+
+    Args:
+        name (str): Name of the root span.
+        attributes (dict): Attributes of the root span.
+    """
+
+    def __init__(self, name, attributes=None):
+        self.trace_id = random.getrandbits(128)
+        self.spans = []
+        self.root = self.new_span(name, None, attributes)
+
+    def new_span(self, name, parent, attributes=None):
+        span = Span(name, random.getrandbits(64), parent.span_id if parent else None, attributes)
+        self.spans.append(span)
+        return span
+
+    def to_otlp(self):
+        """The trace as an OTLP/JSON ExportTraceServiceRequest"""
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [self._otlp_span(span) for span in self.spans if span.duration is not None],
+            }],
+        }]}
+
+    def _otlp_span(self, span):
+        otlp = {
+            "traceId": f"{self.trace_id:032x}",
+            "spanId": f"{span.span_id:016x}",
+            "name": span.name,
+            "kind": 2 if span.parent_id is None else 1,  # SERVER for the root, INTERNAL otherwise
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.start_ns + int(span.duration * 1e9)),
+            "attributes": _otlp_attributes(span.attributes),
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id is not None:
+            otlp["parentSpanId"] = f"{span.parent_id:016x}"
+        return otlp
+
+
+def _otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        result.append({"key": key, "value": typed})
+    return result
+
+
+@contextmanager
+def start_trace(name, attributes=None, sample_rate=None):
+    """
+    Start a trace for one request and export it on exit.
+
+    Unsampled requests get no trace at all (None is yielded), so their spans
+    are only timed.
+    """
+    rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if not (rate > 0 and random.random() < rate):
+        yield None
+        return
+    trace = Trace(name, attributes=attributes)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(trace.root)
+    try:
+        yield trace
+    except Exception as e:
+        trace.root.error = str(e)
+        raise
+    finally:
+        trace.root.end()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        get_exporter().export(trace)
+
+
+@contextmanager
+def span(name, attributes=None):
+    """Time a stage as a child of the current span; outside a trace it is only timed"""
+    trace = _current_trace.get()
+    if trace is None:
+        detached = Span(name, 0, None, attributes)
+        try:
+            yield detached
+        finally:
+            detached.end()
+        return
+    child = trace.new_span(name, _current_span.get(), attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = str(e)
+        raise
+    finally:
+        child.end()
+        _current_span.reset(token)
+
+
+class Exporter:
+    """
+    Writes sampled traces from a background thread, so requests never wait on export.
+
+    Traces are dropped (and counted in tracing.dropped) when the queue is full.
+    """
+
+    def __init__(self, path=TRACE_EXPORT_FILE, url=TRACE_EXPORT_URL):
+        self.path = path
+        self.url = url
+        self._queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        if not self.path and not self.url:
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            metrics.inc("tracing.dropped")
+
+    def _ensure_thread(self):
+        # Started on first use rather than at import, so it is never inherited across a fork
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+                metrics.inc("tracing.exported", len(batch))
+            except Exception as e:
+                metrics.inc("tracing.export_errors")
+                logger.warning(f"Trace export failed: {e}")
+
+    def _write(self, traces):
+        if self.path:
+            with open(self.path, "a") as f:
+                for trace in traces:
+                    f.write(json.dumps(trace.to_otlp()) + "\n")
+        if self.url:
+            import requests
+            payload = {"resourceSpans": [rs for trace in traces for rs in trace.to_otlp()["resourceSpans"]]}
+            response = requests.post(self.url, json=payload, timeout=5)
+            response.raise_for_status()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    """Return the process-wide exporter configured with TRACE_EXPORT_FILE / TRACE_EXPORT_URL"""
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = Exporter()
+    return _exporter
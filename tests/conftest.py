@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fitness_assistant")
+
+# The modules import each other by name and find ../data from the working
+# directory, as when they run from fitness_assistant/
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+
+# No Gemini calls, no waiting on the fake, and conversation rows written before /ask returns
+os.environ["LLM_BACKEND"] = "fake"
+os.environ["FAKE_LLM_LATENCY"] = "0"
+os.environ["SPOOL_DIR"] = ""
+os.environ["CONVERSATION_WRITE"] = "sync"
+
+TEST_DB = "fitness_assistant_test"
+
+
+@pytest.fixture(scope="session")
+def database():
+    """A fresh database with the current schema; skips the test without a reachable Postgres"""
+    import psycopg2
+    import db
+
+    try:
+        conn = db.get_db_connection()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"Postgres is not available: {e}")
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {TEST_DB}")
+        cur.execute(f"CREATE DATABASE {TEST_DB}")
+    original = os.environ.get("POSTGRES_DB")
+    os.environ["POSTGRES_DB"] = TEST_DB
+    db.init_db()
+    yield TEST_DB
+    if original is None:
+        del os.environ["POSTGRES_DB"]
+    else:
+        os.environ["POSTGRES_DB"] = original
+    with conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {TEST_DB} WITH (FORCE)")
+    conn.close()
+
+
+@pytest.fixture(scope="session")
+def client(database):
+    import app
+
+    app.app.config["TESTING"] = True
+    return app.app.test_client()
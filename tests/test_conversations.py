@@ -0,0 +1,70 @@
+import base64
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import db
+
+MODEL = "paging-test-model"
+
+
+@pytest.fixture(scope="module")
+def conversations(database):
+    """Conversations of one model, several sharing a timestamp, newest first as the API pages them"""
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    rows = [(str(uuid.uuid4()), start + timedelta(seconds=i // 3)) for i in range(11)]
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            for conversation_id, timestamp in rows:
+                cur.execute("""
+                    INSERT INTO conversations (id, question, answer, model_used, timestamp)
+                    VALUES (%s, 'Question', 'Answer', %s, %s)
+                """, (conversation_id, MODEL, timestamp))
+        conn.commit()
+    finally:
+        conn.close()
+    rows.sort(key=lambda row: (row[1], uuid.UUID(row[0])), reverse=True)
+    return [conversation_id for conversation_id, _ in rows]
+
+
+def test_cursor_walks_every_row_once(client, conversations):
+    seen = []
+    cursor = None
+    for _ in range(len(conversations)):
+        params = {"model": MODEL, "limit": 4}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/conversations", query_string=params)
+        assert response.status_code == 200
+        page = response.get_json()
+        seen += [row["id"] for row in page["conversations"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert seen == conversations
+
+
+def test_cursor_round_trips(conversations):
+    timestamp = datetime(2024, 1, 1, 12, 0, 1, 250000)
+    assert db.decode_cursor(db.encode_cursor(timestamp, conversations[0])) == (timestamp, conversations[0])
+
+
+def test_last_page_has_no_cursor(client, conversations):
+    page = client.get("/conversations", query_string={"model": MODEL, "limit": len(conversations)}).get_json()
+    assert [row["id"] for row in page["conversations"]] == conversations
+    assert page["next_cursor"] is None
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    base64.urlsafe_b64encode(b"no separator").decode(),
+    base64.urlsafe_b64encode(b"2024-01-01T12:00:00|not-a-uuid").decode(),
+    base64.urlsafe_b64encode(b"yesterday|" + str(uuid.uuid4()).encode()).decode(),
+])
+def test_bad_cursor_is_a_client_error(client, cursor):
+    response = client.get("/conversations", query_string={"cursor": cursor})
+    assert response.status_code == 400
+    assert "error" in response.get_json()
@@ -0,0 +1,38 @@
+import costs
+import rag
+from costs import SpendTracker
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+
+
+def spent(ratio, daily_budget=1.0):
+    """A tracker, kept in memory, that has spent `ratio` of its budget today"""
+    tracker = SpendTracker(daily_budget=daily_budget, persist=False)
+    prompt_tokens = int(ratio * daily_budget * 1_000_000 / costs.price_table()["models"][DEFAULT_MODEL]["input"]) + 1
+    tracker.record(DEFAULT_MODEL, {"prompt_tokens": prompt_tokens, "completion_tokens": 0})
+    return tracker
+
+
+def test_default_model_downgrades_once_the_budget_is_used_up():
+    assert spent(0.5).answer_model(DEFAULT_MODEL) == DEFAULT_MODEL
+    assert spent(costs.BUDGET_DOWNGRADE_RATIO).answer_model(DEFAULT_MODEL) == "gemini-1.5-flash-8b"
+
+
+def test_every_downgrade_is_cheaper():
+    for model, downgrade in costs.MODEL_DOWNGRADES.items():
+        assert costs.cheaper_model(model) == downgrade
+
+
+def test_downgrade_at_the_same_price_is_not_used(monkeypatch):
+    table = {"models": {"big": {"input": 1.0, "cached_input": 0.5, "output": 2.0},
+                        "small": {"input": 1.0, "cached_input": 0.5, "output": 2.0}}}
+    monkeypatch.setitem(costs.MODEL_DOWNGRADES, "big", "small")
+    assert costs.cheaper_model("big", table) == "big"
+
+
+def test_rag_answers_with_the_cheaper_model(monkeypatch):
+    monkeypatch.setattr(costs, "_tracker", spent(costs.BUDGET_DOWNGRADE_RATIO))
+    answer_data = rag.rag("How do I do a push-up?")
+    assert answer_data["model_used"] == "gemini-1.5-flash-8b"
+    # Past the judge threshold too, so no relevance call is made
+    assert answer_data["relevance"] == "UNKNOWN"
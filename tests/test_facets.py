@@ -0,0 +1,56 @@
+import pytest
+
+import facets
+import index_registry
+import rag
+
+QUERIES = [
+    "How do I train my legs with dumbbells?",
+    "exercises for the chest",
+    "core stability without equipment",
+    "pull movements for the upper back",
+]
+
+FILTERS = [
+    {"body_part": "Lower Body"},
+    {"type_of_equipment": ["Dumbbells", "Kettlebell"]},
+    {"type": "Push", "body_part": ["Upper Body", "Core"]},
+    {"type_of_activity": "Strength/Mobility"},
+]
+
+
+@pytest.fixture(scope="module")
+def docs():
+    rag.warmup()
+    return index_registry.current().index.docs
+
+
+def matches(doc, filters):
+    return all(facets.split_values(doc[field]) & values for field, values in filters.items())
+
+
+@pytest.mark.parametrize("raw_filters", FILTERS)
+@pytest.mark.parametrize("query", QUERIES)
+def test_filtered_search_equals_filtering_the_full_ranking(docs, query, raw_filters):
+    filters = facets.parse_filters(raw_filters)
+    # With room for every document neither search cuts ties, so the orders are comparable
+    filtered = rag.search(query, rag.BOOST, filters=filters, num_results=len(docs))
+    unfiltered = rag.search(query, rag.BOOST, num_results=len(docs))
+
+    assert [doc["ID"] for doc in filtered] == [doc["ID"] for doc in unfiltered if matches(doc, filters)]
+
+
+@pytest.mark.parametrize("raw_filters", FILTERS)
+def test_candidates_are_the_matching_documents(docs, raw_filters):
+    filters = facets.parse_filters(raw_filters)
+    candidates = index_registry.current().facet_index.candidates(filters)
+    assert list(candidates) == [i for i, doc in enumerate(docs) if matches(doc, filters)]
+
+
+def test_no_filters_means_no_candidate_restriction(docs):
+    assert index_registry.current().facet_index.candidates({}) is None
+
+
+def test_unknown_filter_field_is_rejected():
+    with pytest.raises(ValueError):
+        facets.parse_filters({"difficulty": "Easy"})
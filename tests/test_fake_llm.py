@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import llm
+from fake_llm import FakeBackend, RELEVANCE_LABELS
+
+PROMPT = "Question: How do I do a push-up?\nContext: Push-Ups, Chest, Bodyweight"
+
+
+def outcomes(backend, n=60):
+    """What each of n calls returned, or the error it raised"""
+    results = []
+    for i in range(n):
+        try:
+            results.append(backend.generate(f"{PROMPT} #{i}", "fake-model"))
+        except llm.LLMError as e:
+            results.append(type(e).__name__)
+    return results
+
+
+def test_same_prompt_same_answer():
+    backend = FakeBackend(latency=0, seed=1)
+    first = backend.generate(PROMPT, "fake-model")
+    assert backend.generate(PROMPT, "fake-model") == first
+    # The answer depends on the prompt only, not on the seed or the call count
+    assert FakeBackend(latency=0, seed=2).generate(PROMPT, "other-model") == first
+
+
+def test_same_seed_same_failures():
+    run = outcomes(FakeBackend(latency=0, error_rate=0.2, rate_limit_rate=0.2, seed=7))
+    assert run == outcomes(FakeBackend(latency=0, error_rate=0.2, rate_limit_rate=0.2, seed=7))
+    assert {"LLMError", "LLMRateLimitError"} <= {r for r in run if isinstance(r, str)}
+    assert run != outcomes(FakeBackend(latency=0, error_rate=0.2, rate_limit_rate=0.2, seed=8))
+
+
+def test_relevance_prompt_returns_a_label():
+    text, tokens = FakeBackend(latency=0).generate('Answer with JSON: {"Relevance": ...}', "fake-model")
+    assert json.loads(text)["Relevance"] in RELEVANCE_LABELS
+    assert tokens["total_tokens"] == tokens["prompt_tokens"] + tokens["completion_tokens"]
+
+
+def test_stream_matches_generate():
+    backend = FakeBackend(latency=0, chunk_delay=0)
+    chunks = list(backend.stream(PROMPT, "fake-model"))
+    text, tokens = backend.generate(PROMPT, "fake-model")
+    assert "".join(chunk for chunk, _ in chunks) == text
+    assert chunks[-1][1] == tokens
+
+
+def test_slow_call_times_out():
+    with pytest.raises(llm.LLMTimeoutError):
+        FakeBackend(latency=1.0).generate(PROMPT, "fake-model", timeout=0.01)
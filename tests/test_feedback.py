@@ -0,0 +1,64 @@
+import uuid
+
+import db
+
+
+def new_conversation():
+    conversation_id = str(uuid.uuid4())
+    db.save_conversation(conversation_id, "How do I do a squat?", "Keep your back straight.",
+                         model_used="fake-model")
+    return conversation_id
+
+
+def stored_feedback(conversation_id):
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM feedback WHERE conversation_id = %s", (conversation_id,))
+            rows = cur.fetchone()[0]
+            cur.execute("""
+                SELECT positive_feedback, negative_feedback FROM feedback_conversation_stats
+                WHERE conversation_id = %s
+            """, (conversation_id,))
+            counters = cur.fetchone()
+    finally:
+        conn.close()
+    return rows, counters
+
+
+def test_retried_feedback_is_stored_once(client):
+    conversation_id = new_conversation()
+    event_id = str(uuid.uuid4())
+    for _ in range(3):
+        response = client.post("/feedback", json={"conversation_id": conversation_id,
+                                                  "feedback": 1, "event_id": event_id})
+        assert response.status_code == 200
+
+    assert stored_feedback(conversation_id) == (1, (1, 0))
+
+
+def test_retried_batch_is_stored_once(client):
+    conversation_id = new_conversation()
+    items = [{"conversation_id": conversation_id, "feedback": feedback, "event_id": str(uuid.uuid4())}
+             for feedback in (1, 1, -1)]
+
+    first = client.post("/feedback/batch", json={"feedback": items})
+    retry = client.post("/feedback/batch", json={"feedback": items + items})
+
+    assert first.get_json() == {"received": 3, "saved": 3}
+    assert retry.get_json() == {"received": 6, "saved": 0}
+    assert stored_feedback(conversation_id) == (3, (2, 1))
+
+
+def test_feedback_without_event_id_is_not_deduplicated(database):
+    conversation_id = new_conversation()
+    assert db.save_feedback_batch([(conversation_id, 1), (conversation_id, 1)]) == 2
+    assert stored_feedback(conversation_id) == (2, (2, 0))
+
+
+def test_invalid_event_id_is_rejected(client):
+    conversation_id = new_conversation()
+    response = client.post("/feedback", json={"conversation_id": conversation_id,
+                                              "feedback": 1, "event_id": "retry-1"})
+    assert response.status_code == 400
+    assert stored_feedback(conversation_id) == (0, None)
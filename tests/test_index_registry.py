@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+import index_registry
+from index_registry import IndexRegistry
+
+TENANTS = ["gym-a", "gym-b", "gym-c"]
+
+
+@pytest.fixture
+def catalogues(tmp_path, monkeypatch):
+    """Three tenants with catalogues of the same size and no documents in common"""
+    data = pd.read_csv(index_registry.injest.DATA_PATH).head(60)
+    paths = {}
+    for tenant in TENANTS:
+        path = tmp_path / f"{tenant}.csv"
+        data.assign(instructions=data["instructions"] + f" ({tenant})").to_csv(path, index=False)
+        paths[tenant] = str(path)
+    monkeypatch.setattr(index_registry, "_catalogues", paths)
+    monkeypatch.setattr(index_registry.injest, "SHARED_INDEX_PATH", None)
+    return paths
+
+
+def catalogue_bytes(tenant):
+    registry = IndexRegistry(max_bytes=2**40, pinned=())
+    registry.get(tenant)
+    return registry.total_bytes()
+
+
+def test_eviction_stops_once_the_budget_is_met(catalogues):
+    # Room for two catalogues, documents included, but not three
+    registry = IndexRegistry(max_bytes=int(2.1 * catalogue_bytes("gym-a")), pinned=())
+    for tenant in TENANTS:
+        registry.get(tenant)
+
+    stats = registry.stats()
+    assert [tenant for tenant in TENANTS if stats[tenant]["loaded"]] == ["gym-b", "gym-c"]
+    assert stats["gym-a"]["evictions"] == 1
+    assert registry.total_bytes() <= registry.max_bytes
+
+
+def test_evicted_documents_leave_the_pool(catalogues):
+    registry = IndexRegistry(max_bytes=int(1.5 * catalogue_bytes("gym-a")), pinned=())
+    registry.get("gym-a")
+    registry.get("gym-b")
+
+    assert len(registry.documents) == len(registry.get("gym-b", count_hit=False).index.docs)
+
+
+def test_pinned_tenant_is_kept(catalogues):
+    registry = IndexRegistry(max_bytes=int(1.5 * catalogue_bytes("gym-a")), pinned=("gym-a",))
+    for tenant in TENANTS:
+        registry.get(tenant)
+
+    stats = registry.stats()
+    assert [tenant for tenant in TENANTS if stats[tenant]["loaded"]] == ["gym-a", "gym-c"]
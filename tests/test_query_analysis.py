@@ -0,0 +1,36 @@
+import pytest
+
+import index_registry
+import rag
+
+QUERIES = [
+    "How do I do squats with dumbbells?",
+    "squatting squat squats",
+    "exercises for the deltiods and tricpes",
+    "What is a deadlift?",
+    "12 kg kettlebell swings, 3 sets",
+    "",
+    "a",
+]
+
+
+@pytest.fixture(scope="module")
+def analyser():
+    rag.warmup()
+    return index_registry.current().query_analyser
+
+
+def test_batch_matrices_equal_the_per_query_vectors(analyser):
+    matrices = analyser.matrices(QUERIES)
+    for i, query in enumerate(QUERIES):
+        for matrix, vector in zip(matrices, analyser.vectors(query)):
+            assert abs(matrix[i] - vector).max() < 1e-12
+
+
+def test_batch_correction_equals_per_token_correction(analyser):
+    tokens = ["deltiods", "tricpes", "squats", "dumbells", "what", "kettlebel", "zzzzzz", "12"]
+    assert analyser.correct_all(tokens) == [analyser.correct(token) for token in tokens]
+
+
+def test_typo_is_corrected_to_a_vocabulary_term(analyser):
+    assert analyser.analyse("deltiods") == ["deltoids"]
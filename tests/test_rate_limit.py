@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter, RateLimitTimeout, PRIORITY_INTERACTIVE, PRIORITY_JUDGE, PRIORITY_BATCH
+
+MODEL = "test-model"
+
+
+def drained_limiter(rpm=600):
+    """A limiter whose request bucket is empty and refills one request every 60/rpm seconds"""
+    limiter = RateLimiter(limits={MODEL: {"rpm": rpm, "tpm": 10 ** 9}})
+    with pytest.raises(RateLimitTimeout):
+        while True:
+            limiter.acquire(MODEL, 1, timeout=0)
+    return limiter
+
+
+def test_waiters_are_served_by_priority(monkeypatch):
+    # Without reserves, only the queue order decides who gets the next request
+    monkeypatch.setattr(rate_limit, "PRIORITY_RESERVE", {})
+    limiter = drained_limiter()
+    served = []
+
+    def waiter(priority):
+        limiter.acquire(MODEL, 1, priority=priority, timeout=5)
+        served.append(priority)
+
+    threads = []
+    # Lowest priority first, so the order served is not the order of arrival
+    for priority in (PRIORITY_BATCH, PRIORITY_JUDGE, PRIORITY_INTERACTIVE):
+        thread = threading.Thread(target=waiter, args=(priority,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join(5)
+
+    assert served == [PRIORITY_INTERACTIVE, PRIORITY_JUDGE, PRIORITY_BATCH]
+
+
+def test_batch_leaves_a_reserve_for_interactive():
+    limiter = RateLimiter(limits={MODEL: {"rpm": 10, "tpm": 10 ** 9}})
+    for _ in range(5):
+        limiter.acquire(MODEL, 1, priority=PRIORITY_BATCH, timeout=0)
+    # Half the bucket is kept for the interactive traffic
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(MODEL, 1, priority=PRIORITY_BATCH, timeout=0)
+    limiter.acquire(MODEL, 1, priority=PRIORITY_INTERACTIVE, timeout=0)
+
+
+def test_unknown_model_is_not_throttled():
+    limiter = RateLimiter(limits={})
+    for _ in range(100):
+        limiter.acquire(MODEL, 10 ** 6, timeout=0)
+    assert limiter.stats["acquired"] == 0
+
+
+def tokens_level(limiter, model):
+    return limiter.store.update(model, lambda state: state)[1]
+
+
+def test_call_is_settled_on_prompt_and_completion_tokens(monkeypatch):
+    import costs
+    import rag
+
+    model = "gemini-1.5-flash"
+    tpm = 60_000  # refills one token per millisecond, so the level barely moves during the call
+    limiter = RateLimiter(limits={model: {"rpm": 1000, "tpm": tpm}})
+    monkeypatch.setattr(rate_limit, "get_rate_limiter", lambda: limiter)
+    monkeypatch.setattr(costs, "_tracker", costs.SpendTracker(daily_budget=None, persist=False))
+
+    _, tokens_stats = rag.llm_gemini("How do I do a push-up? " * 20, model=model)
+
+    assert tokens_stats["completion_tokens"] > 0
+    used = tpm - tokens_level(limiter, model)
+    assert used == pytest.approx(tokens_stats["prompt_tokens"] + tokens_stats["completion_tokens"], abs=10)
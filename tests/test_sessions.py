@@ -0,0 +1,84 @@
+import uuid
+
+import pytest
+
+import db
+import sessions
+from sessions import SessionStore
+
+PREVIOUS = "How do I do a Romanian deadlift?"
+
+
+def session_with_a_turn():
+    return {"id": "s", "summary": "", "turns": [{"question": PREVIOUS, "answer": "Hinge at the hips."}],
+            "version": 1}
+
+
+@pytest.mark.parametrize("question", [
+    "And for beginners?",
+    "what about with kettlebells?",
+    "How about an easier one?",
+    "Is it safe for my knees?",
+    "Can I do that at home?",
+    "Are those good for beginners?",
+    "Is this exercise ok with back pain?",
+    "Any alternatives?",
+])
+def test_follow_up_borrows_the_previous_question(question):
+    assert sessions.rewrite_query(session_with_a_turn(), question) == f"{PREVIOUS} {question}"
+
+
+@pytest.mark.parametrize("question", [
+    "What is a deadlift?",
+    "How do I do a push-up?",
+    "How many sets should I do?",
+    "What muscles do lunges work?",
+    "Squats",
+    "Exercises that target the glutes",
+    "Best core exercises for runners",
+    "And I also want to know which exercises train the lower back best",
+])
+def test_standalone_question_is_searched_as_it_is(question):
+    assert sessions.rewrite_query(session_with_a_turn(), question) == question
+
+
+def test_first_question_is_never_rewritten():
+    assert sessions.rewrite_query({"id": "s", "summary": "", "turns": []}, "And for beginners?") == \
+        "And for beginners?"
+
+
+def test_cached_session_is_used_without_a_round_trip(database, monkeypatch):
+    store = SessionStore()
+    session = store.get_or_create(str(uuid.uuid4()))
+    store.add_turn(session, PREVIOUS, "Hinge at the hips.")
+
+    def no_round_trip(session_id):
+        raise AssertionError("version checked within SESSION_REVALIDATE_SECONDS")
+
+    monkeypatch.setattr(db, "get_session_version", no_round_trip)
+    assert store.get_or_create(session["id"]) is session
+
+
+def test_stale_session_is_reloaded_after_the_revalidation_interval(database, monkeypatch):
+    worker_a, worker_b = SessionStore(), SessionStore()
+    session_id = str(uuid.uuid4())
+    worker_a.add_turn(worker_a.get_or_create(session_id), "first", "answer 1")
+    worker_b.add_turn(worker_b.get_or_create(session_id), "second", "answer 2")
+
+    # Within the interval worker A trusts its cache; past it, A sees B's turn
+    assert [t["question"] for t in worker_a.get_or_create(session_id)["turns"]] == ["first"]
+    monkeypatch.setattr(sessions, "SESSION_REVALIDATE_SECONDS", 0)
+    assert [t["question"] for t in worker_a.get_or_create(session_id)["turns"]] == ["first", "second"]
+
+
+def test_save_on_a_stale_cache_keeps_both_turns(database):
+    worker_a, worker_b = SessionStore(), SessionStore()
+    session_id = str(uuid.uuid4())
+    worker_a.add_turn(worker_a.get_or_create(session_id), "first", "answer 1")
+    worker_b.add_turn(worker_b.get_or_create(session_id), "second", "answer 2")
+
+    # Worker A's cached copy is behind; the conditional save reloads it and adds the turn on top
+    worker_a.add_turn(worker_a.get_or_create(session_id), "third", "answer 3")
+
+    stored = db.get_session(session_id)
+    assert [t["question"] for t in stored["turns"]] == ["first", "second", "third"]
@@ -0,0 +1,255 @@
+import threading
+import time
+
+import pytest
+
+import admission
+import deadlines
+from singleflight import SingleFlight
+
+N_FOLLOWERS = 4
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+class Flight:
+    """A leader on a key and N_FOLLOWERS followers that join while it computes, each under admission control"""
+
+    def __init__(self, flight, fn, leader_timeout=None, follower_timeout=None, deadline_bound=None):
+        self.flight = flight
+        self.fn = fn
+        self.timeouts = (leader_timeout, follower_timeout)
+        self.deadline_bound = deadline_bound
+        self.controller = admission.AdmissionController(max_inflight=N_FOLLOWERS + 1)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+        self.results = []
+
+    def compute(self):
+        self.calls += 1
+        if self.started.is_set():
+            time.sleep(0.1)  # a follower running again; the others join it meanwhile
+        self.started.set()
+        self.release.wait(5)
+        return self.fn()
+
+    def call(self, timeout):
+        try:
+            with deadlines.start(timeout or 60), self.controller.admit():
+                self.results.append(self.flight.do("key", self.compute, deadline_bound=self.deadline_bound))
+        except Exception as e:
+            self.results.append(e)
+
+    def run(self):
+        leader_timeout, follower_timeout = self.timeouts
+        leader = threading.Thread(target=self.call, args=(leader_timeout,))
+        leader.start()
+        assert self.started.wait(5)
+        followers = [threading.Thread(target=self.call, args=(follower_timeout,)) for _ in range(N_FOLLOWERS)]
+        for thread in followers:
+            thread.start()
+        # Only the leader keeps its slot once every follower waits
+        wait_until(lambda: self.controller.queue_depth() == 0 and self.controller.inflight() == 1
+                   and len([t for t in followers if t.is_alive()]) == N_FOLLOWERS)
+        time.sleep(0.05)
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        assert self.controller.inflight() == 0
+        return self.results
+
+
+def test_followers_share_the_leaders_result():
+    flight = Flight(SingleFlight(), lambda: {"answer": 42})
+    results = flight.run()
+    assert flight.calls == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * N_FOLLOWERS
+    assert all(result == {"answer": 42} for result, _ in results)
+
+
+def test_leaders_error_reaches_followers():
+    def fail():
+        raise ValueError("backend down")
+
+    flight = Flight(SingleFlight(), fail)
+    results = flight.run()
+    assert flight.calls == 1
+    assert len(results) == N_FOLLOWERS + 1
+    assert all(isinstance(e, ValueError) and str(e) == "backend down" for e in results)
+
+
+def test_leaders_deadline_is_not_imposed_on_followers_with_more_time():
+    def out_of_time():
+        if flight.calls == 1:
+            raise deadlines.DeadlineExceeded("llm")
+        return {"answer": 42}
+
+    flight = Flight(SingleFlight(), out_of_time, leader_timeout=1, follower_timeout=30)
+    results = flight.run()
+    assert isinstance(results[0], deadlines.DeadlineExceeded)
+    # One follower runs again and the others share its answer
+    assert flight.calls == 2
+    assert sorted(shared for _, shared in results[1:]) == [False] + [True] * (N_FOLLOWERS - 1)
+
+
+def test_degraded_result_is_recomputed_for_followers_with_more_time():
+    def answer():
+        return {"degradations": ["skip_judge"] if flight.calls == 1 else []}
+
+    flight = Flight(SingleFlight(), answer, leader_timeout=1, follower_timeout=30,
+                    deadline_bound=lambda result, error: error is None and bool(result["degradations"]))
+    results = flight.run()
+    assert flight.calls == 2
+    assert results[0] == ({"degradations": ["skip_judge"]}, False)
+    assert all(result == {"degradations": []} for result, _ in results[1:])
+
+
+def test_followers_with_less_time_share_the_leaders_timeout():
+    def out_of_time():
+        raise deadlines.DeadlineExceeded("llm")
+
+    flight = Flight(SingleFlight(), out_of_time, leader_timeout=30, follower_timeout=10)
+    results = flight.run()
+    assert flight.calls == 1
+    assert all(isinstance(e, deadlines.DeadlineExceeded) for e in results)
+
+
+def test_key_is_free_after_an_error():
+    single_flight = SingleFlight()
+    with pytest.raises(ValueError):
+        single_flight.do("key", lambda: (_ for _ in ()).throw(ValueError("first")))
+    assert single_flight.do("key", lambda: "second") == ("second", False)
+
+
+def test_follower_gives_up_at_its_deadline():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "late"
+
+    leader = threading.Thread(target=single_flight.do, args=("key", slow))
+    leader.start()
+    assert started.wait(5)
+    try:
+        with deadlines.start(0.1):
+            with pytest.raises(deadlines.DeadlineExceeded):
+                single_flight.do("key", slow)
+    finally:
+        release.set()
+        leader.join(5)
+
+
+class OtherWorker:
+    """A leader on the key in another SingleFlight on the same directory, as in another gunicorn worker"""
+
+    def __init__(self, shared_dir, fn):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.result = None
+
+        def compute():
+            self.started.set()
+            self.release.wait(5)
+            return fn()
+
+        def lead():
+            try:
+                self.result = SingleFlight(shared_dir=shared_dir).do("key", compute)
+            except Exception as e:
+                self.result = e
+
+        self.thread = threading.Thread(target=lead)
+        self.thread.start()
+        assert self.started.wait(5)
+
+    def finish(self):
+        self.release.set()
+        self.thread.join(5)
+
+
+def follow_with_admission(shared_dir, controller, release, wait_timeout=30.0):
+    """Follow the other worker under admission control; returns (result, slots in use while computing)"""
+    inflight = []
+
+    def compute():
+        inflight.append(controller.inflight())
+        return "own"
+
+    with controller.admit():
+        # The follower gives its slot back while it waits; then the other worker finishes
+        threading.Thread(target=lambda: (wait_until(lambda: controller.inflight() == 0), release())).start()
+        result = SingleFlight(shared_dir=shared_dir, wait_timeout=wait_timeout).do("key", compute)
+    return result, inflight
+
+
+def test_cross_worker_follower_shares_the_result(tmp_path):
+    other = OtherWorker(str(tmp_path), lambda: {"answer": 42})
+    controller = admission.AdmissionController(max_inflight=1)
+    result, inflight = follow_with_admission(str(tmp_path), controller, other.finish)
+
+    assert other.result == ({"answer": 42}, False)
+    assert result == ({"answer": 42}, True)
+    assert inflight == []
+
+
+def test_cross_worker_follower_computes_with_a_slot_after_a_leader_error(tmp_path):
+    def fail():
+        raise ValueError("backend down")
+
+    other = OtherWorker(str(tmp_path), fail)
+    controller = admission.AdmissionController(max_inflight=1)
+    # The error is not published to other workers; the follower takes a slot again and runs itself
+    result, inflight = follow_with_admission(str(tmp_path), controller, other.finish)
+
+    assert isinstance(other.result, ValueError)
+    assert result == ("own", False)
+    assert inflight == [1]
+    assert controller.inflight() == 0
+
+
+def test_cross_worker_follower_computes_with_a_slot_after_waiting_too_long(tmp_path):
+    other = OtherWorker(str(tmp_path), lambda: "late")
+    controller = admission.AdmissionController(max_inflight=1)
+    try:
+        result, inflight = follow_with_admission(str(tmp_path), controller, lambda: None, wait_timeout=0.2)
+    finally:
+        other.finish()
+
+    assert result == ("own", False)
+    assert inflight == [1]
+    assert controller.inflight() == 0
+
+
+def test_follower_without_a_slot_to_return_to_is_shed(tmp_path):
+    other = OtherWorker(str(tmp_path), lambda: "late")
+    controller = admission.AdmissionController(max_inflight=1, max_queue=0)
+    taken = threading.Event()
+    done = threading.Event()
+
+    def take_the_freed_slot():
+        wait_until(lambda: controller.inflight() == 0)
+        with controller.admit():
+            taken.set()
+            done.wait(5)
+
+    busy = threading.Thread(target=take_the_freed_slot)
+    try:
+        with controller.admit():
+            busy.start()
+            with pytest.raises(admission.Overloaded):
+                SingleFlight(shared_dir=str(tmp_path), wait_timeout=0.2).do("key", lambda: "own")
+        assert taken.is_set()
+    finally:
+        done.set()
+        busy.join(5)
+        other.finish()
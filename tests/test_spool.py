@@ -0,0 +1,134 @@
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import pytest
+
+import db
+import spool
+
+CRASHING_WORKER = """
+import os, sys
+import spool
+
+def postgres_down(conversations, feedback):
+    raise ConnectionError("Postgres is down")
+
+worker = spool.Spool(sys.argv[1], ship=postgres_down)
+for conversation_id in sys.argv[2:]:
+    worker.append([spool.conversation_record(conversation_id, question="Q", answer="A")])
+    worker.append([spool.feedback_record(conversation_id, 1, event_id=str(uuid.uuid4()))])
+os._exit(1)  # no close(), no atexit: the process just dies
+"""
+
+
+class Store:
+    """Stands in for Postgres: inserts are idempotent on the conversation id and feedback event_id"""
+
+    def __init__(self, fail_after_insert=0):
+        self.rows = {}
+        self.shipments = 0
+        self.fail_after_insert = fail_after_insert
+
+    def __call__(self, conversations, feedback):
+        self.shipments += 1
+        for record in conversations:
+            self.rows.setdefault(("conversation", record["id"]), record)
+        missing = []
+        for record in feedback:
+            if ("conversation", record["conversation_id"]) in self.rows:
+                self.rows.setdefault(("feedback", record["event_id"]), record)
+            else:
+                missing.append(record["event_id"])
+        if self.fail_after_insert:
+            # Committed, but the connection dropped before the shipper heard back
+            self.fail_after_insert -= 1
+            raise ConnectionError("connection lost")
+        return missing
+
+    def count(self, kind):
+        return sum(1 for row_kind, _ in self.rows if row_kind == kind)
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture(autouse=True)
+def fast_shipping(monkeypatch):
+    monkeypatch.setattr(spool, "SPOOL_SHIP_INTERVAL", 0.01)
+
+
+def test_reshipping_after_a_lost_acknowledgement_stores_once(tmp_path):
+    store = Store(fail_after_insert=1)
+    worker = spool.Spool(str(tmp_path), ship=store)
+    try:
+        conversation_ids = [str(uuid.uuid4()) for _ in range(5)]
+        worker.append([spool.conversation_record(cid, question="Q", answer="A") for cid in conversation_ids])
+        worker.append([spool.feedback_record(cid, 1) for cid in conversation_ids])
+        wait_until(lambda: worker.depth == 0)
+    finally:
+        worker.close()
+
+    assert store.shipments >= 2
+    assert store.count("conversation") == 5
+    assert store.count("feedback") == 5
+
+
+def test_crashed_workers_records_are_adopted_and_shipped_once(tmp_path):
+    conversation_ids = [str(uuid.uuid4()) for _ in range(3)]
+    subprocess.run([sys.executable, "-c", "import uuid\n" + CRASHING_WORKER, str(tmp_path)] + conversation_ids,
+                   env=dict(os.environ, PYTHONPATH=os.getcwd()), check=False, timeout=30)
+    active = [name for name in os.listdir(tmp_path) if name.endswith(".active")]
+    assert active
+    with open(tmp_path / active[0], "ab") as f:
+        f.write(b'{"type": "conversation", "id": "torn')  # the write the crash interrupted
+
+    store = Store()
+    worker = spool.Spool(str(tmp_path), ship=store)
+    try:
+        wait_until(lambda: store.count("feedback") == 3)
+        wait_until(lambda: worker.depth == 0)
+    finally:
+        worker.close()
+
+    assert {key for kind, key in store.rows if kind == "conversation"} == set(conversation_ids)
+    # Nothing is left to adopt: the dead worker's segments and lock are gone
+    assert not [name for name in os.listdir(tmp_path) if not name.startswith(worker.owner)]
+
+
+def test_append_after_close_fails(tmp_path):
+    worker = spool.Spool(str(tmp_path), ship=Store())
+    worker.close()
+    with pytest.raises(spool.SpoolError):
+        worker.append([spool.feedback_record(str(uuid.uuid4()), 1)])
+
+
+def test_reshipped_records_are_stored_once_in_postgres(database):
+    conversation_id = str(uuid.uuid4())
+    conversations = [spool.conversation_record(conversation_id, question="Q", answer="A",
+                                               model_used="fake-model")]
+    feedback = [spool.feedback_record(conversation_id, -1), spool.feedback_record(str(uuid.uuid4()), 1)]
+
+    assert db.save_spooled(conversations, feedback) == [feedback[1]["event_id"]]
+    assert db.save_spooled(conversations, feedback) == [feedback[1]["event_id"]]
+
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM conversations WHERE id = %s", (conversation_id,))
+            assert cur.fetchone()[0] == 1
+            cur.execute("SELECT COUNT(*) FROM feedback WHERE conversation_id = %s", (conversation_id,))
+            assert cur.fetchone()[0] == 1
+            cur.execute("""
+                SELECT positive_feedback, negative_feedback FROM feedback_conversation_stats
+                WHERE conversation_id = %s
+            """, (conversation_id,))
+            assert cur.fetchone() == (0, 1)
+    finally:
+        conn.close()